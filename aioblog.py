@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+#LightBlog: a lightweight Python blogging application.
+#Copyright (C) 2017  Dylan Spriggs
+#
+#This program is free software; you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation; either version 2 of the License, or
+#(at your option) any later version.
+#
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License along
+#with this program; if not, write to the Free Software Foundation, Inc.,
+#51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Serves the blog from one asyncio event loop instead of a thread per request.
+
+Pages that need the database wait for their queries without blocking anything else,
+so one process can keep thousands of keep-alive connections open. Everything else
+(cached pages, the contact page, feeds...) is quick and is handed to blog.py as is.
+Run it with
+
+	./aioblog.py
+
+or under an ASGI server:
+
+	uvicorn aioblog:application
+"""
+import io
+import sys
+import asyncio
+import urllib.parse
+# blog.py and searchindex.py need to be in the same directory as aioblog.py
+import blog
+import searchindex
+# asyncio support comes with mysql-connector-python 8.3 and newer
+# pip3 install 'mysql-connector-python>=8.3'
+import mysql.connector
+try:
+	from mysql.connector import aio as mysql_aio
+except ImportError:
+	mysql_aio = None
+
+async_config = {
+	'host' : '127.0.0.1',
+	'port' : 8080,
+	# most connections to MariaDB this process will open
+	'pool_size' : 16,
+	# most of those searches can use at once, so slow searches always leave some for post views
+	'search_connections' : 4,
+	# seconds to wait for a free connection before serving a 500 error
+	'pool_timeout' : 5,
+	# seconds a query may run before it's cancelled, by query name, and for every other query
+	'timeouts' : {'search_db' : 3.0},
+	'default_timeout' : 2.0,
+	# seconds an idle keep-alive connection is kept open
+	'keep_alive' : 60,
+	# most bytes of request headers and body accepted
+	'max_head' : 16 * 1024,
+	'max_body' : 64 * 1024
+}
+
+class AsyncPool:
+	"""
+	A pool of at most 'size' asyncio connections to MySQL/MariaDB.
+	Queries named in 'limits' can only hold that many of them at once,
+	so a pile of slow searches can't leave post views waiting for a connection.
+	"""
+	def __init__(self, config, size, limits):
+		self.config = dict(config, autocommit = True)
+		self.idle = []
+		self.slots = asyncio.Semaphore(size)
+		self.limits = dict((query, asyncio.Semaphore(limit)) for query, limit in limits.items())
+		# whether the server is MariaDB, found out on the first connection
+		self.mariadb = None
+
+	async def get(self, query):
+		"""
+		Checks out a connection for query, opening a new one if there's no idle one.
+		Raises blog.SQLError if none is free within pool_timeout seconds, or it can't connect.
+		"""
+		limit = self.limits.get(query)
+		try:
+			if limit is not None:
+				await asyncio.wait_for(limit.acquire(), async_config['pool_timeout'])
+			try:
+				await asyncio.wait_for(self.slots.acquire(), async_config['pool_timeout'])
+			except BaseException:
+				if limit is not None:
+					limit.release()
+				raise
+		except asyncio.TimeoutError:
+			raise blog.SQLError('Timed out waiting for a free connection')
+		if self.idle:
+			return self.idle.pop()
+		try:
+			conn = await mysql_aio.connect(**self.config)
+		except mysql.connector.Error as e:
+			blog.log_print("SQL error: {}".format(e))
+			self._release(query)
+			raise blog.SQLError(e)
+		if self.mariadb is None:
+			try:
+				version = await run_query(conn, 'SELECT VERSION();', ())
+			except mysql.connector.Error as e:
+				blog.log_print("SQL error: {}".format(e))
+				self.put(query, conn, broken = True)
+				raise blog.SQLError(e)
+			self.mariadb = 'mariadb' in blog.to_utf8(version[0][0]).lower()
+		return conn
+
+	def put(self, query, conn, broken = False):
+		"""
+		Returns a connection to the pool.
+		Broken connections, and ones whose query was cancelled part way, are closed instead.
+		"""
+		if broken:
+			asyncio.ensure_future(close_quietly(conn))
+		else:
+			self.idle.append(conn)
+		self._release(query)
+
+	def _release(self, query):
+		self.slots.release()
+		if query in self.limits:
+			self.limits[query].release()
+
+	async def close(self):
+		while self.idle:
+			await close_quietly(self.idle.pop())
+
+async def close_quietly(conn):
+	try:
+		await asyncio.wait_for(conn.close(), 1)
+	except (asyncio.TimeoutError, mysql.connector.Error, OSError):
+		pass
+
+open_pool = {'pool' : None}
+
+def get_pool():
+	"""
+	Returns the pool, creating it the first time it's needed so it belongs to the running event loop.
+	"""
+	if open_pool['pool'] is None:
+		open_pool['pool'] = AsyncPool(
+			blog.sql_config,
+			async_config['pool_size'],
+			{'search_db' : async_config['search_connections']}
+		)
+	return open_pool['pool']
+
+async def close_pool():
+	if open_pool['pool'] is not None:
+		await open_pool['pool'].close()
+		open_pool['pool'] = None
+
+async def fetch(query, record, *parameters):
+	"""
+	Like SQLcon.fetch(), without blocking the event loop. Runs one of SQLcon.queries.
+	Raises blog.SQLError if the query failed or ran longer than its timeout, so a 500 error is served.
+	A query that runs out of time is cancelled, and the connection it was on is closed.
+	If the connection was lost, the query is tried once more on a new connection.
+	"""
+	if query not in blog.SQLcon.queries:
+		blog.log_print("SQL error: That query is not defined")
+		raise blog.SQLError('Undefined query')
+	timeout = async_config['timeouts'].get(query, async_config['default_timeout'])
+	pool = get_pool()
+	for retry in (True, False):
+		conn = await pool.get(query)
+		statement = timed_statement(blog.SQLcon.queries[query], timeout, pool.mariadb)
+		# anything but a finished query, including being cancelled, leaves the connection in an unknown state
+		broken = True
+		try:
+			rows = await asyncio.wait_for(run_query(conn, statement, parameters), timeout)
+			broken = False
+			return [record._make(map(blog.to_utf8, row)) for row in rows]
+		except asyncio.TimeoutError:
+			blog.log_print("SQL error: {} took longer than {} seconds".format(query, timeout))
+			raise blog.SQLError('Query timed out')
+		except (mysql.connector.OperationalError, mysql.connector.InterfaceError) as e:
+			blog.log_print("SQL error: {}".format(e))
+			if not retry:
+				raise blog.SQLError(e)
+		except mysql.connector.Error as e:
+			blog.log_print("SQL error: {}".format(e))
+			broken = False
+			raise blog.SQLError(e)
+		finally:
+			pool.put(query, conn, broken)
+
+def timed_statement(statement, timeout, mariadb):
+	"""
+	Returns statement with timeout seconds set on it, so the server stops the query too
+	instead of finishing it for nobody. MariaDB and MySQL set it in different ways,
+	and MySQL can only do it for a SELECT.
+	"""
+	if mariadb:
+		return 'SET STATEMENT max_statement_time={} FOR {}'.format(timeout, statement)
+	if statement.startswith('SELECT '):
+		return 'SELECT /*+ MAX_EXECUTION_TIME({}) */ {}'.format(int(timeout * 1000), statement[len('SELECT '):])
+	return statement
+
+async def run_query(conn, statement, parameters):
+	cur = await conn.cursor()
+	try:
+		await cur.execute(statement, parameters)
+		return await cur.fetchall()
+	finally:
+		await cur.close()
+
+async def serve_post(res, url_title = None, environ = None):
+	"""
+	Like blog.serve_post(), with the query run on the event loop.
+	"""
+	# reading the snapshot doesn't block
+	if blog.get_snapshot() is not None:
+		blog.serve_post(res, url_title, environ)
+		return
+	if url_title is None:
+		posts = await fetch('get_first_post_page', blog.PostPage)
+	else:
+		posts = await fetch('get_post_page', blog.PostPage, url_title)
+	blog.show_post(res, posts, environ)
+
+async def serve_default_archive(res, environ = None, before = None, after = None):
+	"""
+	Like blog.serve_default_archive(), with the queries run on the event loop.
+	"""
+	if blog.get_snapshot() is not None:
+		blog.serve_default_archive(res, environ, before, after)
+		return
+	cursor = blog.parse_archive_cursor(before or after)
+	if (before or after) and cursor is None or before and after:
+		blog.serve_error(res, '404 Not Found', 'The page you\'re requesting doesn\'t exist.')
+		return
+	if before:
+		posts = await fetch('get_archive_before', blog.ArchiveEntry, *cursor)
+	elif after:
+		posts = await fetch('get_archive_after', blog.ArchiveEntry, *cursor)
+		if len(posts) <= blog.archive_config['page_size']:
+			# close enough to the newest posts that this is the first page
+			posts = await fetch('get_title_and_desc', blog.ArchiveEntry)
+			after = None
+	else:
+		posts = await fetch('get_title_and_desc', blog.ArchiveEntry)
+	blog.show_archive(res, posts, environ, before, after)
+
+async def search_posts(search_string):
+	"""
+	Like blog.search_posts(), but a search that has to go to MariaDB runs on the event loop.
+	Searching the index file is quick, so it's done in place.
+	"""
+	index = blog.get_search_index()
+	key = blog.search_key(search_string, index is not None)
+	posts = blog.search_cache.get(key)
+	if posts is not None:
+		return posts
+	generation = blog.search_cache.generation
+	if index is not None:
+		posts = index.search(search_string)
+	else:
+		posts = await fetch('search_db', searchindex.SearchResult, search_string)
+		posts = [post for post in posts if post.rank != 0]
+	blog.search_cache.put(key, posts, generation)
+	return posts
+
+# pages being rendered, so the other requests for a page wait for its render instead of all querying MariaDB
+rendering = dict()
+
+async def find_cached_page(key):
+	"""
+	Like blog.find_cached_page(), but waiting for another request's render doesn't block the event loop.
+	Returns the page, and a future to set to the page when it's rendered if this request has to render it.
+	Waits are counted in blog.page_flights.
+	"""
+	page = blog.page_cache.get(key)
+	if page is not None:
+		return page, None
+	flight = rendering.get(key)
+	if flight is None:
+		flight = rendering[key] = asyncio.get_running_loop().create_future()
+		return None, flight
+	label = blog.page_label(key)
+	blog.page_flights.note_wait(label)
+	if blog.cache_config['serve_stale']:
+		page = blog.page_cache.get_stale(key)
+		if page is not None:
+			blog.page_flights.note_stale(label)
+			return page, None
+	try:
+		# shielded, so a waiter timing out doesn't cancel the render
+		page = await asyncio.wait_for(asyncio.shield(flight), blog.cache_config['flight_timeout'])
+	except asyncio.TimeoutError:
+		page = None
+	return page, None
+
+async def handle_request(environ):
+	"""
+	Like blog.handle_request(), but posts, the archive and searches wait for the database without blocking.
+	Every other page is passed on to blog.handle_request().
+	"""
+	blog.page_cache.check_version()
+	blog.search_cache.check_version()
+	generation = blog.page_cache.generation
+	request_type = environ.get('REQUEST_METHOD')
+	form = blog.read_form(environ)
+	# blog.handle_request() reads the body again if the request is passed on
+	environ['wsgi.input'].seek(0)
+	res = blog.Response()
+	try:
+		query = form.get('p')
+		if request_type == 'GET' and (query is None or query == 'archive' or
+				(query not in blog.named_routes and blog.is_url_title(query))):
+			key = blog.archive_key(form.get('before'), form.get('after')) if query == 'archive' else query
+			page, flight = await find_cached_page(key)
+			if page is not None:
+				return page.respond(environ)
+			# a request rendering a page for others renders all of it, and decides on a 304 once it's published
+			check_environ = None if flight is not None else environ
+			try:
+				if query == 'archive':
+					await serve_default_archive(res, check_environ, form.get('before'), form.get('after'))
+				else:
+					await serve_post(res, query, check_environ)
+				if res.streaming:
+					blog.streamed_not_modified(res, environ)
+				elif res.status == '200 OK':
+					page = blog.CachedPage(res)
+					blog.keep_page(key, page, generation)
+					return page.respond(environ)
+				return res
+			finally:
+				# the requests waiting for this page get it, or render their own if there's none
+				if flight is not None:
+					del rendering[key]
+					flight.set_result(page)
+		if request_type == 'POST' and 'search' in form:
+			done = blog.admit(res, environ)
+			if done is None:
+				return res
+			try:
+				blog.render_search_archive(res, await search_posts(form['search']))
+			finally:
+				done()
+			return res
+	except blog.SQLError:
+		# start over so a half written page isn't sent
+		res = blog.Response()
+		blog.serve_error(res, '500 Internal Error', 'Something went wrong. Please Try again later')
+		return res
+	return blog.handle_request(environ)
+
+def make_environ(method, target, headers, body, client):
+	"""
+	Returns a WSGI style environment for a request, which is what the handlers in blog.py take.
+	headers is a list of (name, value) pairs, client the (address, port) the request came from.
+	"""
+	path, _, query_string = target.partition('?')
+	environ = {
+		'REQUEST_METHOD' : method,
+		'PATH_INFO' : urllib.parse.unquote(path),
+		'QUERY_STRING' : query_string,
+		'CONTENT_LENGTH' : str(len(body)),
+		'REMOTE_ADDR' : client[0] if client else '',
+		'wsgi.input' : io.BytesIO(body)
+	}
+	for name, value in headers:
+		name = name.upper().replace('-', '_')
+		if name == 'CONTENT_TYPE':
+			environ[name] = value
+		elif name != 'CONTENT_LENGTH':
+			key = 'HTTP_' + name
+			environ[key] = environ[key] + ', ' + value if key in environ else value
+	return environ
+
+def parse_head(head):
+	"""
+	Splits the head of an HTTP request into its method, target, version and a list of headers.
+	Raises ValueError if it isn't one.
+	"""
+	lines = head.decode('latin-1').split('\r\n')
+	method, target, version = lines[0].split(' ')
+	if not version.startswith('HTTP/1.'):
+		raise ValueError(version)
+	headers = []
+	for line in lines[1:]:
+		if line:
+			name, value = line.split(':', 1)
+			headers.append((name.strip(), value.strip()))
+	return method, target, version, headers
+
+async def handle_connection(reader, writer):
+	"""
+	Serves requests on one client connection until the client closes it,
+	or it's been idle for keep_alive seconds.
+	"""
+	client = writer.get_extra_info('peername')
+	try:
+		while True:
+			try:
+				head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), async_config['keep_alive'])
+			except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+				break
+			try:
+				method, target, version, headers = parse_head(head)
+			except ValueError:
+				await send_status(writer, '400 Bad Request')
+				break
+			fields = dict((name.lower(), value.lower()) for name, value in headers)
+			length = fields.get('content-length', '0')
+			if 'transfer-encoding' in fields or not length.isdigit() or int(length) > async_config['max_body']:
+				await send_status(writer, '413 Payload Too Large')
+				break
+			try:
+				body = await asyncio.wait_for(reader.readexactly(int(length)), async_config['keep_alive'])
+			except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+				break
+			if version == 'HTTP/1.1':
+				keep_alive = fields.get('connection') != 'close'
+			else:
+				keep_alive = fields.get('connection') == 'keep-alive'
+			res = await handle_request(make_environ(method, target, headers, body, client))
+			if not await send_response(writer, res, version, keep_alive):
+				break
+	except ConnectionError:
+		pass
+	finally:
+		writer.close()
+
+async def send_response(writer, res, version, keep_alive):
+	"""
+	Writes res to the client. Streamed pages are sent chunked, or until the connection closes for HTTP/1.0.
+	Returns whether the connection can be kept open for another request.
+	"""
+	headers = list(res.headers)
+	chunked = False
+	if res.streaming:
+		chunked = version == 'HTTP/1.1'
+		if chunked:
+			headers.append(('Transfer-Encoding', 'chunked'))
+		else:
+			keep_alive = False
+	else:
+		body = res.body()
+		if not res.status.startswith('304'):
+			headers.append(('Content-Length', str(len(body))))
+	headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+	head = 'HTTP/1.1 {}\r\n'.format(res.status) + ''.join('{}: {}\r\n'.format(name, value) for name, value in headers) + '\r\n'
+	writer.write(head.encode('latin-1'))
+	if res.streaming:
+		for chunk in res.iter_body():
+			# an empty chunk would end the body early
+			if chunked and chunk:
+				writer.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+			elif not chunked:
+				writer.write(chunk)
+			await writer.drain()
+		if chunked:
+			writer.write(b'0\r\n\r\n')
+	elif not res.status.startswith('304'):
+		writer.write(body)
+	await writer.drain()
+	return keep_alive
+
+async def send_status(writer, status):
+	writer.write('HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.format(status).encode('latin-1'))
+	await writer.drain()
+
+async def application(scope, receive, send):
+	"""
+	ASGI entry point, for running under uvicorn, hypercorn and the like.
+	"""
+	if scope['type'] == 'lifespan':
+		while True:
+			message = await receive()
+			if message['type'] == 'lifespan.startup':
+				await send({'type' : 'lifespan.startup.complete'})
+			elif message['type'] == 'lifespan.shutdown':
+				await close_pool()
+				await send({'type' : 'lifespan.shutdown.complete'})
+				return
+	if scope['type'] != 'http':
+		return
+	body = bytearray()
+	more_body = True
+	while more_body:
+		message = await receive()
+		if message['type'] == 'http.disconnect':
+			return
+		body += message.get('body', b'')
+		more_body = message.get('more_body', False)
+		if len(body) > async_config['max_body']:
+			await send({'type' : 'http.response.start', 'status' : 413, 'headers' : []})
+			await send({'type' : 'http.response.body', 'body' : b''})
+			return
+	headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers']]
+	target = scope['path'] + '?' + scope['query_string'].decode('latin-1')
+	res = await handle_request(make_environ(scope['method'], target, headers, bytes(body), scope.get('client')))
+	headers = list(res.headers)
+	if not res.streaming:
+		body = res.body()
+		if not res.status.startswith('304'):
+			headers.append(('Content-Length', str(len(body))))
+	await send({
+		'type' : 'http.response.start',
+		'status' : int(res.status.split(' ', 1)[0]),
+		'headers' : [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+	})
+	if res.streaming:
+		for chunk in res.iter_body():
+			await send({'type' : 'http.response.body', 'body' : chunk, 'more_body' : True})
+		await send({'type' : 'http.response.body', 'body' : b''})
+	else:
+		await send({'type' : 'http.response.body', 'body' : b'' if res.status.startswith('304') else body})
+
+def serve(host = async_config['host'], port = async_config['port']):
+	"""
+	Serves the blog over HTTP/1.1 until interrupted.
+	Meant to sit behind a reverse proxy like nginx, same as blog.py --serve.
+	"""
+	async def run():
+		server = await asyncio.start_server(handle_connection, host, port, limit = async_config['max_head'], backlog = 1024)
+		blog.log_print("Serving on {}:{}".format(host, port))
+		async with server:
+			await server.serve_forever()
+	try:
+		asyncio.run(run())
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == '__main__':
+	if mysql_aio is None:
+		blog.log_print("aioblog.py needs mysql-connector-python 8.3 or newer")
+		sys.exit(1)
+	serve()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Times finding a post's neighbours as the number of posts grows from 10 to 100,000.
+blog.py finds them in the get_post_page query, with the post_order index.
+
+The old way of finding a post's neighbours, reading every url title in order
+and scanning for the current one, is timed too, so the two can be compared.
+This needs a MariaDB user that can create and drop the database in
+bench_config, and it drops that database when it's done.
+
+  ./bench/neighbours.py [-sizes 10,100,1000,10000,100000] [-lookups 200]
+"""
+import os
+import re
+import sys
+import time
+import random
+import datetime
+import statistics
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mysql.connector
+import blog
+
+bench_config = {
+	'unix_socket' : '/var/run/mysqld/mysqld.sock',
+	'user' : 'root',
+	'password' : '',
+	'database' : 'blog_bench',
+	'raise_on_warnings' : True
+}
+
+def create_table(con):
+	"""
+	Creates blog_posts exactly like init.sql does, indexes included.
+	"""
+	with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'init.sql')) as fh:
+		create = re.search(r'CREATE TABLE blog_posts \(.*?\) ENGINE=[^;]*;', fh.read(), re.S).group(0)
+	cur = con.cursor()
+	cur.execute("DROP DATABASE IF EXISTS {};".format(bench_config['database']))
+	cur.execute("CREATE DATABASE {};".format(bench_config['database']))
+	cur.execute("USE {};".format(bench_config['database']))
+	cur.execute(re.sub(r'--[^\n]*', '', create))
+	cur.close()
+
+def add_posts(con, start, stop):
+	"""
+	Inserts posts number start up to stop, a few per day so some share a date.
+	"""
+	first_day = datetime.date(2000, 1, 1)
+	rows = [
+		('Post {}'.format(i), 'post-{}'.format(i), first_day + datetime.timedelta(days = i // 3), 'desc', '<p>\ntext\n</p>\n')
+		for i in range(start, stop)
+	]
+	cur = con.cursor()
+	for offset in range(0, len(rows), 1000):
+		cur.executemany(
+			"INSERT INTO blog_posts(title, url_title, post_date, description, text) VALUES(%s,%s,%s,%s,%s);",
+			rows[offset:offset + 1000]
+		)
+	con.commit()
+	cur.execute("ANALYZE TABLE blog_posts;")
+	cur.fetchall()
+	cur.close()
+
+def query_seq_url_titles(url_title, sql):
+	"""
+	The way blog.py does it: the post page query looks them up in the index.
+	"""
+	post = sql.fetch('get_post_page', blog.PostPage, url_title)[0]
+	return (post.prev_url, post.next_url)
+
+def scan_seq_url_titles(url_title, con):
+	"""
+	The old way: read every url title and look for this one.
+	blog.py doesn't have this query any more, so it's run on the benchmark's own connection.
+	"""
+	cur = con.cursor()
+	cur.execute("SELECT url_title FROM blog_posts ORDER BY post_date DESC, post_id DESC;")
+	titles = [blog.to_utf8(row[0]) for row in cur.fetchall()]
+	cur.close()
+	prev_url = next_url = None
+	for offset, title in enumerate(titles):
+		if title == url_title:
+			if offset != 0:
+				prev_url = titles[offset - 1]
+			if offset != len(titles) - 1:
+				next_url = titles[offset + 1]
+			break
+	return (prev_url, next_url)
+
+def time_lookups(fn, args_list):
+	"""
+	Returns the median and 99th percentile time of fn(*args) in milliseconds.
+	"""
+	times = []
+	for args in args_list:
+		start = time.perf_counter()
+		fn(*args)
+		times.append((time.perf_counter() - start) * 1000)
+	times.sort()
+	return statistics.median(times), times[int(len(times) * 0.99) - 1 if len(times) >= 100 else -1]
+
+if __name__ == '__main__':
+	sizes = [10, 100, 1000, 10000, 100000]
+	lookups = 200
+	if '-sizes' in sys.argv:
+		sizes = [int(size) for size in sys.argv[sys.argv.index('-sizes') + 1].split(',')]
+	if '-lookups' in sys.argv:
+		lookups = int(sys.argv[sys.argv.index('-lookups') + 1])
+	con = mysql.connector.connect(**dict(bench_config, database = None))
+	create_table(con)
+	print('{:>8} {:>14} {:>14} {:>14} {:>14}'.format('posts', 'index p50 ms', 'index p99 ms', 'scan p50 ms', 'scan p99 ms'))
+	count = 0
+	try:
+		for size in sorted(sizes):
+			add_posts(con, count, size)
+			count = size
+			sql = blog.SQLcon(bench_config)
+			picks = ['post-{}'.format(random.randrange(size)) for i in range(lookups)]
+			index_p50, index_p99 = time_lookups(query_seq_url_titles, [(url, sql) for url in picks])
+			# the scan reads the whole table every time, so fewer lookups keep this from taking forever
+			scan_p50, scan_p99 = time_lookups(scan_seq_url_titles, [(url, con) for url in picks[:max(lookups * 100 // size, 5)]])
+			del sql
+			print('{:>8} {:>14.3f} {:>14.3f} {:>14.3f} {:>14.3f}'.format(size, index_p50, index_p99, scan_p50, scan_p99))
+	finally:
+		cur = con.cursor()
+		cur.execute("DROP DATABASE IF EXISTS {};".format(bench_config['database']))
+		con.close()
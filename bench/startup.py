@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Times how long blog.py takes to start and answer one request as a CGI script, for every route.
+
+Posts are made up like in suite.py, with a snapshot and a search index, so no route should
+need the database. Every request is answered by a new Python process, the way a web server
+runs a CGI script, and for each route the time over starting a bare interpreter, the time
+spent importing modules (from python3 -X importtime) and the slowest imports are printed.
+Exits with an error if any route loaded mysql.connector.
+
+  ./bench/startup.py [-posts 200] [-runs 10] [-top 3]
+
+The processes import blog like the wrapper script in the README does. Running blog.py
+itself as the CGI script also compiles it every time, which is printed at the end.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import compileall
+import statistics
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import blog
+import suite
+
+# a CGI process that imports blog, answers one request and reports whether the driver was loaded
+child = """
+import sys
+sys.path.insert(0, {repo_dir!r})
+import blog
+{settings}
+blog.main()
+print('mysql.connector loaded:', 'mysql.connector' in sys.modules, file = sys.stderr)
+"""
+
+def child_code():
+	"""
+	Returns the code for a child process, with blog.py's settings copied from this one.
+	"""
+	settings = []
+	for name in ('template_config', 'challenge_config', 'search_config', 'feed_config', 'snapshot_config', 'limit_config'):
+		settings.append('blog.{}.update({!r})'.format(name, getattr(blog, name)))
+	return child.format(repo_dir = suite.repo_dir, settings = '\n'.join(settings))
+
+def run_child(code, method, query_string, body, importtime):
+	"""
+	Runs one request in a new process. Returns its status line, stderr and wall time in milliseconds.
+	"""
+	env = dict(os.environ,
+		REQUEST_METHOD = method,
+		QUERY_STRING = query_string,
+		CONTENT_TYPE = 'application/x-www-form-urlencoded',
+		CONTENT_LENGTH = str(len(body)),
+		SERVER_NAME = 'localhost',
+		SERVER_PORT = '80',
+		SERVER_PROTOCOL = 'HTTP/1.1'
+	)
+	args = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', code]
+	start = time.perf_counter()
+	done = subprocess.run(args, input = body, env = env, capture_output = True)
+	elapsed = (time.perf_counter() - start) * 1000
+	status = done.stdout.split(b'\r\n', 1)[0].decode('latin-1')
+	return status, done.stderr.decode('utf8', 'replace'), elapsed
+
+def parse_importtime(stderr, skip):
+	"""
+	Returns the modules imported at the top level and their cumulative import time in
+	milliseconds, from python3 -X importtime output, leaving out the ones in skip.
+	"""
+	imports = dict()
+	for line in stderr.splitlines():
+		if not line.startswith('import time:') or line.endswith('package'):
+			continue
+		fields = line[len('import time:'):].split('|')
+		name = fields[2][1:]
+		# nested imports are indented under the module that imported them
+		if not name.startswith(' ') and name not in skip:
+			imports[name] = int(fields[1]) / 1000
+	return imports
+
+def measure(code, name, args, runs, skip):
+	"""
+	Requests one route runs times, returns the median wall time, the import times and whether the driver was loaded.
+	"""
+	times = []
+	for i in range(runs):
+		status, stderr, elapsed = run_child(code, *args, False)
+		if not status.endswith('200 OK'):
+			raise RuntimeError('{} answered {}\n{}'.format(name, status, stderr))
+		times.append(elapsed)
+	status, stderr, elapsed = run_child(code, *args, True)
+	return statistics.median(times), parse_importtime(stderr, skip), 'mysql.connector loaded: True' in stderr
+
+if __name__ == '__main__':
+	def option(flag, default):
+		return type(default)(sys.argv[sys.argv.index(flag) + 1]) if flag in sys.argv else default
+	count = option('-posts', 200)
+	runs = option('-runs', 10)
+	top = option('-top', 3)
+	random.seed(1)
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		suite.configure(tmp_dir, True, True)
+		urls, words = suite.seed(tmp_dir, count, 5)
+		routes = suite.make_routes(urls, words, 10)
+		code = child_code()
+		# blog.py and the modules next to it are imported from cached bytecode, like after the first request
+		compileall.compile_dir(suite.repo_dir, maxlevels = 0, quiet = 1)
+		# what a bare interpreter takes, and imports before running anything
+		bare = statistics.median(run_child('pass', 'GET', '', b'', False)[2] for i in range(runs))
+		skip = set(parse_importtime(run_child('pass', 'GET', '', b'', True)[1], set()))
+		print('bare interpreter: {:.1f} ms'.format(bare))
+		print('{:<14} {:>10} {:>10} {:>6}  {}'.format('route', '+ms', 'import ms', 'mysql', 'slowest imports'))
+		loaded_driver = []
+		for name, next_request in routes.items():
+			args = next_request()
+			if len(args) == 2:
+				args += (b'',)
+			wall, imports, driver = measure(code, name, args, runs, skip)
+			slowest = sorted(imports.items(), key = lambda item: -item[1])[:top]
+			print('{:<14} {:>10.1f} {:>10.1f} {:>6}  {}'.format(
+				name, wall - bare, sum(imports.values()), 'yes' if driver else 'no',
+				', '.join('{} {:.1f}'.format(module, ms) for module, ms in slowest)
+			))
+			if driver:
+				loaded_driver.append(name)
+	with open(os.path.join(suite.repo_dir, 'blog.py')) as fh:
+		source = fh.read()
+	start = time.perf_counter()
+	compile(source, 'blog.py', 'exec')
+	print('compiling blog.py: {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+	if loaded_driver:
+		print('loaded mysql.connector: {}'.format(', '.join(loaded_driver)), file = sys.stderr)
+		sys.exit(1)
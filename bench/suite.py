@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Load tests every route blog.py serves and times the pieces pages are made of.
+
+Posts are made up, converted with post.py's convert_block() and stored in
+SQLite, and blog.SQLcon is swapped for a stand-in that runs blog.py's own
+queries on it, so no database server is needed. Requests go through
+blog.application like they would from a WSGI server, from several threads at
+once, and for each route the throughput, median and 99th percentile latency
+and the peak memory use of the process so far are printed. Then
+HTMLtemplate, convert_inline(), convert_block() and the post page query are
+timed on their own.
+
+  ./bench/suite.py [-posts 1000] [-paragraphs 20] [-requests 2000] [-concurrency 8]
+                   [-nocache] [-snapshot] [-routes home,post,...] [-load | -micro]
+                   [-save results.json] [-compare results.json]
+
+-nocache turns blog.py's page cache off, so every request renders its page.
+-snapshot serves posts and the archive from a snapshot file instead of SQLite.
+-save writes the results to a file, and -compare prints how much faster or
+slower each result is than the ones in a saved file.
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import timeit
+import sqlite3
+import datetime
+import resource
+import shutil
+import tempfile
+import threading
+import statistics
+import concurrent.futures
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import blog
+import post
+import searchindex
+import snapshot
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# blog_posts as in init.sql, in SQLite's dialect
+schema = """
+CREATE TABLE blog_posts (
+	post_id integer PRIMARY KEY AUTOINCREMENT,
+	title text NOT NULL,
+	url_title text NOT NULL,
+	post_date date NOT NULL,
+	description text NOT NULL,
+	text text NOT NULL,
+	updated_at text NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX post_order ON blog_posts (post_date, post_id);
+CREATE INDEX url_title ON blog_posts (url_title);
+"""
+
+sqlite3.register_adapter(datetime.date, lambda date: date.isoformat())
+sqlite3.register_converter('date', lambda value: datetime.date.fromisoformat(value.decode()))
+
+def to_sqlite(query):
+	"""
+	Rewrites one of blog.SQLcon's queries for SQLite.
+	"""
+	query = re.sub(r'Match\(text\) Against\(%s WITH QUERY EXPANSION\)', '(instr(lower(text), lower(%s)) > 0)', query)
+	query = query.replace('%s', '?')
+	return re.sub(r'UNIX_TIMESTAMP\(([\w.]+)\)', r"CAST(strftime('%s', \1) AS INTEGER)", query)
+
+class SQLiteCon:
+	"""
+	Stands in for blog.SQLcon, running the same queries on a SQLite file.
+	Every thread gets its own connection, like it would get one from the pool.
+	"""
+	path = None
+	local = threading.local()
+	queries = {name : to_sqlite(query) for name, query in blog.SQLcon.queries.items()}
+
+	def __init__(self, config):
+		self.con = getattr(self.local, 'con', None)
+		if self.con is None:
+			self.con = sqlite3.connect(self.path, detect_types = sqlite3.PARSE_DECLTYPES, check_same_thread = False)
+			self.local.con = self.con
+
+	def _run(self, query, parameters, commit):
+		cur = self.con.execute(self.queries[query], parameters)
+		if commit:
+			self.con.commit()
+			return (cur, [])
+		return (cur, cur.fetchall())
+
+	def execute(self, query, *parameters, commit = False):
+		cur, rows = self._run(query, parameters, commit)
+		names = [column[0] for column in cur.description or ()]
+		if len(rows) == 0:
+			return None
+		elif len(rows) == 1:
+			return dict(zip(names, rows[0]))
+		return tuple(dict(zip(names, row)) for row in rows)
+
+	def fetch(self, query, record, *parameters):
+		return [record._make(row) for row in self._run(query, parameters, False)[1]]
+
+def make_mml(number, paragraphs, words):
+	"""
+	Makes up a post in post.py's markup language, using every kind of element.
+	"""
+	def sentence(length):
+		return ' '.join(random.choice(words) for i in range(length))
+	lines = ['{h}', 'Part {} of {}'.format(number, sentence(3)), '{h}']
+	for i in range(paragraphs):
+		lines += [
+			'{p}',
+			'{} {{b}}{}{{b}} {} {{i}}{}{{i}}.'.format(sentence(30), sentence(2), sentence(20), sentence(3)),
+			'See {{l|/?p=post-{}}}{}{{l}} and {{ic}}{}{{ic}}.'.format(random.randrange(max(number, 1)), sentence(2), sentence(1)),
+			'{p}'
+		]
+		if i % 5 == 4:
+			lines += ['{c}', 'for word in {}:'.format(sentence(1)), '    print(word)', '{c}']
+			lines += ['{l}', sentence(4), sentence(4), sentence(4), '{l}']
+	return '\n'.join(lines) + '\n'
+
+def seed(tmp_dir, count, paragraphs):
+	"""
+	Fills a new SQLite database with count posts, and writes the search index, feed and snapshot blog.py reads.
+	Returns the url titles and the words the posts were made of.
+	"""
+	with open(os.path.join(repo_dir, 'wordlist')) as fh:
+		words = [word.strip().lower() for word in fh if word.strip().isalpha()]
+	SQLiteCon.path = os.path.join(tmp_dir, 'blog.db')
+	con = sqlite3.connect(SQLiteCon.path)
+	con.executescript(schema)
+	first_day = datetime.date(2000, 1, 1)
+	rows = []
+	for number in range(count):
+		text = post.convert_block(io.StringIO(make_mml(number, paragraphs, words)))
+		rows.append((
+			'Post {}'.format(number), 'post-{}'.format(number), first_day + datetime.timedelta(days = number // 3),
+			' '.join(random.choice(words) for i in range(12)), text
+		))
+	con.executemany("INSERT INTO blog_posts(title, url_title, post_date, description, text) VALUES(?,?,?,?,?);", rows)
+	con.commit()
+	index_rows = con.execute("SELECT post_id, url_title, title, description, text FROM blog_posts;").fetchall()
+	searchindex.build_index(blog.search_config['index_file'], index_rows)
+	feed_rows = con.execute(
+		"SELECT url_title, title, description, text, CAST(strftime('%s', updated_at) AS INTEGER) FROM blog_posts ORDER BY post_date DESC, post_id DESC LIMIT 20;"
+	).fetchall()
+	with open(blog.feed_config['feed_file'], 'w') as fh:
+		fh.write(post.make_feed(feed_rows, 'http://localhost'))
+	if blog.snapshot_config['snapshot_file']:
+		snapshot_rows = con.execute(
+			"SELECT post_id, url_title, title, post_date, CAST(strftime('%s', updated_at) AS INTEGER), description, text FROM blog_posts;"
+		).fetchall()
+		snapshot.write_snapshot(blog.snapshot_config['snapshot_file'], [
+			row[:3] + (datetime.date.fromisoformat(row[3]),) + row[4:] for row in snapshot_rows
+		])
+	con.close()
+	return [row[1] for row in rows], words
+
+def configure(tmp_dir, cache, use_snapshot):
+	"""
+	Points blog.py at the templates in the repository and files in tmp_dir, and swaps in SQLiteCon.
+	"""
+	for name, file_name in (
+		('post_template', 'home_temp.html'), ('archive_template', 'archive_temp.html'),
+		('email_challenge', 'email_temp1.html'), ('email_success', 'email_temp2.html')
+	):
+		blog.template_config[name] = os.path.join(repo_dir, 'templates', file_name)
+	# copied, so its index is written in tmp_dir
+	blog.template_config['wordlist'] = os.path.join(tmp_dir, 'wordlist')
+	shutil.copy(os.path.join(repo_dir, 'wordlist'), blog.template_config['wordlist'])
+	blog.challenge_config['secret_file'] = os.path.join(tmp_dir, 'secret')
+	blog.challenge_config['nonce_file'] = os.path.join(tmp_dir, 'nonces')
+	blog.search_config['index_file'] = os.path.join(tmp_dir, 'search')
+	blog.feed_config['feed_file'] = os.path.join(tmp_dir, 'feed')
+	blog.snapshot_config['snapshot_file'] = os.path.join(tmp_dir, 'snapshot') if use_snapshot else ''
+	# every request is checked against the limits, but they're too high for the benchmark to reach
+	blog.limit_config.update(limit_file = os.path.join(tmp_dir, 'limits'), burst = 10 ** 9, rate = 10 ** 9, concurrency = 0)
+	for lru in (blog.page_cache, blog.search_cache):
+		lru.version_path = os.path.join(tmp_dir, 'version')
+	if not cache:
+		blog.page_cache.max_bytes = 0
+	blog.SQLcon = SQLiteCon
+
+def request(method, query_string = '', body = b''):
+	"""
+	Sends one request through blog.application and returns its status and body.
+	"""
+	environ = {
+		'REQUEST_METHOD' : method,
+		'QUERY_STRING' : query_string,
+		'CONTENT_TYPE' : 'application/x-www-form-urlencoded',
+		'CONTENT_LENGTH' : str(len(body)),
+		'wsgi.input' : io.BytesIO(body)
+	}
+	status = []
+	chunks = blog.application(environ, lambda s, headers, exc_info = None: status.append(s))
+	return status[0], b''.join(chunks)
+
+def contact_answers(count):
+	"""
+	Gets count contact pages and returns the right answers to them, so the challenge route can be timed succeeding.
+	"""
+	answers = []
+	for i in range(count):
+		page = request('GET', 'p=contact')[1].decode()
+		word = re.search(r'<hr />\s*<p>\s*(\S+)\s*</p>', page).group(1)
+		token = re.search(r'name="token" value="([^"]+)"', page).group(1)
+		answers.append('challenge={}&token={}'.format(word, token).encode())
+	return answers
+
+def make_routes(urls, words, count):
+	"""
+	Returns a dictionary from route names to functions that return the next request's arguments.
+	"""
+	# a cursor at the oldest post would have nothing before it
+	cursors = []
+	for url in urls[1::blog.archive_config['page_size']]:
+		number = int(url.split('-')[1])
+		cursors.append('{}.{}'.format(datetime.date(2000, 1, 1) + datetime.timedelta(days = number // 3), number + 1))
+	answers = []
+	return {
+		'home' : lambda: ('GET', ''),
+		'post' : lambda: ('GET', 'p=' + random.choice(urls)),
+		'archive' : lambda: ('GET', 'p=archive'),
+		'archive_deep' : lambda: ('GET', 'p=archive&before=' + random.choice(cursors)),
+		'search' : lambda: ('POST', '', 'search={}+{}'.format(random.choice(words), random.choice(words)).encode()),
+		'contact' : lambda: ('GET', 'p=contact'),
+		'challenge' : lambda: ('POST', '', answers.pop() if answers else answers.extend(contact_answers(count)) or answers.pop()),
+		'feed' : lambda: ('GET', 'p=feed'),
+	}
+
+def load_test(name, next_request, count, concurrency):
+	"""
+	Sends count requests for one route from concurrency threads.
+	Returns requests per second and the median and 99th percentile latency in milliseconds.
+	"""
+	requests = [next_request() for i in range(count)]
+	def timed(args):
+		start = time.perf_counter()
+		status, body = request(*args)
+		if not status.startswith('200'):
+			raise RuntimeError('{} answered {}'.format(name, status))
+		return (time.perf_counter() - start) * 1000
+	start = time.perf_counter()
+	with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+		times = sorted(pool.map(timed, requests))
+	elapsed = time.perf_counter() - start
+	return {
+		'rps' : count / elapsed,
+		'p50' : statistics.median(times),
+		'p99' : times[min(int(len(times) * 0.99), len(times) - 1)]
+	}
+
+def micro_benchmarks(urls, paragraphs, words):
+	"""
+	Times the pieces a page is made of, returning microseconds per call.
+	"""
+	sql = SQLiteCon(None)
+	url = urls[len(urls) // 2]
+	page = sql.fetch('get_post_page', blog.PostPage, url)[0]
+	mml = make_mml(1, paragraphs, words)
+	line = 'A {b}bold{b} and {i}italic{i} {l|/?p=post-1}link{l}, {im|/a.png}image{im} and {ic}code{ic}.'
+	def render():
+		blog.render_post(blog.Response(), page)
+	benchmarks = {
+		'render_post' : render,
+		'convert_inline' : lambda: post.convert_inline(line),
+		'convert_block' : lambda: post.convert_block(io.StringIO(mml)),
+		'get_post_page' : lambda: sql.fetch('get_post_page', blog.PostPage, url),
+	}
+	results = dict()
+	for name, fn in benchmarks.items():
+		number, total = timeit.Timer(fn).autorange()
+		best = min(timeit.repeat(fn, number = number, repeat = 5))
+		results[name] = best / number * 1e6
+	return results
+
+def peak_rss_mb():
+	# ru_maxrss is in kilobytes on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def compare(name, value, old, higher_is_better):
+	if old is None:
+		return ''
+	change = (value - old) / old * 100 if old else 0
+	better = change > 0 if higher_is_better else change < 0
+	return '  {:+.1f}% {}'.format(change, 'better' if better else 'worse')
+
+if __name__ == '__main__':
+	def option(flag, default):
+		return type(default)(sys.argv[sys.argv.index(flag) + 1]) if flag in sys.argv else default
+	count = option('-posts', 1000)
+	paragraphs = option('-paragraphs', 20)
+	requests = option('-requests', 2000)
+	concurrency = option('-concurrency', 8)
+	old = dict()
+	if '-compare' in sys.argv:
+		with open(option('-compare', '')) as fh:
+			old = json.load(fh)
+	random.seed(1)
+	results = {'routes' : dict(), 'micro' : dict()}
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		configure(tmp_dir, '-nocache' not in sys.argv, '-snapshot' in sys.argv)
+		start = time.perf_counter()
+		urls, words = seed(tmp_dir, count, paragraphs)
+		print('seeded {} posts in {:.1f}s, peak RSS {:.1f} MB'.format(count, time.perf_counter() - start, peak_rss_mb()))
+		if '-micro' not in sys.argv:
+			routes = make_routes(urls, words, requests)
+			names = option('-routes', ','.join(routes)).split(',')
+			print('{:<14} {:>10} {:>10} {:>10} {:>14}'.format('route', 'req/s', 'p50 ms', 'p99 ms', 'peak RSS MB'))
+			for name in names:
+				result = load_test(name, routes[name], requests, concurrency)
+				result['rss'] = peak_rss_mb()
+				results['routes'][name] = result
+				print('{:<14} {:>10.0f} {:>10.3f} {:>10.3f} {:>14.1f}{}'.format(
+					name, result['rps'], result['p50'], result['p99'], result['rss'],
+					compare(name, result['rps'], old.get('routes', {}).get(name, {}).get('rps'), True)
+				))
+		if '-load' not in sys.argv:
+			print('{:<20} {:>12}'.format('function', 'us per call'))
+			for name, us in micro_benchmarks(urls, paragraphs, words).items():
+				results['micro'][name] = us
+				print('{:<20} {:>12.2f}{}'.format(name, us, compare(name, us, old.get('micro', {}).get(name), False)))
+	if '-save' in sys.argv:
+		with open(option('-save', ''), 'w') as fh:
+			json.dump(results, fh, indent = 1, sort_keys = True)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Compares rendering the templates in templates/ with HTMLtemplate against the
+line scanning version it replaced, which re-read the template on every page
+and printed one line at a time.
+
+  ./bench/template.py [-n 2000]
+"""
+import io
+import os
+import sys
+import timeit
+import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import blog
+
+template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+
+class LineScanningHTMLtemplate(blog.HTMLtemplate):
+	"""
+	HTMLtemplate as it was before templates were compiled.
+	"""
+	def __enter__(self):
+		self.fh = open(self.template_path, 'r')
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		printed = False
+		for line in self.fh:
+			for mark in self.inserts.keys():
+				if line.find(mark) != -1:
+					self._print_list(self.inserts[mark])
+					printed = True
+					break
+			if not printed:
+				print(line, end = '', file = self.out)
+			printed = False
+		self.fh.close()
+
+	def _append_at_marker(self, text):
+		current_list = self.inserts[self.current_marker]
+		append_method = lambda x: current_list.append(x)
+		if self.current_list_index != []:
+			append_method = lambda x: current_list.insert(-1, x)
+			for i in self.current_list_index:
+				current_list = current_list[i]
+		if isinstance(text, list):
+			self.current_list_index.append(len(current_list) if self.current_list_index == [] else len(current_list) - 1)
+		append_method(text)
+
+	def _print_list(self, l):
+		for i in l:
+			if isinstance(i, list):
+				self._print_list(i)
+			else:
+				print(i, file = self.out)
+
+def render_post(template_class, out):
+	with template_class(os.path.join(template_dir, 'home_temp.html'), out) as temp:
+		temp.set_insert('<!--post-->')
+		temp.h('A post about benchmarks')
+		temp.h(datetime.date(2017, 5, 1).strftime('%b. %d, %Y'), level = 3)
+		temp.append_raw('<p>\nSome text about benchmarks.\n</p>\n' * 200)
+		temp.hr()
+		temp.set_insert('<!--links-->')
+		temp.div('prev')
+		temp.a('/?p=newer-post', 'Previous Post')
+		temp.jump()
+		temp.div('next')
+		temp.a('/?p=older-post', 'Next Post')
+		temp.jump()
+
+def render_archive(template_class, out):
+	with template_class(os.path.join(template_dir, 'archive_temp.html'), out) as temp:
+		temp.set_insert('<!--message-->')
+		temp.p("Here's all my posts from newest to oldest:")
+		temp.set_insert('<!--results-->')
+		for i in range(20):
+			temp.li()
+			temp.a('/?p=post-{}'.format(i), 'Post {}'.format(i))
+			temp.p('The description of post {}'.format(i))
+			temp.jump()
+
+if __name__ == '__main__':
+	number = 2000
+	if '-n' in sys.argv:
+		number = int(sys.argv[sys.argv.index('-n') + 1])
+	print('{:>8} {:>16} {:>16} {:>8}'.format('page', 'line scan us', 'compiled us', 'speedup'))
+	for name, render in (('post', render_post), ('archive', render_archive)):
+		old_out, new_out = io.StringIO(), io.StringIO()
+		render(LineScanningHTMLtemplate, old_out)
+		render(blog.HTMLtemplate, new_out)
+		if old_out.getvalue() != new_out.getvalue():
+			print('{} pages are different!'.format(name), file = sys.stderr)
+			sys.exit(1)
+		old = min(timeit.repeat(lambda: render(LineScanningHTMLtemplate, io.StringIO()), number = number, repeat = 5)) / number * 1e6
+		new = min(timeit.repeat(lambda: render(blog.HTMLtemplate, io.StringIO()), number = number, repeat = 5)) / number * 1e6
+		print('{:>8} {:>16.1f} {:>16.1f} {:>7.1f}x'.format(name, old, new, old / new))
@@ -16,15 +16,21 @@
 #with this program; if not, write to the Free Software Foundation, Inc.,
 #51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 import os
-import re
 import sys
-import cgi
-import cgitb
-import random
-import datetime
+import io
+import threading
+import collections
+import array
+import itertools
+import time
+# everything else is imported by the functions that need it, so a CGI request only loads what
+# its page uses. mysql.connector is imported by get_pool(), and isn't loaded at all for pages
+# that come from the cache, the snapshot or the search index.
 # be sure to install mysql-connector!
 # pip3 install mysql-connector
-import mysql.connector
+# searchindex.py, snapshot.py, sharedcache.py and ratelimit.py need to be in the same directory as blog.py
+# cached pages are also compressed with brotli if it's installed, it's imported by CachedPage.compress()
+# pip3 install brotli
 
 sql_config = {
 	'unix_socket': '/var/run/mysqld/mysqld.sock',
@@ -35,6 +41,92 @@ sql_config = {
 	'raise_on_warnings': True
 }
 
+# blog.py keeps a pool of connections open instead of connecting on every request.
+# size is the most connections one blog.py process will open, so keep
+# size times the number of processes below MariaDB's max_connections.
+pool_config = {
+	'size' : 8,
+	# seconds to wait for a free connection before serving a 500 error
+	'timeout' : 5,
+	# connections that sat unused for this many seconds get checked before they're used
+	'check_after' : 30
+}
+
+# rendered pages are kept in memory until post.py changes a post.
+# post.py rewrites version_file after every change, so both scripts need to agree on its path.
+cache_config = {
+	'version_file' : '/var/www/lightblog.version',
+	# most bytes of rendered pages to keep, least recently used pages are dropped first (oldest ones with workers)
+	'max_bytes' : 64 * 1024 * 1024,
+	# most bytes of search results to keep
+	'search_max_bytes' : 4 * 1024 * 1024,
+	# when a page isn't cached, only one request renders it and the others for the same page wait,
+	# for at most flight_timeout seconds before rendering it themselves
+	'flight_timeout' : 10,
+	# instead of waiting, send the page from before post.py changed something while it's rendered again.
+	# Old pages are kept until their new copy is ready or new pages need the room, so together they stay within max_bytes.
+	'serve_stale' : False,
+	# with workers, the page cache is a file in this directory that they all share,
+	# and max_bytes is set aside for it up front. Leave it on a tmpfs like /dev/shm.
+	'shared_dir' : '/dev/shm'
+}
+
+# cached pages are sent with an ETag and Last-Modified, so browsers can ask whether their copy is still good.
+# Browsers may use their copy for max_age seconds before asking again.
+http_config = {
+	'max_age' : 0,
+	# how hard cached pages are compressed. Pages are compressed while a request waits for them,
+	# so these trade a little size for a lot of time, post.py's static copy uses the highest levels.
+	'gzip_level' : 6,
+	'brotli_quality' : 5
+}
+
+# posts from the snapshot longer than threshold characters are sent to the client straight out of
+# its memory map in chunk_size pieces, instead of being copied into the page first. They aren't
+# cached, and only get a 304 by their Last-Modified. Posts from the database are already in memory,
+# so they're cached like every other page.
+stream_config = {
+	'threshold' : 256 * 1024,
+	'chunk_size' : 64 * 1024
+}
+
+# the archive is shown page_size posts at a time, newest first
+archive_config = {
+	'page_size' : 20
+}
+
+# post.py keeps a search index in this file, so searches don't need the database.
+# If the file doesn't exist, MariaDB's full text search is used instead.
+search_config = {
+	'index_file' : '/var/www/lightblog.search'
+}
+
+# post.py writes a copy of every post to snapshot_file whenever posts change.
+# Posts and the archive are read from it instead of the database, which is only used if the file doesn't exist.
+# It must be the same path as snapshot_file in post.py's publish_config, '' turns it off.
+snapshot_config = {
+	'snapshot_file' : '/var/www/lightblog.snapshot'
+}
+
+# post.py writes an Atom feed and a sitemap to these files, blog.py serves them at ?p=feed and ?p=sitemap.
+# They must be the same paths as in post.py's feed_config.
+feed_config = {
+	'feed_file' : '/var/www/lightblog.atom',
+	'sitemap_file' : '/var/www/lightblog.sitemap'
+}
+
+# the contact page's challenge is a signed token in the form instead of a row in the database.
+# secret_file holds the signing key, blog.py creates it if it can, otherwise put 32 random bytes in it.
+challenge_config = {
+	'secret_file' : '/var/www/lightblog.secret',
+	# seconds a challenge can be answered for
+	'lifetime' : 180,
+	# answered challenges are remembered in this file, shared by every process, so they can't be answered again.
+	# It needs to be writable by the web server. If it can't be opened, each process remembers max_used on its own.
+	'nonce_file' : '/dev/shm/lightblog.nonces',
+	'max_used' : 10000
+}
+
 template_config = {
 	'post_template' : '/var/www/home_temp.html',
 	'archive_template': '/var/www/archive_temp.html',
@@ -43,52 +135,995 @@ template_config = {
 	'wordlist' : '/var/www/wordlist'
 }
 
-def handle_request():
+# blog.py can time every request: the route, time spent in each query and rendering templates,
+# bytes sent and whether the page came from the cache. Nothing is measured unless enabled is True.
+metrics_config = {
+	'enabled' : False,
+	# log a line of JSON for every request
+	'log_requests' : True,
+	# serve totals in Prometheus' text format at ?p=metrics. Only turn this on behind a proxy that keeps it private.
+	'endpoint' : False,
+	# also write the totals to this file, at most once every stats_interval seconds
+	'stats_file' : '',
+	'stats_interval' : 10,
+	# profile one in every profile_every requests with cProfile, 0 turns profiling off.
+	# Each profile is written to profile_dir, read them with python3 -m pstats.
+	'profile_every' : 0,
+	'profile_dir' : '/tmp/lightblog-profiles'
+}
+
+# used when blog.py is started with --serve instead of being run as a CGI script
+server_config = {
+	'host' : '127.0.0.1',
+	'port' : 8080,
+	# processes to fork, all answering on the same port, 0 serves from this process only
+	'workers' : 0,
+	# a worker is replaced by a new one after this many requests, 0 keeps it running
+	'max_requests' : 10000
+}
+
+# searches and the contact page cost the most to serve, so each client can only ask for them so often,
+# and only so many are served at once. Requests over either limit get a short 429 Too Many Requests.
+# The limits are kept in limit_file, which every CGI process and worker shares. An empty limit_file turns them off.
+limit_config = {
+	'limit_file' : '/dev/shm/lightblog.limits',
+	# requests a client can make in a row, and how many more it gets every second
+	'burst' : 10,
+	'rate' : 0.5,
+	# most of these requests served at once by all processes together, 0 doesn't limit them
+	'concurrency' : 8,
+	# behind a reverse proxy, every request comes from the proxy. If blog.py can only be reached
+	# through one that adds the client's address to X-Forwarded-For, set this to use that address.
+	'forwarded_for' : False
+}
+
+def handle_request(environ):
 	"""
 	This function is where execution of this code begins.
-	It figures out what the page to serve based on the CGI request passed by the web server.
-	"""
-	form = cgi.FieldStorage()
-	request_type = os.getenv('REQUEST_METHOD')
-	if request_type == 'GET':
-		query = form.getvalue('p')
-		if query is None:
-			serve_post()
-		elif query == 'archive':
-			serve_default_archive()
-		elif query == 'contact':
-			serve_email_challenge()
-		elif re.match('^[a-z0-9\-]+$', query):
-			serve_post(query)
+	It figures out what the page to serve based on the request environment passed by the web server.
+	The same environment is used for CGI and WSGI, so this works for both.
+	Returns a Response holding the page.
+	"""
+	res = Response()
+	page_cache.check_version()
+	search_cache.check_version()
+	generation = page_cache.generation
+	try:
+		form = read_form(environ)
+		request_type = environ.get('REQUEST_METHOD')
+		if request_type == 'GET':
+			query = form.get('p')
+			note_request(route = 'home' if query is None else query if query in named_routes else 'post')
+			# the contact page has a new word every time, everything else can come from the cache
+			cacheable = query not in ('contact', 'metrics')
+			key = archive_key(form.get('before'), form.get('after')) if query == 'archive' else query
+			# a CGI process ends after this page, so it isn't compressed or kept for later
+			run_once = environ.get('wsgi.run_once', False)
+			flight = None
+			if cacheable:
+				if run_once:
+					page = page_cache.get(key)
+					found = 'miss' if page is None else 'hit'
+				else:
+					page, flight, found = find_cached_page(key)
+				note_request(cache = found)
+				if page is not None:
+					return page.respond(environ)
+			page = None
+			# a request rendering a page for others renders all of it, and decides on a 304 once it's published
+			check_environ = None if flight is not None else environ
+			try:
+				if query is None:
+					serve_post(res, environ = check_environ)
+				elif query == 'archive':
+					serve_default_archive(res, check_environ, form.get('before'), form.get('after'))
+				elif query == 'contact':
+					serve_limited(res, environ, serve_email_challenge)
+				elif query == 'feed':
+					serve_file(res, feed_config['feed_file'], 'application/atom+xml')
+				elif query == 'sitemap':
+					serve_file(res, feed_config['sitemap_file'], 'application/xml')
+				elif query == 'metrics' and metrics_config['endpoint']:
+					serve_metrics(res)
+				elif is_url_title(query):
+					serve_post(res, query, check_environ)
+				else:
+					serve_error(res, '404 Not Found', 'The page you\'re requesting doesn\'t exist.')
+				if res.streaming:
+					streamed_not_modified(res, environ)
+				elif cacheable and res.status == '200 OK':
+					page = CachedPage(res)
+					if not run_once:
+						keep_page(key, page, generation)
+					return page.respond(environ)
+			finally:
+				# the requests waiting for this page get it, or render their own if there's none
+				if flight is not None:
+					page_flights.finish(key, flight, page)
+		elif request_type == 'POST':
+			if 'search' in form:
+				note_request(route = 'search')
+				serve_limited(res, environ, serve_search_archive, form['search'])
+			elif 'challenge' in form:
+				note_request(route = 'challenge')
+				serve_limited(res, environ, check_email_challenge, form['challenge'], form.get('token'))
+			else:
+				serve_error(res, '400 Bad Request', 'Bad POST request.')
 		else:
-			serve_error('404 Not Found', 'The page you\'re requesting doesn\'t exist.')
-	elif request_type == 'POST':
-		if 'search' in form:
-			serve_search_archive(form.getvalue('search'))
-		elif 'challenge' in form:
-			check_email_challenge(form.getvalue('challenge'))
+			serve_error(res, '400 Bad Request', str(request_type) + " is not a supported http method.")
+	except SQLError:
+		# start over so a half written page isn't sent
+		res = Response()
+		serve_error(res, '500 Internal Error', 'Something went wrong. Please Try again later')
+	return res
+
+def read_form(environ):
+	"""
+	Returns the fields of a request as a dictionary of strings: the query string of a GET,
+	or the url encoded body of a POST. Fields without a value are left out, and only the
+	first value of a field given more than once is kept.
+	"""
+	if environ.get('REQUEST_METHOD') != 'POST':
+		return parse_form(environ.get('QUERY_STRING', ''))
+	if not environ.get('CONTENT_TYPE', '').startswith('application/x-www-form-urlencoded'):
+		return dict()
+	try:
+		length = int(environ.get('CONTENT_LENGTH') or 0)
+	except ValueError:
+		return dict()
+	# the forms are a word or a search, anything bigger isn't from them
+	if length <= 0 or length > max_form_bytes:
+		return dict()
+	return parse_form(environ['wsgi.input'].read(length).decode('latin-1'))
+
+max_form_bytes = 64 * 1024
+hex_digits = frozenset('0123456789abcdefABCDEF')
+url_title_chars = 'abcdefghijklmnopqrstuvwxyz0123456789-'
+
+def parse_form(text):
+	"""
+	Parses a query string or url encoded form into a dictionary, see read_form().
+	"""
+	form = dict()
+	for field in text.split('&'):
+		name, _, value = field.partition('=')
+		if value and name:
+			form.setdefault(unquote(name), unquote(value))
+	return form
+
+def unquote(text):
+	"""
+	Decodes a url encoded string: '+' is a space, and %XX is a byte of utf-8.
+	"""
+	text = text.replace('+', ' ')
+	if '%' not in text:
+		return text
+	pieces = text.split('%')
+	out = bytearray(pieces[0].encode('latin-1'))
+	for piece in pieces[1:]:
+		if len(piece) >= 2 and piece[0] in hex_digits and piece[1] in hex_digits:
+			out.append(int(piece[:2], 16))
+			out += piece[2:].encode('latin-1')
 		else:
-			serve_error('400 Bad Request', 'Bad POST request.')
+			out += b'%' + piece.encode('latin-1')
+	return out.decode('utf8', 'replace')
+
+def is_url_title(text):
+	return bool(text) and not text.strip(url_title_chars)
+
+def application(environ, start_response):
+	"""
+	WSGI entry point.
+	Point a WSGI server (mod_wsgi, uWSGI, gunicorn...) at blog:application to serve the blog
+	from one long running process instead of starting a new one for every request.
+	"""
+	if metrics_config['enabled']:
+		metrics = RequestMetrics()
+		res = profile_request(environ)
 	else:
-		serve_error('400 Bad Request', request_type + " is not a supported http method.")
-		sys.exit(1)
+		metrics = None
+		res = handle_request(environ)
+	if res.streaming:
+		start_response(res.status, res.headers)
+		if metrics is not None:
+			return metrics.count_body(res.status, res.iter_body())
+		return res.iter_body()
+	body = res.body()
+	if metrics is not None:
+		metrics.finish(res.status, len(body))
+	if res.status.startswith('304'):
+		start_response(res.status, res.headers)
+		return []
+	start_response(res.status, res.headers + [('Content-Length', str(len(body)))])
+	return [body]
+
+def make_server(host, port):
+	"""
+	Returns an HTTP server for application() listening on host and port.
+	"""
+	import socketserver
+	from wsgiref import simple_server
+	class ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+		"""
+		wsgiref's server handles one request at a time, this one uses a thread per request.
+		"""
+		daemon_threads = True
+		# wsgiref only lets 5 connections wait to be accepted, more than that wait a second and try again
+		request_queue_size = 128
+		# requests taken so far, so a worker knows when to retire
+		handled = 0
+
+		def process_request(self, request, client_address):
+			self.handled += 1
+			super().process_request(request, client_address)
+	return simple_server.make_server(host, port, application, server_class = ThreadingWSGIServer)
+
+def serve(host = server_config['host'], port = server_config['port'], workers = server_config['workers']):
+	"""
+	Serves the blog over HTTP until interrupted.
+	Meant to sit behind a reverse proxy like nginx or Apache's mod_proxy.
+	"""
+	if workers > 0:
+		serve_prefork(host, port, workers)
+		return
+	with make_server(host, port) as httpd:
+		log_print("Serving on {}:{}".format(host, port))
+		try:
+			httpd.serve_forever()
+		except KeyboardInterrupt:
+			pass
+
+# which of the forked workers this process is, None in the process that forks them
+worker_number = None
+
+def serve_prefork(host, port, workers):
+	"""
+	Opens the listening socket and forks workers to accept connections on it, so requests
+	are served by as many cores as there are workers. A worker that exits, or retires after
+	max_requests, is replaced by a new one. Stops the workers on SIGTERM or SIGINT.
+	The workers share one page cache, made here before they're forked.
+	"""
+	global page_cache
+	import signal
+	import sharedcache
+	page_cache = sharedcache.SharedCache(
+		cache_config['max_bytes'],
+		version_path = cache_config['version_file'],
+		directory = cache_config['shared_dir'] if os.path.isdir(cache_config['shared_dir']) else None
+	)
+	httpd = make_server(host, port)
+	children = dict()
+	stopping = []
+	parent = os.getpid()
+	def stop(signum, frame):
+		# a worker that hasn't set up its own handlers yet has nothing to finish
+		if os.getpid() != parent:
+			os._exit(0)
+		stopping.append(signum)
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+	def start_worker(number):
+		pid = os.fork()
+		if pid == 0:
+			status = 1
+			try:
+				run_worker(httpd, number)
+				status = 0
+			finally:
+				os._exit(status)
+		children[pid] = (number, time.monotonic())
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+	log_print("Serving on {}:{} with {} workers".format(host, port, workers))
+	for number in range(workers):
+		start_worker(number)
+	while children:
+		try:
+			pid, status = os.wait()
+		except ChildProcessError:
+			break
+		number, started = children.pop(pid)
+		if stopping:
+			continue
+		if os.waitstatus_to_exitcode(status) != 0:
+			log_print("Worker {} exited with status {}".format(number, os.waitstatus_to_exitcode(status)))
+			# don't fork over and over if workers die as soon as they start
+			if time.monotonic() - started < 1:
+				time.sleep(1)
+		start_worker(number)
+	httpd.server_close()
+
+def run_worker(httpd, number):
+	"""
+	Serves requests from httpd in a forked worker until it's told to stop or has taken max_requests.
+	Requests already being answered are finished before it returns.
+	"""
+	global worker_number
+	import signal
+	import random
+	worker_number = number
+	stopping = []
+	signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+	signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+	# workers started together don't all retire together
+	max_requests = server_config['max_requests']
+	if max_requests:
+		max_requests += random.randrange(max_requests // 10 + 1)
+	# every worker wakes up for a new connection, and the ones that don't get it wait at most
+	# a second for the next one, then check whether it's time to stop
+	httpd.socket.settimeout(1)
+	httpd.timeout = 1
+	httpd.daemon_threads = False
+	httpd.block_on_close = True
+	while not stopping and not (max_requests and httpd.handled >= max_requests):
+		httpd.handle_request()
+	# waits for the threads that are still answering requests
+	httpd.server_close()
 
 def log_print(*args, **kwargs):
 	"""
 	A wrapper around print() that prints to stderr.
 	On Apache, stderr gets logged.
+	The line is written all at once, so lines from different workers don't run together.
+	"""
+	line = io.StringIO()
+	print(*args, file = line, **kwargs)
+	sys.stderr.write(line.getvalue())
+
+class Response:
+	"""
+	Holds the status, headers and body of the page being served.
+	It has a write() method, so anything that prints can print into it with print(..., file = res).
+	Big pieces of text can be added with write_stream(), and are sent as they're encoded.
+	"""
+	def __init__(self):
+		self.status = '200 OK'
+		self.headers = []
+		self.chunks = []
+		self.encoded = None
+		self.streaming = False
+
+	def write(self, text):
+		self.chunks.append(text)
+
+	def write_stream(self, pieces):
+		"""
+		Adds an iterable of strings, or of utf-8 bytes-like objects, to the body.
+		It's only read when the body is sent, so the response is sent without a Content-Length.
+		"""
+		self.chunks.append(pieces)
+		self.streaming = True
+
+	def iter_body(self):
+		"""
+		Yields the body as utf-8 encoded bytes, one chunk at a time.
+		"""
+		for chunk in self.chunks:
+			if isinstance(chunk, str):
+				yield chunk.encode('utf8')
+			else:
+				for piece in chunk:
+					yield piece.encode('utf8') if isinstance(piece, str) else bytes(piece)
+
+	def body(self):
+		"""
+		Returns the body as utf-8 encoded bytes.
+		The body is only encoded once, so a finished Response can be cached and served again.
+		"""
+		if self.encoded is None:
+			self.encoded = b''.join(self.iter_body())
+			self.chunks = []
+			self.streaming = False
+		return self.encoded
+
+class LRUCache:
 	"""
-	print(*args, file = sys.stderr, **kwargs)
+	A thread safe least recently used cache that holds at most max_bytes worth of values.
+	sizeof is called on a value to find out how many bytes it takes up.
+	Everything in the cache is dropped when the file at version_path changes,
+	which is how post.py tells blog.py that posts were changed.
+	With keep_stale, the dropped values can still be had from get_stale() until they're
+	replaced, or pushed out to make room for new ones.
+	"""
+	def __init__(self, max_bytes, sizeof = len, version_path = None, keep_stale = False):
+		self.max_bytes = max_bytes
+		self.sizeof = sizeof
+		self.version_path = version_path
+		self.version = None
+		self.keep_stale = keep_stale
+		# bumped every time the cache is emptied
+		self.generation = 0
+		self.entries = collections.OrderedDict()
+		self.bytes = 0
+		# what was in the cache before it was last emptied
+		self.stale = collections.OrderedDict()
+		self.stale_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		"""
+		Returns the cached value for key, or None.
+		"""
+		with self.lock:
+			value = self.entries.get(key)
+			if value is None:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return value[0]
+
+	def get_stale(self, key):
+		"""
+		Returns the value that was cached for key before the cache was last emptied, or None.
+		"""
+		with self.lock:
+			value = self.stale.get(key)
+			return None if value is None else value[0]
+
+	def put(self, key, value, generation = None):
+		"""
+		Caches value under key, dropping the least recently used values if over budget.
+		Values bigger than the whole budget aren't cached.
+		If generation is given and the cache was emptied since it was read,
+		the value was made from old data and isn't cached.
+		"""
+		size = self.sizeof(value)
+		if size > self.max_bytes:
+			return
+		with self.lock:
+			if generation is not None and generation != self.generation:
+				return
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.bytes -= old[1]
+			old = self.stale.pop(key, None)
+			if old is not None:
+				self.stale_bytes -= old[1]
+			self.entries[key] = (value, size)
+			self.bytes += size
+			# stale values go first
+			while self.stale and self.bytes + self.stale_bytes > self.max_bytes:
+				self.stale_bytes -= self.stale.popitem(last = False)[1][1]
+			while self.bytes > self.max_bytes:
+				self.bytes -= self.entries.popitem(last = False)[1][1]
+
+	def clear(self):
+		with self.lock:
+			if self.keep_stale:
+				self.stale = self.entries
+				self.stale_bytes = self.bytes
+			self.entries = collections.OrderedDict()
+			self.bytes = 0
+			self.generation += 1
+
+	def check_version(self):
+		"""
+		Empties the cache if the version file changed since the last check.
+		This is a single stat() call, so it can be done on every request.
+		"""
+		if self.version_path is None:
+			return
+		try:
+			st = os.stat(self.version_path)
+			version = (st.st_ino, st.st_mtime_ns, st.st_size)
+		except OSError:
+			version = None
+		if version != self.version:
+			self.clear()
+			self.version = version
 
-def print_headers(headers = [], mime_type = 'text/html'):
+	def stats(self):
+		return {'hits' : self.hits, 'misses' : self.misses, 'entries' : len(self.entries), 'bytes' : self.bytes}
+
+class SingleFlight:
+	"""
+	Lets one request at a time render a page that isn't cached, while the other requests for
+	the same page wait for it instead of all going to the database at once.
+	Counts how many requests waited for each page, so the metrics show how much it saved.
 	"""
-	Prints HTTP headers to stdout.
-	Takes a list of HTTP headers as strings.
+	class Flight:
+		"""
+		A page being rendered.
+		"""
+		def __init__(self):
+			self.done = threading.Event()
+			self.page = None
+
+		def wait(self, timeout):
+			"""
+			Returns the page once it's rendered, or None if it can't be cached or took longer than timeout seconds.
+			"""
+			self.done.wait(timeout)
+			return self.page
+
+	def __init__(self, max_labels = 1000):
+		self.lock = threading.Lock()
+		self.flights = dict()
+		self.max_labels = max_labels
+		# requests that waited for another one by page, and how many of those got a stale page instead
+		self.waits = collections.Counter()
+		self.stale = collections.Counter()
+
+	def begin(self, key, label):
+		"""
+		Returns whether this request is the one to render key, and the Flight to wait on if it isn't.
+		The request rendering it has to call finish() when it's done, even if it failed.
+		label names the page in the counts.
+		"""
+		with self.lock:
+			flight = self.flights.get(key)
+			if flight is None:
+				flight = self.flights[key] = self.Flight()
+				return True, flight
+			self._count(self.waits, label)
+			return False, flight
+
+	def _count(self, counter, label):
+		# past max_labels pages, the rest are counted together
+		if label not in counter and len(counter) >= self.max_labels:
+			label = 'other'
+		counter[label] += 1
+
+	def note_wait(self, label):
+		with self.lock:
+			self._count(self.waits, label)
+
+	def note_stale(self, label):
+		with self.lock:
+			self._count(self.stale, label)
+
+	def finish(self, key, flight, page):
+		"""
+		Hands page to the requests waiting for key. page is None if there's nothing they can use.
+		"""
+		with self.lock:
+			del self.flights[key]
+		flight.page = page
+		flight.done.set()
+
+	def stats(self):
+		with self.lock:
+			return {'waits' : sum(self.waits.values()), 'stale' : sum(self.stale.values()), 'rendering' : len(self.flights)}
+
+def page_label(key):
+	"""
+	Names the page cached under key in metrics: home, archive, or a post's url title.
+	Archive pages all count as the archive, and anything that isn't a post as other.
+	"""
+	if key is None:
+		return 'home'
+	if isinstance(key, tuple):
+		return 'archive'
+	return key if is_url_title(key) else 'other'
+
+def find_cached_page(key):
+	"""
+	Returns a page from page_cache for key, the Flight of its render if this request has to render it,
+	and how it was found, for the metrics: hit, miss, wait or stale.
+	If another request is rendering the page, this one waits for it, or with serve_stale,
+	gets the page from before the cache was emptied if there is one.
+	"""
+	page = page_cache.get(key)
+	if page is not None:
+		return page, None, 'hit'
+	label = page_label(key)
+	leader, flight = page_flights.begin(key, label)
+	if leader:
+		return None, flight, 'miss'
+	if cache_config['serve_stale']:
+		page = page_cache.get_stale(key)
+		if page is not None:
+			page_flights.note_stale(label)
+			return page, None, 'stale'
+	page = flight.wait(cache_config['flight_timeout'])
+	# if the other request's page can't be cached, or it's taking too long, this one renders its own
+	return page, None, 'miss' if page is None else 'wait'
+
+class CachedPage:
+	"""
+	A finished page as it's kept in page_cache.
+	The body is compressed with compress() when the page is cached, so it's compressed once per change
+	instead of once per request. The ETag is a hash of the uncompressed body.
+	"""
+	def __init__(self, res):
+		import hashlib
+		self.status = res.status
+		self.headers = res.headers
+		body = res.body()
+		self.etag = hashlib.sha1(body).hexdigest()[:20]
+		self.bodies = {'identity' : body}
+		self.last_modified = None
+		for name, value in self.headers:
+			if name == 'Last-Modified':
+				self.last_modified = parse_http_date(value)
+
+	def size(self):
+		return sum(len(body) for body in self.bodies.values())
+
+	def compress(self):
+		"""
+		Adds gzip and brotli copies of the body, if they're smaller.
+		"""
+		import gzip
+		body = self.bodies['identity']
+		compressed = gzip.compress(body, http_config['gzip_level'], mtime = 0)
+		if len(compressed) < len(body):
+			self.bodies['gzip'] = compressed
+		try:
+			import brotli
+		except ImportError:
+			return
+		compressed = brotli.compress(body, quality = http_config['brotli_quality'])
+		if len(compressed) < len(body):
+			self.bodies['br'] = compressed
+
+	def respond(self, environ):
+		"""
+		Returns a Response for this page, in the best encoding the client accepts,
+		or a 304 Not Modified if the client's copy is still good.
+		"""
+		encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''), self.bodies)
+		res = Response()
+		res.headers = [
+			('ETag', '"{}"'.format(self.etag if encoding == 'identity' else self.etag + '-' + encoding)),
+			('Cache-Control', 'public, max-age={}'.format(http_config['max_age'])),
+			('Vary', 'Accept-Encoding')
+		]
+		if is_not_modified(environ, self.etag, self.last_modified):
+			res.status = '304 Not Modified'
+			res.headers += [header for header in self.headers if header[0] == 'Last-Modified']
+			res.encoded = b''
+			return res
+		res.status = self.status
+		res.headers += self.headers
+		if encoding != 'identity':
+			res.headers.append(('Content-Encoding', encoding))
+		res.encoded = self.bodies[encoding]
+		return res
+
+def keep_page(key, page, generation):
+	"""
+	Compresses page and puts it in page_cache under key, unless the cache wouldn't keep it anyway,
+	because it's too big or the cache was emptied since generation was read.
+	"""
+	if generation != page_cache.generation or page.size() > page_cache.max_bytes:
+		return
+	page.compress()
+	page_cache.put(key, page, generation)
+
+def choose_encoding(accept_encoding, bodies):
+	"""
+	Picks the smallest of bodies the Accept-Encoding header allows.
+	'identity' is always in bodies and is used when nothing else is accepted.
+	"""
+	accepted = set()
+	for coding in accept_encoding.split(','):
+		name, _, params = coding.partition(';')
+		params = params.replace(' ', '')
+		if params.startswith('q=') and params[2:] in ('0', '0.0', '0.00', '0.000'):
+			continue
+		accepted.add(name.strip().lower())
+	best = 'identity'
+	for encoding in bodies:
+		if (encoding in accepted or '*' in accepted) and len(bodies[encoding]) < len(bodies[best]):
+			best = encoding
+	return best
+
+def is_not_modified(environ, etag = None, last_modified = None):
+	"""
+	Checks the request's If-None-Match and If-Modified-Since headers against a page's ETag and last modified time.
+	Returns True if the client's copy of the page is still good.
+	If-Modified-Since is only looked at when there's no If-None-Match.
+	"""
+	if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+	if if_none_match is not None:
+		if etag is None:
+			return False
+		for tag in if_none_match.split(','):
+			tag = tag.strip()
+			if tag.startswith('W/'):
+				tag = tag[2:]
+			# the tags of the compressed bodies are the same hash with the encoding after a '-'
+			if tag == '*' or tag.strip('"').split('-')[0] == etag:
+				return True
+		return False
+	since = parse_http_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+	return since is not None and last_modified is not None and last_modified <= since
+
+def not_modified(res, last_modified):
+	"""
+	Makes res a 304 Not Modified for a page last changed at last_modified.
+	"""
+	res.status = '304 Not Modified'
+	res.headers = [
+		('Last-Modified', format_http_date(last_modified)),
+		('Cache-Control', 'public, max-age={}'.format(http_config['max_age']))
+	]
+	res.encoded = b''
+	res.chunks = []
+	res.streaming = False
+
+def streamed_not_modified(res, environ):
+	"""
+	Makes a streamed page a 304 Not Modified if the client's copy is newer than its Last-Modified.
+	Streamed pages aren't cached, so they have no ETag to check.
+	"""
+	for name, value in res.headers:
+		if name == 'Last-Modified':
+			last_modified = parse_http_date(value)
+			if is_not_modified(environ, last_modified = last_modified):
+				not_modified(res, last_modified)
+			return
+
+# HTTP dates are always in English, whatever the locale is
+weekday_names = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+month_names = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def format_http_date(timestamp):
+	t = time.gmtime(timestamp)
+	return '{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT'.format(
+		weekday_names[t.tm_wday], t.tm_mday, month_names[t.tm_mon - 1], t.tm_year, t.tm_hour, t.tm_min, t.tm_sec
+	)
+
+def parse_http_date(value):
+	"""
+	Returns an HTTP date header as a unix timestamp, or None if it can't be read.
+	"""
+	if not value:
+		return None
+	import datetime
+	fields = value.split()
+	try:
+		# browsers send back the date they were given, like 'Sun, 06 Nov 1994 08:49:37 GMT'
+		if len(fields) == 6 and fields[2] in month_names and fields[5] == 'GMT':
+			hour, minute, second = fields[4].split(':')
+			return int(datetime.datetime(
+				int(fields[3]), month_names.index(fields[2]) + 1, int(fields[1]),
+				int(hour), int(minute), int(second), tzinfo = datetime.timezone.utc
+			).timestamp())
+		# the older formats HTTP allows
+		import email.utils
+		return int(email.utils.parsedate_to_datetime(value).timestamp())
+	except (TypeError, ValueError, IndexError):
+		return None
+
+page_cache = LRUCache(
+	cache_config['max_bytes'],
+	sizeof = lambda page: page.size(),
+	version_path = cache_config['version_file'],
+	keep_stale = cache_config['serve_stale']
+)
+
+page_flights = SingleFlight()
+
+search_cache = LRUCache(
+	cache_config['search_max_bytes'],
+	# roughly what a list of results costs in memory
+	sizeof = lambda posts: 64 + sum(128 + len(post.url_title) + len(post.title) + len(post.description) for post in posts),
+	version_path = cache_config['version_file']
+)
+
+def get_stats():
+	"""
+	Returns a dictionary of counters for the caches and connection pools.
+	"""
+	stats = dict()
+	for name, cache in (('page_cache', page_cache), ('search_cache', search_cache)):
+		stats[name] = cache.stats()
+	stats['page_flights'] = page_flights.stats()
+	for number, pool in enumerate(list(pools.values())):
+		stats['pool_{}'.format(number)] = pool.stats()
+	return stats
+
+# routes with their own name in ?p=, everything else is a post
+named_routes = frozenset(('archive', 'contact', 'feed', 'sitemap', 'metrics'))
+
+# the RequestMetrics of the request a thread is serving
+request_metrics = threading.local()
+
+class RequestMetrics:
+	"""
+	Where the time went in one request.
+	Creating one makes it the current request's, so SQLcon and HTMLtemplate add to it.
+	"""
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.route = None
+		self.cache = None
+		self.sql = collections.defaultdict(float)
+		self.queries = collections.Counter()
+		self.render = 0.0
+		request_metrics.current = self
+
+	def count_body(self, status, chunks):
+		"""
+		Passes a streamed body on, finishing the request once it has all been sent.
+		"""
+		sent = 0
+		try:
+			for chunk in chunks:
+				sent += len(chunk)
+				yield chunk
+		finally:
+			self.finish(status, sent)
+
+	def finish(self, status, bytes_out):
+		"""
+		Adds the request to the totals and logs it.
+		"""
+		if getattr(request_metrics, 'current', None) is self:
+			request_metrics.current = None
+		seconds = time.perf_counter() - self.start
+		metrics_totals.add(self, status, seconds, bytes_out)
+		if metrics_config['log_requests']:
+			import json
+			log_print(json.dumps({
+				'route' : self.route,
+				'status' : int(status[:3]),
+				'seconds' : round(seconds, 6),
+				'sql' : {query : round(query_seconds, 6) for query, query_seconds in self.sql.items()},
+				'render' : round(self.render, 6),
+				'bytes' : bytes_out,
+				'cache' : self.cache
+			}, sort_keys = True))
+		metrics_totals.write_stats_file()
+
+def current_metrics():
+	"""
+	Returns the RequestMetrics of the request being served on this thread, or None if it isn't measured.
+	"""
+	if not metrics_config['enabled']:
+		return None
+	return getattr(request_metrics, 'current', None)
+
+def note_request(**fields):
+	"""
+	Sets fields like route and cache on the current request's RequestMetrics, if it's measured.
+	"""
+	metrics = current_metrics()
+	if metrics is not None:
+		for name, value in fields.items():
+			setattr(metrics, name, value)
+
+class MetricsTotals:
+	"""
+	Totals of every measured request since blog.py started, by route and by query.
+	"""
+	# upper bounds of the request time histogram, in seconds
+	buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.requests = collections.Counter()
+		self.seconds = collections.defaultdict(float)
+		self.histogram = collections.defaultdict(lambda: [0] * len(self.buckets))
+		self.bytes_out = collections.Counter()
+		self.sql = collections.defaultdict(float)
+		self.queries = collections.Counter()
+		self.render = 0.0
+		self.stats_written = 0.0
+
+	def add(self, metrics, status, seconds, bytes_out):
+		route = metrics.route or 'other'
+		with self.lock:
+			self.requests[(route, status[:3])] += 1
+			self.seconds[route] += seconds
+			counts = self.histogram[route]
+			for offset, bound in enumerate(self.buckets):
+				if seconds <= bound:
+					counts[offset] += 1
+			self.bytes_out[route] += bytes_out
+			for query, query_seconds in metrics.sql.items():
+				self.sql[query] += query_seconds
+			self.queries.update(metrics.queries)
+			self.render += metrics.render
+
+	def prometheus(self):
+		"""
+		Returns the totals, along with the cache and pool counters from get_stats(), in Prometheus' text format.
+		"""
+		out = []
+		def metric(name, kind, samples):
+			# samples are (name suffix, labels, value)
+			out.append('# TYPE lightblog_{} {}'.format(name, kind))
+			for suffix, labels, value in samples:
+				label_text = ','.join('{}="{}"'.format(key, label) for key, label in labels)
+				out.append('lightblog_{}{}{} {}'.format(name, suffix, '{' + label_text + '}' if labels else '', value))
+		with self.lock:
+			metric('requests_total', 'counter', [
+				('', (('route', route), ('status', status)), count) for (route, status), count in sorted(self.requests.items())
+			])
+			histogram = []
+			for route in sorted(self.histogram):
+				count = sum(count for (request_route, status), count in self.requests.items() if request_route == route)
+				for bound, bucket_count in zip(self.buckets + ('+Inf',), self.histogram[route] + [count]):
+					histogram.append(('_bucket', (('route', route), ('le', bound)), bucket_count))
+				histogram.append(('_sum', (('route', route),), self.seconds[route]))
+				histogram.append(('_count', (('route', route),), count))
+			metric('request_seconds', 'histogram', histogram)
+			metric('bytes_out_total', 'counter', [('', (('route', route),), count) for route, count in sorted(self.bytes_out.items())])
+			metric('sql_seconds_total', 'counter', [('', (('query', query),), seconds) for query, seconds in sorted(self.sql.items())])
+			metric('sql_queries_total', 'counter', [('', (('query', query),), count) for query, count in sorted(self.queries.items())])
+			metric('render_seconds_total', 'counter', [('', (), self.render)])
+		for name, values in sorted(get_stats().items()):
+			for key, value in sorted(values.items()):
+				metric('{}_{}'.format(name, key), 'gauge', [('', (), value)])
+		with page_flights.lock:
+			metric('page_waits_total', 'counter', [('', (('page', page),), count) for page, count in sorted(page_flights.waits.items())])
+			metric('page_stale_total', 'counter', [('', (('page', page),), count) for page, count in sorted(page_flights.stale.items())])
+		return '\n'.join(out) + '\n'
+
+	def write_stats_file(self):
+		"""
+		Writes prometheus() to the stats file if it's set and hasn't been written for stats_interval seconds.
+		"""
+		path = metrics_config['stats_file']
+		if not path:
+			return
+		# every worker counts its own requests
+		if worker_number is not None:
+			path = '{}.{}'.format(path, worker_number)
+		now = time.monotonic()
+		with self.lock:
+			if now - self.stats_written < metrics_config['stats_interval']:
+				return
+			self.stats_written = now
+		tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+		try:
+			with open(tmp_path, 'w') as fh:
+				fh.write(self.prometheus())
+			os.replace(tmp_path, path)
+		except OSError as e:
+			log_print("Could not write {}: {}".format(path, e))
+
+metrics_totals = MetricsTotals()
+
+profile_lock = threading.Lock()
+request_count = itertools.count(1)
+
+def profile_request(environ):
+	"""
+	Runs handle_request(), under cProfile for one in every profile_every requests.
+	Only one request is profiled at a time, others go unprofiled while it runs.
+	"""
+	every = metrics_config['profile_every']
+	if not every or next(request_count) % every or not profile_lock.acquire(blocking = False):
+		return handle_request(environ)
+	try:
+		import cProfile
+		profiler = cProfile.Profile()
+		res = profiler.runcall(handle_request, environ)
+		path = os.path.join(metrics_config['profile_dir'], '{}-{}-{}.prof'.format(
+			time.strftime('%Y%m%d-%H%M%S'), os.getpid(), getattr(current_metrics(), 'route', None) or 'other'
+		))
+		try:
+			os.makedirs(metrics_config['profile_dir'], exist_ok = True)
+			profiler.dump_stats(path)
+		except OSError as e:
+			log_print("Could not write {}: {}".format(path, e))
+		return res
+	finally:
+		profile_lock.release()
+
+def print_headers(res, headers = [], mime_type = 'text/html'):
+	"""
+	Sets the HTTP headers of a Response.
+	Takes a list of HTTP headers as strings like 'Status: 404 Not Found'.
 	Optional mime_type variable can be used to modify Content-Type header
 	"""
 	for header in headers:
-		print(header + '\r\n', end = '')
-	print('Content-Type:', mime_type + '\r\n\r\n', end = '')
+		name, value = header.split(':', 1)
+		if name == 'Status':
+			res.status = value.strip()
+		else:
+			res.headers.append((name, value.strip()))
+	res.headers.append(('Content-Type', mime_type + '; charset=utf-8'))
 
 def to_utf8(field):
 	"""
@@ -97,33 +1132,233 @@ def to_utf8(field):
 	"""
 	return field.decode('utf8') if type(field) is bytearray else field
 
+class SQLError(Exception):
+	"""
+	Raised when the database can't be reached.
+	handle_request() turns it into a 500 error page.
+	"""
+
+class PooledConnection:
+	"""
+	A connection to MySQL/MariaDB that remembers its prepared statements.
+	Each query name gets its own prepared cursor, so a statement is only prepared
+	by the server the first time it is used on this connection.
+	"""
+	def __init__(self, config):
+		self.conn = mysql.connector.connect(**config)
+		# without autocommit, a long lived connection would keep reading from an old snapshot
+		# and never see posts added by post.py
+		self.conn.autocommit = True
+		self.cursors = dict()
+		self.last_used = time.monotonic()
+
+	def cursor(self, query):
+		"""
+		Returns the prepared cursor for the query name, creating it if needed.
+		"""
+		cur = self.cursors.get(query)
+		if cur is None:
+			cur = self.cursors[query] = self.conn.cursor(prepared = True)
+		return cur
+
+	def is_healthy(self, check_after):
+		"""
+		Pings the server if the connection hasn't been used for check_after seconds.
+		"""
+		if time.monotonic() - self.last_used < check_after:
+			return True
+		try:
+			return self.conn.is_connected()
+		except mysql.connector.Error:
+			return False
+
+	def close(self):
+		try:
+			for cur in self.cursors.values():
+				cur.close()
+			self.conn.close()
+		except mysql.connector.Error:
+			pass
+
+class ConnectionPool:
+	"""
+	A thread safe pool of at most 'size' PooledConnections.
+	get() waits up to 'timeout' seconds for a free connection, then raises SQLError.
+	stats() reports how the pool is doing, which helps with picking a size.
+	"""
+	def __init__(self, config, size, timeout, check_after):
+		self.config = config
+		self.size = size
+		self.timeout = timeout
+		self.check_after = check_after
+		self.cond = threading.Condition()
+		self.idle = []
+		self.open = 0
+		self.checkouts = 0
+		self.wait_time = 0.0
+		self.timeouts = 0
+
+	def get(self):
+		"""
+		Checks out a connection, opening a new one if the pool isn't full yet.
+		"""
+		start = time.monotonic()
+		with self.cond:
+			while not self.idle and self.open >= self.size:
+				remaining = start + self.timeout - time.monotonic()
+				if remaining <= 0:
+					self.timeouts += 1
+					raise SQLError('Timed out waiting for a free connection')
+				self.cond.wait(remaining)
+			self.checkouts += 1
+			self.wait_time += time.monotonic() - start
+			pconn = self.idle.pop() if self.idle else None
+			# reserve a spot for the connection about to be opened
+			self.open += 1
+		if pconn is not None:
+			if pconn.is_healthy(self.check_after):
+				return pconn
+			pconn.close()
+		try:
+			return PooledConnection(self.config)
+		except mysql.connector.Error as e:
+			log_print("SQL error: {}".format(e))
+			self._forget()
+			raise SQLError(e)
+
+	def put(self, pconn, broken = False):
+		"""
+		Returns a connection to the pool.
+		Broken connections are closed, and a new one will be opened in their place when needed.
+		"""
+		if broken:
+			pconn.close()
+			self._forget()
+			return
+		pconn.last_used = time.monotonic()
+		with self.cond:
+			self.open -= 1
+			self.idle.append(pconn)
+			self.cond.notify()
+
+	def _forget(self):
+		with self.cond:
+			self.open -= 1
+			self.cond.notify()
+
+	def stats(self):
+		"""
+		Returns a dictionary describing the pool.
+		'open' counts connections in use, 'idle' connections waiting in the pool.
+		'wait_time' is the total number of seconds spent waiting in get().
+		"""
+		with self.cond:
+			return {
+				'size' : self.size,
+				'open' : self.open,
+				'idle' : len(self.idle),
+				'checkouts' : self.checkouts,
+				'wait_time' : self.wait_time,
+				'timeouts' : self.timeouts
+			}
+
+pools = dict()
+pools_lock = threading.Lock()
+
+def get_pool(config):
+	"""
+	Returns the ConnectionPool for a config dictionary, creating it the first time.
+	"""
+	# the driver is only loaded once a page needs the database
+	global mysql
+	import mysql.connector
+	key = tuple(sorted(config.items()))
+	with pools_lock:
+		if key not in pools:
+			pools[key] = ConnectionPool(config, **pool_config)
+		return pools[key]
+
+# rows are returned as these light weight tuples by SQLcon.fetch()
+# updated_at is a unix timestamp
+PostPage = collections.namedtuple('PostPage', 'post_id title url_title post_date text updated_at prev_url next_url')
+ArchiveEntry = collections.namedtuple('ArchiveEntry', 'url_title title description updated_at post_date post_id')
+
 class SQLcon:
 	"""
-	Opens a connection to MySQL/MariaDB.
-	sql_config must be passed to the constructor to open the connection.
+	Borrows a connection to MySQL/MariaDB from the pool.
+	sql_config must be passed to the constructor to pick the pool.
+	The connection goes back to the pool when no references of this object are left.
 	"""
+	# a post along with the url titles of the posts around it, so a post page takes one round trip.
+	# posts are ordered by (post_date, post_id), and the post_order index makes each neighbour a single index lookup.
+	post_page = (
+		"SELECT p.post_id, p.title, p.url_title, p.post_date, p.text, UNIX_TIMESTAMP(p.updated_at) AS updated_at, "
+		"(SELECT n.url_title FROM blog_posts n WHERE n.post_date >= p.post_date AND (n.post_date > p.post_date OR n.post_id > p.post_id) ORDER BY n.post_date ASC, n.post_id ASC LIMIT 1) AS prev_url, "
+		"(SELECT n.url_title FROM blog_posts n WHERE n.post_date <= p.post_date AND (n.post_date < p.post_date OR n.post_id < p.post_id) ORDER BY n.post_date DESC, n.post_id DESC LIMIT 1) AS next_url "
+		"FROM blog_posts p "
+	)
+	# a page of the archive, with one extra post to tell whether there's another page after it.
+	# Older and newer pages start from the post_order index at a (post_date, post_id) cursor,
+	# so every page costs the same no matter how deep it is.
+	archive_page = "SELECT url_title, title, description, UNIX_TIMESTAMP(updated_at) AS updated_at, post_date, post_id FROM blog_posts "
+	archive_limit = "LIMIT {};".format(archive_config['page_size'] + 1)
 	queries = {
-		'get_number_posts'		: "SELECT COUNT(*) AS max FROM blog_posts;",
-		'get_first_post'		: "SELECT title, url_title, post_date, text FROM blog_posts ORDER BY post_date DESC LIMIT 1;",
-		'get_post' 				: "SELECT title, post_date, text FROM blog_posts WHERE url_title = %s;",
-		'get_title_and_desc'	: "SELECT url_title, title, description FROM blog_posts ORDER BY post_date DESC LIMIT 20;",
-		'search_db'				: "SELECT title, url_title, description, Match(text) Against(%s WITH QUERY EXPANSION) AS rank FROM blog_posts ORDER BY rank DESC LIMIT 20;",
-		'get_ordered_url_titles': "SELECT url_title FROM blog_posts ORDER BY post_date DESC;",
-		'insert_challenge'		: "INSERT INTO email_challenges(word, creation_time) VALUES (%s, NOW());",
-		'find_challenge'		: "SELECT challenge_id FROM email_challenges WHERE word = %s;",
-		'delete_challenge'		: "DELETE FROM email_challenges WHERE challenge_id = %s;",
+		'get_first_post_page'	: post_page + "ORDER BY p.post_date DESC, p.post_id DESC LIMIT 1;",
+		'get_post_page'			: post_page + "WHERE p.url_title = %s;",
+		'get_title_and_desc'	: archive_page + "ORDER BY post_date DESC, post_id DESC " + archive_limit,
+		'get_archive_before'	: archive_page + "WHERE post_date <= %s AND (post_date < %s OR post_id < %s) ORDER BY post_date DESC, post_id DESC " + archive_limit,
+		'get_archive_after'		: archive_page + "WHERE post_date >= %s AND (post_date > %s OR post_id > %s) ORDER BY post_date ASC, post_id ASC " + archive_limit,
+		'search_db'				: "SELECT url_title, title, description, Match(text) Against(%s WITH QUERY EXPANSION) AS rank FROM blog_posts ORDER BY rank DESC LIMIT 20;",
 	}
 	def __init__(self, config):
 		"""
-		Sets up connection.
-		Sends a 500 error to web sever and exits with status 1 if connection fails.
+		Checks out a connection.
+		Raises SQLError if there's no connection to be had.
+		"""
+		self.pconn = None
+		self.pool = get_pool(config)
+		self.pconn = self.pool.get()
+
+	def _run(self, query, parameters, commit):
+		"""
+		Runs a query and returns the cursor and rows, or None if it failed.
+		The time it takes is added to the request's RequestMetrics, if it's measured.
 		"""
+		metrics = current_metrics()
+		if metrics is None:
+			return self._run_query(query, parameters, commit)
+		start = time.perf_counter()
 		try:
-			self.conn = mysql.connector.connect(**config)
-		except mysql.connector.Error as e:
-			print("SQL error: {}".format(e), file = sys.stderr)
-			serve_error('500 Internal Error', 'Something went wrong. Please Try again later')
-			exit(1)
+			return self._run_query(query, parameters, commit)
+		finally:
+			metrics.sql[query] += time.perf_counter() - start
+			metrics.queries[query] += 1
+
+	def _run_query(self, query, parameters, commit):
+		"""
+		If the connection was lost, the query is tried once more on a new connection.
+		"""
+		if query not in self.queries:
+			log_print("SQL error: That query is not defined")
+			return None
+		for retry in (True, False):
+			try:
+				cur = self.pconn.cursor(query)
+				cur.execute(self.queries[query], parameters)
+				if commit:
+					self.pconn.conn.commit()
+					return (cur, [])
+				return (cur, cur.fetchall())
+			except (mysql.connector.OperationalError, mysql.connector.InterfaceError) as e:
+				log_print("SQL error: {}".format(e))
+				self.pool.put(self.pconn, broken = True)
+				self.pconn = None
+				if not retry:
+					return None
+				self.pconn = self.pool.get()
+			except mysql.connector.Error as e:
+				log_print("SQL error: {}".format(e))
+				return None
 
 	def execute(self, query, *parameters, commit = False):
 		"""
@@ -134,42 +1369,82 @@ class SQLcon:
 		In every dictionary, the keys are the column names and values the value of that particular row.
 		If only one row is returned, the dictionary for that row is not wrapped in a tuple.
 		"""
-		try:
-			# set up a temporary cursor
-			cur = self.conn.cursor(prepared = True)
-			# execute the query
-			cur.execute(self.queries[query], parameters)
-			if commit:
-				self.conn.commit()
-				return None
-			rows = cur.fetchall()
-			if cur.rowcount == 0:
-				return None
-			elif cur.rowcount == 1:
-				return dict(
-					[(col_name, to_utf8(field)) for col_name, field in zip(cur.column_names, rows[0])]
-				)
-			else: 
-				ret = list()
-				for row in rows:
-					ret.append(dict(
-						[(col_name, to_utf8(field)) for col_name, field in zip(cur.column_names, row)]
-					))
-				return tuple(ret)
-		except KeyError:
-			log_print("SQL error: That query is not defined")
+		result = self._run(query, parameters, commit)
+		if result is None or commit:
 			return None
-		except mysql.connector.Error as e:
-			log_print("SQL error: {}".format(e))
-			return None	
-		finally:
-			cur.close()
+		cur, rows = result
+		if len(rows) == 0:
+			return None
+		elif len(rows) == 1:
+			return dict(
+				[(col_name, to_utf8(field)) for col_name, field in zip(cur.column_names, rows[0])]
+			)
+		else: 
+			ret = list()
+			for row in rows:
+				ret.append(dict(
+					[(col_name, to_utf8(field)) for col_name, field in zip(cur.column_names, row)]
+				))
+			return tuple(ret)
+
+	def fetch(self, query, record, *parameters):
+		"""
+		Like execute(), but returns a list of 'record' namedtuples, one for each row.
+		The columns of the query must be in the same order as the fields of the record.
+		Returns None if the query failed.
+		"""
+		result = self._run(query, parameters, False)
+		if result is None:
+			return None
+		return [record._make(map(to_utf8, row)) for row in result[1]]
 
 	def __del__(self):
 		"""
-		Closes connection when no references of this object are left.
+		Returns the connection to the pool when no references of this object are left.
 		"""
-		self.conn.close()
+		if self.pconn is not None:
+			self.pool.put(self.pconn)
+
+compiled_templates = dict()
+
+# marks text that HTMLtemplate should pass on to Response.write_stream()
+TextStream = collections.namedtuple('TextStream', 'pieces')
+
+def split_text(text, size):
+	"""
+	Yields text in pieces of at most size characters.
+	"""
+	for offset in range(0, len(text), size):
+		yield text[offset:offset + size]
+
+def compile_template(template_path, markers):
+	"""
+	Reads a template and splits it at every line containing one of the markers.
+	Returns a list of static text with a marker between each piece, like:
+	['<html>...', '<!--post-->', '...', '<!--links-->', '...</html>']
+	Lines with a marker are left out, since whatever is inserted at the marker replaces them.
+	The result is kept until the template file is modified, so templates are only read once.
+	"""
+	mtime = os.stat(template_path).st_mtime_ns
+	key = (template_path, markers)
+	compiled = compiled_templates.get(key)
+	if compiled is not None and compiled[0] == mtime:
+		return compiled[1]
+	parts = []
+	static = []
+	with open(template_path, 'r') as fh:
+		for line in fh:
+			for mark in markers:
+				if line.find(mark) != -1:
+					parts.append(''.join(static))
+					parts.append(mark)
+					static = []
+					break
+			else:
+				static.append(line)
+	parts.append(''.join(static))
+	compiled_templates[key] = (mtime, parts)
+	return parts
 
 class HTMLtemplate:
 	"""
@@ -180,47 +1455,67 @@ class HTMLtemplate:
 		...
 
 	It is initialized with the path to the premade HTML template.
+	The filled in template is printed to 'out', which is usually a Response, in a single write.
+	Templates are only read from disk once, see compile_template().
 	"""
-	def __init__(self, template_path):
+	def __init__(self, template_path, out = sys.stdout):
 			self.template_path = template_path
+			self.out = out
 			self.inserts = dict()
 			self.current_marker = str()
 			self.current_list_index = list()
 
 	def __enter__(self):
-		self.fh = open(self.template_path, 'r')
+		self.start = time.perf_counter()
 		return self
 
 	def __exit__(self, exc_type, exc_value, traceback):
-		printed = False
-		for line in self.fh:
-			for mark in self.inserts.keys():
-				if line.find(mark) != -1:
-					self._print_list(self.inserts[mark])
-					printed = True
-					break
-			if not printed:
-				print(line, end = '')
-			printed = False
-		self.fh.close()
-	
-	def _print_list(self, l):
+		# nothing is printed if the page couldn't be finished
+		if exc_type is not None:
+			return
+		self._write()
+		metrics = current_metrics()
+		if metrics is not None:
+			metrics.render += time.perf_counter() - self.start
+
+	def _write(self):
+		parts = compile_template(self.template_path, tuple(self.inserts))
+		out = []
+		for offset, part in enumerate(parts):
+			# compile_template() puts a marker between each piece of static text
+			if offset % 2:
+				self._flatten(self.inserts[part], out)
+			else:
+				out.append(part)
+		self.out.write(''.join(out))
+
+	def _flatten(self, l, out):
 		for i in l:
 			if isinstance(i, list):
-				self._print_list(i)
+				self._flatten(i, out)
+			elif isinstance(i, TextStream):
+				# everything up to here can be sent while the stream is read
+				self.out.write(''.join(out))
+				self.out.write_stream(i.pieces)
+				out.clear()
+				out.append('\n')
 			else:
-				print(i)
+				out.append(str(i))
+				out.append('\n')
 
 	def _append_at_marker(self, text):
 		current_list = self.inserts[self.current_marker]
-		append_method = lambda x: current_list.append(x)
-		if self.current_list_index != []:
-			append_method = lambda x: current_list.insert(-1, x)
+		if self.current_list_index:
+			# nested elements go before the closing tag of the element they're in
 			for i in self.current_list_index:
 				current_list = current_list[i]
-		if isinstance(text, list):
-			self.current_list_index.append(len(current_list) if self.current_list_index == [] else len(current_list) - 1)
-		append_method(text)
+			if isinstance(text, list):
+				self.current_list_index.append(len(current_list) - 1)
+			current_list.insert(-1, text)
+		else:
+			if isinstance(text, list):
+				self.current_list_index.append(len(current_list))
+			current_list.append(text)
 
 	def set_insert(self, marker):
 		"""
@@ -273,6 +1568,13 @@ class HTMLtemplate:
 		"""
 		self._append_at_marker(raw)
 
+	def append_stream(self, pieces):
+		"""
+		Print an iterable of strings, no HTML.
+		The pieces aren't read until the page is sent, so 'out' must be a Response.
+		"""
+		self._append_at_marker(TextStream(pieces))
+
 	def a(self, url, text):
 		"""
 		Print hyperlink.
@@ -297,116 +1599,569 @@ class HTMLtemplate:
 		"""
 		self._append_at_marker(['<div id="{}">'.format(identifier), '</div>'])
 
-def serve_post(url_title = None):
+def serve_post(res, url_title = None, environ = None):
 	"""
 	Serves a blog post.
 	If no post url is provided by handle_request(), it prints the newest post.
+	If environ is given and the client's copy is newer than the post, a 304 is served without rendering.
+	The post comes from the snapshot if there is one, otherwise from the database.
 	"""
-	sql = SQLcon(sql_config)
-	if url_title is None:
-		post = sql.execute('get_first_post')
-		url_title = post['url_title']
+	snap = get_snapshot()
+	if snap is not None:
+		posts = snap.post_page(PostPage, url_title)
+	elif url_title is None:
+		posts = SQLcon(sql_config).fetch('get_first_post_page', PostPage)
 	else:
-		post = sql.execute('get_post', url_title)	
-		if post is None:
-			serve_error('404 Not Found', 'Sorry. That blog post doesn\'t exist.')
-			return
-	print_headers()
-	with HTMLtemplate(template_config['post_template']) as temp:
+		posts = SQLcon(sql_config).fetch('get_post_page', PostPage, url_title)
+	show_post(res, posts, environ)
+
+def show_post(res, posts, environ = None):
+	"""
+	Serves the post in posts, what the post page query returned.
+	This is the part of serve_post() after the query, aioblog.py uses it too.
+	posts is None if the query failed.
+	"""
+	if posts is None:
+		serve_error(res, '500 Internal Error', 'Something went wrong. Please Try again later')
+		return
+	if not posts:
+		serve_error(res, '404 Not Found', 'Sorry. That blog post doesn\'t exist.')
+		return
+	if environ is not None and is_not_modified(environ, last_modified = posts[0].updated_at):
+		not_modified(res, posts[0].updated_at)
+		return
+	render_post(res, posts[0])
+
+def render_post(res, post):
+	"""
+	Prints a post page with links to its neighbours into res.
+	post is a PostPage.
+	post.py uses this too, so static pages look the same as served ones.
+	"""
+	print_headers(res, ['Last-Modified: ' + format_http_date(post.updated_at)])
+	with HTMLtemplate(template_config['post_template'], res) as temp:
 		temp.set_insert('<!--post-->')
-		temp.h(post['title'])
-		temp.h(post['post_date'].strftime('%b. %d, %Y'), level = 3)
-		temp.append_raw(post['text'])
+		temp.h(post.title)
+		temp.h(post.post_date.strftime('%b. %d, %Y'), level = 3)
+		# a text from the snapshot is a memoryview of utf-8, big ones are sent straight out of it
+		if not isinstance(post.text, str) and len(post.text) > stream_config['threshold']:
+			temp.append_stream(split_text(post.text, stream_config['chunk_size']))
+		else:
+			temp.append_raw(post.text if isinstance(post.text, str) else str(post.text, 'utf8'))
 		temp.hr()
-		prev_url, next_url = get_seq_url_titles(url_title, sql)
 		temp.set_insert('<!--links-->')
-		if prev_url is not None:
+		if post.prev_url is not None:
 			temp.div('prev')
-			temp.a('/?p=' + prev_url, 'Previous Post')
+			temp.a('/?p=' + post.prev_url, 'Previous Post')
 			temp.jump()
-		if next_url is not None:
+		if post.next_url is not None:
 			temp.div('next')
-			temp.a('/?p=' + next_url, 'Next Post')
+			temp.a('/?p=' + post.next_url, 'Next Post')
 			temp.jump()
-	
-def get_seq_url_titles(url_title, sql):
-	"""
-	Gets the urls of next oldest post and previous newest post.
-	In addition to taking a url_title, it takes a SQLcon object to do its work.
-	"""
-	max_offset = sql.execute('get_number_posts')['max'] - 1
-	titles = sql.execute('get_ordered_url_titles')
-	prev_url = next_url = None
-	for offset, row in enumerate(titles):
-		if row['url_title'] == url_title:
-			if offset != 0:
-				prev_url = titles[offset - 1]['url_title']
-			if offset != max_offset:
-				next_url = titles[offset + 1]['url_title']
-	return (prev_url, next_url)
 
-def serve_default_archive():
+def serve_default_archive(res, environ = None, before = None, after = None):
 	"""
 	First search page before a user tries to search for something.
-	Prints a list links to the ten newest posts.
+	Prints a page of links to posts, newest first.
+	Without a cursor it's the newest posts, with a before or after cursor it's the posts older or newer than it.
+	If environ is given and the client's copy is newer than every post in it, a 304 is served without rendering.
+	The posts come from the snapshot if there is one, otherwise from the database.
 	"""
+	page_size = archive_config['page_size']
+	cursor = parse_archive_cursor(before or after)
+	# a page can't be both before and after a post
+	if (before or after) and cursor is None or before and after:
+		serve_error(res, '404 Not Found', 'The page you\'re requesting doesn\'t exist.')
+		return
+	snap = get_snapshot()
+	if snap is not None:
+		posts = snap.archive_page(ArchiveEntry, page_size + 1, cursor if before else None, cursor if after else None)
+		if after and len(posts) <= page_size:
+			posts = snap.archive_page(ArchiveEntry, page_size + 1)
+			after = None
+		show_archive(res, posts, environ, before, after)
+		return
 	sql = SQLcon(sql_config)
-	posts = sql.execute('get_title_and_desc')
-	if posts is None:
-		serve_error('500 Internal Error', 'Something went wrong. Please Try again later')
+	if before:
+		posts = sql.fetch('get_archive_before', ArchiveEntry, *cursor)
+	elif after:
+		posts = sql.fetch('get_archive_after', ArchiveEntry, *cursor)
+		if posts is not None and len(posts) <= page_size:
+			# close enough to the newest posts that this is the first page
+			posts = sql.fetch('get_title_and_desc', ArchiveEntry)
+			after = None
+	else:
+		posts = sql.fetch('get_title_and_desc', ArchiveEntry)
+	show_archive(res, posts, environ, before, after)
+
+def show_archive(res, posts, environ = None, before = None, after = None):
+	"""
+	Serves a page of the archive from what the archive query for the before or after cursor, if any, returned.
+	This is the part of serve_default_archive() after the queries, aioblog.py uses it too.
+	"""
+	page_size = archive_config['page_size']
+	newer = None
+	older = None
+	if before:
+		if posts == []:
+			serve_error(res, '404 Not Found', 'There aren\'t any older posts.')
+			return
+		if posts:
+			newer = archive_cursor(posts[0])
+	elif after and posts:
+		# oldest first, and the extra post belongs to the page before this one
+		posts = posts[page_size - 1::-1]
+		newer = archive_cursor(posts[0])
+		older = archive_cursor(posts[-1])
+	if not posts:
+		serve_error(res, '500 Internal Error', 'Something went wrong. Please Try again later')
+		return
+	if len(posts) > page_size:
+		older = archive_cursor(posts[page_size - 1])
+		posts = posts[:page_size]
+	last_modified = max(post.updated_at for post in posts)
+	if environ is not None and is_not_modified(environ, last_modified = last_modified):
+		not_modified(res, last_modified)
 		return
-	print_headers()
-	with HTMLtemplate(template_config['archive_template']) as temp:
+	render_archive(res, posts, newer, older)
+
+def archive_cursor(post):
+	"""
+	Returns the cursor for an archive page starting next to post, like '2017-10-22.14'.
+	"""
+	return '{:%Y-%m-%d}.{}'.format(post.post_date, post.post_id)
+
+def parse_archive_cursor(cursor):
+	"""
+	Returns the (post_date, post_date, post_id) parameters the archive queries take for a cursor,
+	or None if it isn't one.
+	"""
+	if not cursor:
+		return None
+	date, _, post_id = cursor.partition('.')
+	fields = date.split('-')
+	if [len(field) for field in fields] != [4, 2, 2] or not all(field.isdigit() for field in fields + [post_id]):
+		return None
+	import datetime
+	try:
+		post_date = datetime.date(int(fields[0]), int(fields[1]), int(fields[2]))
+	except ValueError:
+		return None
+	return (post_date, post_date, int(post_id))
+
+def archive_key(before = None, after = None):
+	"""
+	Returns the page cache key for the archive page picked by a before or after cursor, if any.
+	Cursors are keyed by what they parse to, so '2017-10-22.014' and '2017-10-22.14' are the same page.
+	"""
+	cursor = parse_archive_cursor(before or after)
+	if cursor is None or before and after:
+		# the first page, or a 404 that's never cached
+		return ('archive', before, after)
+	return ('archive', 'before' if before else 'after', cursor[1:])
+
+def render_archive(res, posts, newer = None, older = None):
+	"""
+	Prints a page of the archive into res, with a heading for each month.
+	posts is a list of ArchiveEntry, newer and older are the cursors of the pages around it, or None.
+	post.py uses this too, so the static archive looks the same as the served one.
+	"""
+	print_headers(res, ['Last-Modified: ' + format_http_date(max(post.updated_at for post in posts))] if posts else [])
+	with HTMLtemplate(template_config['archive_template'], res) as temp:
 		temp.set_insert('<!--message-->')
 		temp.p("Here's all my posts from newest to oldest:")
 		temp.set_insert('<!--results-->')
+		month = None
 		for post in posts:
+			if (post.post_date.year, post.post_date.month) != month:
+				month = (post.post_date.year, post.post_date.month)
+				temp.li()
+				temp.h(post.post_date.strftime('%B %Y'), level = 3)
+				temp.jump()
 			temp.li()
-			temp.a('/?p=' + post['url_title'], post['title'])
-			temp.p(post['description'])
+			temp.a('/?p=' + post.url_title, post.title)
+			temp.p(post.description)
+			temp.jump()
+		temp.set_insert('<!--pages-->')
+		if newer is not None:
+			temp.div('newer')
+			temp.a('/?p=archive&after=' + newer, 'Newer Posts')
+			temp.jump()
+		if older is not None:
+			temp.div('older')
+			temp.a('/?p=archive&before=' + older, 'Older Posts')
 			temp.jump()
 
-def serve_search_archive(search_string):
+def serve_search_archive(res, search_string):
 	"""
 	Prints a list of links to post that match a user-submitted search string.
 	"""
-	sql = SQLcon(sql_config)
-	posts = sql.execute('search_db', search_string)
+	render_search_archive(res, search_posts(search_string))
+
+def render_search_archive(res, posts):
+	"""
+	Prints the search results in posts, or a 500 error if posts is None because the search failed.
+	"""
 	if posts is None:
-		serve_error('500 Internal Error', 'Something went wrong. Please Try again later')
+		serve_error(res, '500 Internal Error', 'Something went wrong. Please Try again later')
 		return
-	print_headers()
-	result_message_flag = sum([post['rank'] for post in posts])
-	with HTMLtemplate(template_config['archive_template']) as temp:
+	print_headers(res)
+	with HTMLtemplate(template_config['archive_template'], res) as temp:
 		temp.set_insert('<!--message-->')
-		temp.p('Here are the results of your search:' if result_message_flag else 'There weren\'t any relevant posts with your search terms.')
-		if result_message_flag:
+		temp.p('Here are the results of your search:' if posts else 'There weren\'t any relevant posts with your search terms.')
+		if posts:
 			temp.set_insert('<!--results-->')
 			for post in posts:
-				if post['rank'] != 0:
-					temp.li()
-					temp.a('/?p=' + post['url_title'], post['title'])
-					temp.p(post['description'])
-					temp.jump()
+				temp.li()
+				temp.a('/?p=' + post.url_title, post.title)
+				temp.p(post.description)
+				temp.jump()
+
+def search_posts(search_string):
+	"""
+	Returns a list of SearchResults for search_string, best match first, or None if the search failed.
+	Searches the index post.py keeps, or MariaDB if there isn't one.
+	Results are cached under search_key(), searches that found nothing are cached too.
+	"""
+	index = get_search_index()
+	key = search_key(search_string, index is not None)
+	posts = search_cache.get(key)
+	if posts is not None:
+		return posts
+	generation = search_cache.generation
+	if index is not None:
+		posts = index.search(search_string)
+	else:
+		import searchindex
+		sql = SQLcon(sql_config)
+		posts = sql.fetch('search_db', searchindex.SearchResult, search_string)
+		if posts is None:
+			return None
+		posts = [post for post in posts if post.rank != 0]
+	search_cache.put(key, posts, generation)
+	return posts
+
+def search_key(search_string, indexed):
+	"""
+	Returns the key search_string's results are cached under.
+	The index only looks at a search's words, so if indexed, the key is its words, sorted, without stop words,
+	and 'The Python', 'python' and ' PYTHON ' are one entry. MariaDB's WITH QUERY EXPANSION looks at
+	the whole string, so its results are kept under the string as it was typed.
+	"""
+	if not indexed:
+		return ('db', search_string)
+	import searchindex
+	return ('index', ' '.join(sorted(set(searchindex.tokenize(search_string)))))
+
+open_search_index = {'version' : None, 'index' : None}
+
+def get_search_index():
+	"""
+	Returns the SearchIndex in search_config['index_file'], or None if there isn't one.
+	The index is opened again when post.py replaces the file.
+	"""
+	path = search_config['index_file']
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	version = (st.st_ino, st.st_mtime_ns)
+	if version != open_search_index['version']:
+		import searchindex
+		try:
+			index = searchindex.SearchIndex(path)
+		except (OSError, ValueError) as e:
+			log_print("Search index error: {}".format(e))
+			return None
+		open_search_index['index'] = index
+		open_search_index['version'] = version
+	return open_search_index['index']
 
-def serve_email_challenge(fail = False):
+open_limiter = {'path' : None, 'limiter' : None}
+limiter_lock = threading.Lock()
+
+def get_limiter():
+	"""
+	Returns the RateLimiter for limit_config, or None if limits are off or limit_file can't be opened.
+	The file is opened once per process, since closing it would let go of the process' places.
+	"""
+	path = limit_config['limit_file']
+	if path != open_limiter['path']:
+		with limiter_lock:
+			if path != open_limiter['path']:
+				limiter = None
+				if path:
+					import ratelimit
+					try:
+						limiter = ratelimit.RateLimiter(path, limit_config['burst'], limit_config['rate'], limit_config['concurrency'])
+					except (OSError, ValueError) as e:
+						log_print("Rate limit error: {}".format(e))
+				open_limiter['limiter'] = limiter
+				open_limiter['path'] = path
+	return open_limiter['limiter']
+
+def client_address(environ):
+	"""
+	Returns the address a request came from, see forwarded_for in limit_config.
+	"""
+	if limit_config['forwarded_for']:
+		# the proxy adds the address it got the request from at the end, anything before it came from the client
+		forwarded = environ.get('HTTP_X_FORWARDED_FOR', '').split(',')[-1].strip()
+		if forwarded:
+			return forwarded
+	return environ.get('REMOTE_ADDR', '')
+
+def admit(res, environ):
+	"""
+	Checks a request for one of the expensive pages against the limits in limit_config.
+	Returns a function to call once the page is served, or None if the request is over a limit,
+	in which case res is a 429 Too Many Requests.
+	"""
+	limiter = get_limiter()
+	if limiter is None:
+		return lambda: None
+	# a request turned away because too many are being served doesn't use up the client's token
+	place = limiter.enter()
+	if place is None:
+		# places free up as soon as a page is done, so there's no telling when, a second is a fair guess
+		serve_too_many_requests(res, 1)
+		return None
+	wait = limiter.take(client_address(environ))
+	if wait:
+		limiter.leave(place)
+		serve_too_many_requests(res, wait)
+		return None
+	return lambda: limiter.leave(place)
+
+def serve_limited(res, environ, serve, *args):
+	"""
+	Calls serve(res, *args) if the request is within the limits in limit_config, see admit().
+	"""
+	done = admit(res, environ)
+	if done is None:
+		return
+	try:
+		serve(res, *args)
+	finally:
+		done()
+
+open_snapshot = {'version' : None, 'snapshot' : None}
+
+def get_snapshot():
+	"""
+	Returns the Snapshot in snapshot_config['snapshot_file'], or None if there isn't one.
+	The snapshot is opened again when post.py replaces the file. The old one isn't closed,
+	since a page being streamed may still be reading from it, it goes away with its last reference.
+	"""
+	path = snapshot_config['snapshot_file']
+	if not path:
+		return None
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	version = (st.st_ino, st.st_mtime_ns)
+	if version != open_snapshot['version']:
+		import snapshot
+		try:
+			snap = snapshot.Snapshot(path)
+		except (OSError, ValueError) as e:
+			log_print("Snapshot error: {}".format(e))
+			return None
+		open_snapshot['snapshot'] = snap
+		open_snapshot['version'] = version
+	return open_snapshot['snapshot']
+
+class WordList:
+	"""
+	The words for the contact page challenge, one per line in the file at path.
+	The file is memory mapped, and where each word starts and ends is kept in an index file
+	next to it at path + '.index', so picking a word reads one entry of the index and the word
+	instead of going through the whole list, and every word is equally likely to be picked.
+	The index is written the first time the list is used after it changes.
+	"""
+	def __init__(self, path):
+		import mmap
+		with open(path, 'rb') as fh:
+			st = os.fstat(fh.fileno())
+			# an empty file can't be mapped
+			self.data = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ) if st.st_size else b''
+		# word n is data[bounds[2 * n]:bounds[2 * n + 1]]
+		self.bounds = self.load_index(path + '.index', st)
+
+	def load_index(self, index_path, st):
+		"""
+		Returns the index in index_path if it was made from this version of the word list,
+		otherwise makes it again and writes it to index_path.
+		"""
+		import mmap
+		import struct
+		# magic, then the size and modification time of the word list the index was made from
+		header = struct.pack('=4sQq', b'LBWI', st.st_size, st.st_mtime_ns)
+		try:
+			with open(index_path, 'rb') as fh:
+				index = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+			if index[:len(header)] == header and (len(index) - len(header)) % 8 == 0:
+				return memoryview(index)[len(header):].cast('I')
+		except (OSError, ValueError):
+			pass
+		import re
+		bounds = array.array('I', itertools.chain.from_iterable(match.span() for match in re.finditer(rb'\S+', self.data)))
+		try:
+			import tempfile
+			fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(index_path) or '.')
+			try:
+				# post.py and the web server may run as different users, both read it
+				os.fchmod(fd, 0o644)
+				with os.fdopen(fd, 'wb') as fh:
+					fh.write(header)
+					fh.write(bounds.tobytes())
+				os.replace(tmp_path, index_path)
+			except OSError:
+				os.unlink(tmp_path)
+				raise
+		except OSError as e:
+			# the words can still be picked, the index is made again next time
+			log_print("Word list index error: {}".format(e))
+		return bounds
+
+	def __len__(self):
+		return len(self.bounds) // 2
+
+	def choice(self):
+		import random
+		n = random.randrange(len(self))
+		return self.data[self.bounds[2 * n]:self.bounds[2 * n + 1]].decode('utf8')
+
+loaded_wordlist = {'version' : None, 'wordlist' : None}
+
+def get_wordlist():
+	"""
+	Returns the WordList in template_config['wordlist'], reading it again if the file changed.
+	"""
+	path = template_config['wordlist']
+	st = os.stat(path)
+	version = (st.st_ino, st.st_mtime_ns)
+	if version != loaded_wordlist['version']:
+		loaded_wordlist['wordlist'] = WordList(path)
+		loaded_wordlist['version'] = version
+	return loaded_wordlist['wordlist']
+
+def get_challenge_secret():
+	"""
+	Returns the key challenge tokens are signed with, from challenge_config['secret_file'],
+	or None if it can't be read or is shorter than 32 bytes.
+	If the file doesn't exist yet, it's created with a new random key. The key is written to a
+	temporary file first and linked into place, so no process ever reads a half written key.
+	"""
+	if loaded_secret['secret'] is None:
+		path = challenge_config['secret_file']
+		try:
+			if not os.path.exists(path):
+				import tempfile
+				fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path) or '.')
+				try:
+					with os.fdopen(fd, 'wb') as fh:
+						fh.write(os.urandom(32))
+					try:
+						os.link(tmp_path, path)
+					except FileExistsError:
+						# another process made it first, its key is used
+						pass
+				finally:
+					os.unlink(tmp_path)
+			with open(path, 'rb') as fh:
+				secret = fh.read()
+		except OSError as e:
+			log_print("Challenge secret error: {}".format(e))
+			return None
+		if len(secret) < 32:
+			log_print("Challenge secret error: {} holds fewer than 32 bytes".format(path))
+			return None
+		loaded_secret['secret'] = secret
+	return loaded_secret['secret']
+
+loaded_secret = {'secret' : None}
+
+def sign_challenge(word, expires, nonce):
+	import hmac
+	import hashlib
+	message = '{}.{}.{}'.format(expires, nonce, word.lower()).encode('utf8')
+	return hmac.new(get_challenge_secret(), message, hashlib.sha256).hexdigest()[:32]
+
+def make_challenge_token(word):
+	"""
+	Returns a token for the contact form that proves which word was asked for.
+	It looks like '<expiry time>.<random nonce>.<signature>', and doesn't contain the word.
+	"""
+	expires = int(time.time()) + challenge_config['lifetime']
+	nonce = os.urandom(8).hex()
+	return '{}.{}.{}'.format(expires, nonce, sign_challenge(word, expires, nonce))
+
+class UsedNonces:
+	"""
+	Remembers the nonces of challenge tokens that were already answered, until they expire,
+	so each token only gets the email once. At most max_size nonces are kept.
+	This only covers one process, it's used when nonce_file in challenge_config can't be opened.
+	"""
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.nonces = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def use(self, nonce, expires):
+		"""
+		Marks nonce as used. Returns False if it was already used.
+		"""
+		now = time.time()
+		with self.lock:
+			# nonces are kept in the order they were answered, not the order they expire in,
+			# so this only drops expired ones from the front. The rest go once max_size is reached.
+			while self.nonces and next(iter(self.nonces.values())) < now:
+				self.nonces.popitem(last = False)
+			if nonce in self.nonces:
+				return False
+			if len(self.nonces) >= self.max_size:
+				self.nonces.popitem(last = False)
+			self.nonces[nonce] = expires
+			return True
+
+open_nonces = {'path' : None, 'nonces' : None}
+nonces_lock = threading.Lock()
+
+def get_used_nonces():
+	"""
+	Returns the table of answered nonces shared through nonce_file,
+	or one for this process only if the file can't be opened.
+	"""
+	path = challenge_config['nonce_file']
+	if path != open_nonces['path']:
+		with nonces_lock:
+			if path != open_nonces['path']:
+				nonces = None
+				if path:
+					import usednonces
+					try:
+						nonces = usednonces.UsedNonces(path)
+					except (OSError, ValueError) as e:
+						log_print("Nonce file error: {}".format(e))
+				open_nonces['nonces'] = nonces or UsedNonces(challenge_config['max_used'])
+				open_nonces['path'] = path
+	return open_nonces['nonces']
+
+def serve_email_challenge(res, fail = False):
 	"""
 	Prints the default contact page.
 	A user must type in a word randomly selected from a word list to get contact information.
 	This function gets that word and presents it to the user.
+	The word's signed token goes in a hidden field, so nothing needs to be stored.
 	"""
-	sql = SQLcon(sql_config)
-	wordlist_path = template_config['wordlist']
-	random.seed()
-	with open(wordlist_path, 'r') as wordlist:
-		wordlist.seek(random.randrange(os.path.getsize(wordlist_path)))
-		for c in iter(lambda: wordlist.read(1), '\n'):
-			if c == '':
-				wordlist.seek(random.randrange(os.path.getsize(wordlist_path)))
-		word = wordlist.readline()[:-1]	
-	sql.execute('insert_challenge', word, commit = True)	
-	print_headers()
-	with HTMLtemplate(template_config['email_challenge']) as temp:
+	if get_challenge_secret() is None:
+		serve_error(res, '500 Internal Error', 'Something went wrong. Please Try again later')
+		return
+	word = get_wordlist().choice()
+	print_headers(res)
+	with HTMLtemplate(template_config['email_challenge'], res) as temp:
 		temp.set_insert('<!--message-->')
 		if not fail:
 			temp.p("Hi! Thanks for showing interest in contacting me! Unfortunately, the internet is full of spammers, and I don't want my inbox to fall prey to them by directly putting my email on this page, so I created a small 'challenge' that most web crawlers probably won't be able to get past. Just type in the word you see below into the grey box and hit 'Enter', then you should see my email.")
@@ -414,37 +2169,128 @@ def serve_email_challenge(fail = False):
 			temp.p("Sorry, that word wasn't typed in correctly. Please try again.")
 		temp.set_insert('<!--word-->')
 		temp.append_raw(word)
+		temp.set_insert('<!--token-->')
+		temp.append_raw('<input type="hidden" name="token" value="{}" />'.format(make_challenge_token(word)))
 
-def check_email_challenge(challenge_string):
+def check_email_challenge(res, challenge_string, token):
 	"""
 	Checks if the word generated in serve_email_challenge() is valid.
+	The word must match the token's signature, the token can't be expired, and it can only be used once.
 	If it is, print contact info.
 	If not, call serve_email_challenge() again.
 	"""
-	sql = SQLcon(sql_config)
-	res = sql.execute('find_challenge', challenge_string)
-	if res is None:
-		serve_email_challenge(fail = True)
+	if get_challenge_secret() is None:
+		serve_error(res, '500 Internal Error', 'Something went wrong. Please Try again later')
+		return
+	import hmac
+	try:
+		expires, nonce, signature = token.split('.')
+		expires = int(expires)
+	except (AttributeError, ValueError):
+		expires = nonce = signature = None
+	if (
+		expires is None or expires < time.time()
+		or not hmac.compare_digest(signature.encode('utf8'), sign_challenge(challenge_string.strip(), expires, nonce).encode('utf8'))
+		or not get_used_nonces().use(nonce, expires)
+	):
+		serve_email_challenge(res, fail = True)
 		return	
-	sql.execute('delete_challenge', res['challenge_id'], commit = True)
-	print_headers()
-	with HTMLtemplate(template_config['email_success']) as temp:	
+	print_headers(res)
+	with HTMLtemplate(template_config['email_success'], res) as temp:	
 		temp.set_insert('<!--message-->')
 		temp.p('Thank you! My email is below. I hope to hear from you soon!')
 
-def serve_error(http_status, message):
+def serve_file(res, path, mime_type):
+	"""
+	Serves a file post.py wrote, like the feed or the sitemap.
+	Like any other page it's cached until post.py changes something,
+	so the file is only read once per change and is sent with an ETag.
+	"""
+	try:
+		with open(path, 'r', encoding = 'utf8') as fh:
+			text = fh.read()
+			mtime = int(os.fstat(fh.fileno()).st_mtime)
+	except OSError:
+		serve_error(res, '404 Not Found', 'The page you\'re requesting doesn\'t exist.')
+		return
+	print_headers(res, ['Last-Modified: ' + format_http_date(mtime)], mime_type)
+	res.write(text)
+
+def serve_metrics(res):
+	"""
+	Serves the request totals in Prometheus' text format.
+	"""
+	print_headers(res, [], 'text/plain')
+	res.write(metrics_totals.prometheus())
+
+def serve_error(res, http_status, message):
 	"""
 	Prints an error page with http_status and message.
 	"""
 	http_status_header = 'Status: ' + http_status
-	print_headers(headers = [http_status_header])
-	with HTMLtemplate(template_config['post_template']) as temp:
+	print_headers(res, headers = [http_status_header])
+	with HTMLtemplate(template_config['post_template'], res) as temp:
 		temp.set_insert('<!--post-->')
 		temp.h(http_status)
 		temp.p(message)
 
+def serve_too_many_requests(res, wait):
+	"""
+	Makes res a 429 Too Many Requests, telling the client to come back in wait seconds.
+	It's sent to clients that are already asking too much, so it doesn't read a template.
+	"""
+	import math
+	res.status = '429 Too Many Requests'
+	res.headers = [
+		('Content-Type', 'text/plain; charset=utf-8'),
+		('Retry-After', str(max(1, math.ceil(wait))))
+	]
+	res.encoded = b'Too many requests, please try again later.\n'
+
+def serve_cgi():
+	"""
+	Serves one CGI request with application().
+	Does what wsgiref's CGIHandler does for this application, without the imports it needs.
+	"""
+	environ = dict(os.environ)
+	environ.update({
+		'wsgi.input' : sys.stdin.buffer,
+		'wsgi.errors' : sys.stderr,
+		'wsgi.version' : (1, 0),
+		'wsgi.multithread' : False,
+		'wsgi.multiprocess' : True,
+		'wsgi.run_once' : True,
+		'wsgi.url_scheme' : 'https' if environ.get('HTTPS', 'off') in ('on', '1') else 'http'
+	})
+	out = sys.stdout.buffer
+	started = []
+	def start_response(status, headers, exc_info = None):
+		head = 'Status: {}\r\n'.format(status) + ''.join('{}: {}\r\n'.format(name, value) for name, value in headers)
+		out.write((head + '\r\n').encode('latin-1'))
+		started.append(status)
+	try:
+		for chunk in application(environ, start_response):
+			out.write(chunk)
+	except Exception:
+		import traceback
+		traceback.print_exc()
+		if not started:
+			out.write(b'Status: 500 Internal Server Error\r\nContent-Type: text/plain\r\n\r\nA server error occurred.')
+	out.flush()
+
+def main():
+	"""
+	Serves one CGI request, or serves HTTP with --serve [--workers N].
+	A CGI script is compiled every time it runs, so a CGI script that only imports blog
+	and calls this starts faster than blog.py itself, see the README.
+	"""
+	if '--serve' in sys.argv:
+		if '--workers' in sys.argv:
+			serve(workers = int(sys.argv[sys.argv.index('--workers') + 1]))
+		else:
+			serve()
+	else:
+		serve_cgi()
+
 if __name__ == '__main__':
-	# only uncomment the line below if you're testing this application out
-	# if you're going to run this on the internet, leave this line commented
-	#cgitb.enable()
-	handle_request()
+	main()
@@ -15,9 +15,18 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+import os
 import re
 import sys
-import mysql.connector
+import time
+import gzip
+import html
+import datetime
+import concurrent.futures
+# blog.py's templates are used to render the static copy of the blog
+import blog
+import searchindex
+import snapshot
 
 help_str = """
 To create a new post:				
@@ -26,6 +35,29 @@ To create a new post:
 To update a currently existing post:
 	./post -u <url> [-title <title>] [-url <url>] [-date <YYYY-MM-DD>] [-desc <description>] [-text <mml file>]
 
+To render every post into a directory of static pages:
+	./post -b [<directory>]
+
+To rebuild the search index from every post:
+	./post -s
+
+To write the snapshot of every post blog.py reads from:
+	./post -snapshot
+
+To write the Atom feed and sitemap again:
+	./post -feeds
+
+To write the index of the contact page word list, next to it at <wordlist>.index:
+	./post -wordlist
+
+To create or update many posts at once:
+	./post -bulk <manifest file>
+The manifest has one post per line: <url title>	<title>	<description>	<mml file>	[<YYYY-MM-DD>], separated by tabs.
+Posts whose url title already exists are updated, the rest are created. Lines starting with # are skipped.
+
+To render the text of existing posts again from a directory of <url title>.mml files:
+	./post -bulk <directory>
+
 To print an mml file converted to html to stdout:
 	./post -p <mml file>
 
@@ -41,6 +73,45 @@ sql_config = {
 	'raise_on_warnings' : True
 }
 
+# blog.py caches rendered pages until version_file changes.
+# It must be the same path as version_file in blog.py's cache_config.
+# search_index must be the same path as index_file in blog.py's search_config,
+# and snapshot_file the same as snapshot_file in blog.py's snapshot_config.
+publish_config = {
+	'version_file' : '/var/www/lightblog.version',
+	'search_index' : '/var/www/lightblog.search',
+	'snapshot_file' : '/var/www/lightblog.snapshot'
+}
+
+# post.py writes an Atom feed of the newest posts and a sitemap of every post whenever posts change.
+# feed_file and sitemap_file must be the same paths as in blog.py's feed_config.
+# site_url is where the blog is, like 'https://www.example.com'. No feeds are written until it's set.
+feed_config = {
+	'feed_file' : '/var/www/lightblog.atom',
+	'sitemap_file' : '/var/www/lightblog.sitemap',
+	'site_url' : '',
+	'title' : 'LightBlog',
+	# posts in the feed
+	'entries' : 20
+}
+
+# post.py can keep a static copy of the blog that the web server serves as plain files.
+# When output_dir is set, -i and -u re-render the pages they affect.
+# Searching and the contact page are still served by blog.py.
+static_config = {
+	'output_dir' : ''
+}
+
+# -bulk converts files in worker processes and writes batch_size posts per transaction.
+# workers = None uses one process per cpu.
+bulk_config = {
+	'workers' : None,
+	'batch_size' : 200
+}
+
+# every statement post.py runs goes over this one connection
+connection = {'con' : None}
+
 def sanitize(line):
 	"""
 	Escape HTML characters like '<'.
@@ -54,77 +125,80 @@ def sanitize(line):
 	line = line.replace("\t", '    ')
 	return line
 
+def is_reserved(url):
+	"""
+	Whether url is the name of one of blog.py's own pages, like ?p=feed.
+	blog.py would serve that page instead of a post with this url title.
+	"""
+	return url in blog.named_routes
+
+def reserved_message(url):
+	return "{} is reserved for blog.py's own pages ({}), pick another url title".format(url, ', '.join(sorted(blog.named_routes)))
+
+# line level elements, applied in this order
+inline_patterns = (
+	(re.compile(r'{l\|([^{}]+)}([^{}]+){l}'), r'<a href="\1">\2</a>'),
+	(re.compile(r'{im\|([^{}]+)}([^{}]+){im}'), r'<img src="\1" alt="\2" />'),
+	(re.compile(r'{i}([^{}]+){i}'), r'<i>\1</i>'),
+	(re.compile(r'{b}([^{}]+){b}'), r'<b>\1</b>'),
+	(re.compile(r'{ic}([^{}]+){ic}'), r'<span class="inline-code">\1</span>'),
+)
+
+# block level elements: the HTML they open and close with, whether their lines can have
+# line level elements, and the tag each of their lines is wrapped in
+block_tags = {
+	'{p}' : ('<p>\n', '</p>\n', True, None),
+	'{c}' : ('<div class="code"><code><pre class="code-font">\n', '</pre></code></div>\n', False, None),
+	'{h}' : ('<h3>\n', '</h3>\n', False, None),
+	'{l}' : ('<ul>\n', '</ul>\n', True, 'li'),
+}
+
 def convert_inline(line):
 	"""
 	Convert a line with {l}, {im}, {i}, {b}, {ic} elements into HTML elements.
 	"""
-	link_re = re.search('{l\|([^{}]+)}([^{}]+){l}', line)
-	img_re = re.search('{im\|([^{}]+)}([^{}]+){im}', line)
-	if link_re:
-		line = re.sub(link_re.re, 
-					  lambda x: ''.join(['<a href="', x.group(1), '">', x.group(2), '</a>']),
-					  line)
-	if img_re:
-		line = re.sub(img_re.re, 
-					  lambda x: ''.join(['<img src="', x.group(1), '" alt="', x.group(2), '" />']),
-					  line)
-	for tag in ('i', 'b', 'ic'):
-		match = re.search('{' + tag + '}([^{}]+){' + tag + '}', line)
-		if match:
-			if tag == 'ic':
-				line = re.sub(match.re, 
-							  lambda x: ''.join(['<span class="inline-code">', x.group(1), '</span>']), 
-							  line)
-			else:
-				line = re.sub(match.re, 
-							  lambda x: ''.join(['<', tag, '>', x.group(1), '</', tag, '>']), 
-							  line)
+	if '{' not in line:
+		return line
+	for pattern, replacement in inline_patterns:
+		line = pattern.sub(replacement, line)
 	return line
 
 def convert_block(file_handler, close_tag = None, inline = False, enclose = None):
 	"""
 	Convert a block level element ({p}, {c}, {h}, {l}) into HTML.
+	Called with only a file, it converts every block in the file.
+	The file is read once, line by line, and the HTML is joined together at the end.
 	"""
-	out_html = str()
+	out_html = []
 	if close_tag is not None:
-		found_close_tag = False
-		for line in file_handler:
-			if re.match('^' + close_tag + '$', line):
-				found_close_tag = True
-				break
-			if inline:
-				line = sanitize(line)
-				if enclose is None:
-					out_html += convert_inline(line)
-				else: 
-					out_html += ''.join(['<', enclose, '>', convert_inline(line)[:-1], '</', enclose, '>\n'])
-			else:
-				line = sanitize(line)
-				out_html += line
-		if not found_close_tag:
-			print("Could not find corresponding close tag to " + close_tag, file = sys.stderr)
-			file_handler.close()
-			exit(1)
-		return out_html
+		convert_lines(file_handler, out_html, close_tag, inline, enclose)
 	else:
 		for line in file_handler:
-			if re.match('{p}', line):
-				out_html += '<p>\n'
-				out_html += convert_block(file_handler, close_tag = '{p}', inline = True)
-				out_html += '</p>\n'
-			elif re.match('{c}', line):
-				out_html += '<div class="code"><code><pre class="code-font">\n'
-				out_html += convert_block(file_handler, close_tag = '{c}')
-				out_html += '</pre></code></div>\n'
-			elif re.match('{h}', line):
-				out_html += '<h3>\n'
-				out_html += convert_block(file_handler, close_tag = '{h}')
-				out_html += '</h3>\n'
-			elif re.match('{l}', line):
-				out_html += '<ul>\n'
-				out_html += convert_block(file_handler, close_tag = '{l}', inline = True, enclose = 'li')
-				out_html += '</ul>\n'
-		return out_html
+			block = block_tags.get(line[:3])
+			if block is not None:
+				open_html, close_html, block_inline, block_enclose = block
+				out_html.append(open_html)
+				convert_lines(file_handler, out_html, line[:3], block_inline, block_enclose)
+				out_html.append(close_html)
+	return ''.join(out_html)
+
+def convert_lines(file_handler, out_html, close_tag, inline, enclose):
+	"""
+	Converts the lines of one block into out_html, up to the line with just close_tag on it.
+	"""
+	for line in file_handler:
+		if line == close_tag + '\n' or line == close_tag:
+			return
+		line = sanitize(line)
+		if not inline:
+			out_html.append(line)
+		elif enclose is None:
+			out_html.append(convert_inline(line))
+		else:
+			out_html.extend(('<', enclose, '>', convert_inline(line)[:-1], '</', enclose, '>\n'))
+	print("Could not find corresponding close tag to " + close_tag, file = sys.stderr)
+	file_handler.close()
+	exit(1)
 
 def setup_and_execute(query, *parameters, commit = False):
 	"""
@@ -132,19 +206,480 @@ def setup_and_execute(query, *parameters, commit = False):
 	Call with commit = True to alter data.
 	"""
 	try:
-		con = mysql.connector.connect(**sql_config)
+		con = get_connection()
 		cur = con.cursor(prepared = True)
-		cur.execute(query, parameters)
-		if not commit:
-			return cur.fetchone()
+		try:
+			cur.execute(query, parameters)
+			if not commit:
+				return cur.fetchone()
+			else:
+				con.commit()
+				return
+		finally:
+			cur.close()
+	except mysql.connector.Error as e:
+		print("SQL Error: {}".format(e), file = sys.stderr)
+		sys.exit(1)
+
+def get_connection():
+	"""
+	Returns post.py's connection to the database, connecting the first time it is called.
+	mysql.connector is imported here, so post.py can be imported without it.
+	"""
+	if connection['con'] is None:
+		global mysql
+		import mysql.connector
+		connection['con'] = mysql.connector.connect(**sql_config)
+	return connection['con']
+
+def publish_changes(changed = None):
+	"""
+	Updates everything made from the posts after they changed, then tells blog.py with bump_version().
+	changed is a list of the url titles that were changed, and is passed on to build_static().
+	"""
+	if static_config['output_dir']:
+		build_static(static_config['output_dir'], changed)
+	update_search_index(changed)
+	write_snapshot()
+	write_feeds()
+	bump_version()
+
+def bump_version():
+	"""
+	Tells blog.py that posts changed by rewriting the version file.
+	The file is replaced rather than written in place, so blog.py never sees it half written.
+	"""
+	path = publish_config['version_file']
+	tmp_path = path + '.tmp'
+	try:
+		with open(tmp_path, 'w') as fh:
+			fh.write(str(time.time_ns()) + '\n')
+		os.replace(tmp_path, path)
+	except OSError as e:
+		print("Could not update {}: {}".format(path, e), file = sys.stderr)
+		print("blog.py may keep serving old pages until it is restarted.", file = sys.stderr)
+
+def get_post_order(cur):
+	"""
+	Returns the url title, title, description, last update time, date and id of every post, newest first.
+	The rows are in the same order as blog.ArchiveEntry's fields.
+	This has to be the same order blog.py uses for its previous and next links.
+	"""
+	cur.execute("SELECT url_title, title, description, UNIX_TIMESTAMP(updated_at), post_date, post_id FROM blog_posts ORDER BY post_date DESC, post_id DESC;")
+	return [tuple(blog.to_utf8(field) for field in row) for row in cur.fetchall()]
+
+def get_neighbours(order, url):
+	"""
+	Returns url along with the url titles of the posts before and after it in order.
+	"""
+	urls = [row[0] for row in order]
+	if url not in urls:
+		return []
+	offset = urls.index(url)
+	return urls[max(offset - 1, 0):offset + 2]
+
+def get_all_neighbours(order, urls):
+	"""
+	Like get_neighbours(), but for a list of url titles at once. Returns a set.
+	"""
+	offsets = {row[0] : offset for offset, row in enumerate(order)}
+	neighbours = set()
+	for url in urls:
+		if url in offsets:
+			offset = offsets[url]
+			neighbours.update(row[0] for row in order[max(offset - 1, 0):offset + 2])
+	return neighbours
+
+def touch_posts(urls):
+	"""
+	Sets updated_at to now for the posts in urls.
+	A post's page links to the posts before and after it, so when those change
+	its page changes too, and blog.py's Last-Modified header has to say so.
+	"""
+	try:
+		con = get_connection()
+		cur = con.cursor()
+		cur.executemany("UPDATE blog_posts SET updated_at = NOW() WHERE url_title = %s;", [(url,) for url in urls])
+		con.commit()
+		cur.close()
+	except mysql.connector.Error as e:
+		print("SQL Error: {}".format(e), file = sys.stderr)
+		sys.exit(1)
+
+def write_static(out_dir, name, page):
+	"""
+	Writes page to out_dir/name through a temporary file,
+	so the web server never sends a half written page.
+	Compressed copies are written next to it as name.gz, and name.br if brotli is installed,
+	for web servers that can send them as they are (nginx's gzip_static and brotli_static).
+	"""
+	copies = [(name, page), (name + '.gz', gzip.compress(page, 9, mtime = 0))]
+	try:
+		import brotli
+		copies.append((name + '.br', brotli.compress(page)))
+	except ImportError:
+		pass
+	for copy_name, data in copies:
+		path = os.path.join(out_dir, copy_name)
+		with open(path + '.tmp', 'wb') as fh:
+			fh.write(data)
+		os.replace(path + '.tmp', path)
+
+def remove_static(out_dir, name):
+	"""
+	Removes out_dir/name and its compressed copies.
+	"""
+	for copy_name in (name, name + '.gz', name + '.br'):
+		path = os.path.join(out_dir, copy_name)
+		if os.path.exists(path):
+			os.remove(path)
+
+def build_static(out_dir, changed = None):
+	"""
+	Renders the blog into out_dir with blog.py's templates:
+	the newest post as index.html, every post as p/<url title>.html and the archive as archive.html.
+	If changed is a list of url titles, only those posts, their neighbours, index.html and archive.html are rendered.
+	Otherwise everything is rendered and pages of posts that no longer exist are removed.
+	"""
+	try:
+		cur = get_connection().cursor(prepared = True)
+		order = get_post_order(cur)
+		urls = [row[0] for row in order]
+		if changed is None:
+			targets = set(urls)
+		else:
+			targets = set()
+			for url in changed:
+				targets.update(get_neighbours(order, url))
+		os.makedirs(os.path.join(out_dir, 'p'), exist_ok = True)
+		for offset, url in enumerate(urls):
+			if url not in targets and offset != 0:
+				continue
+			cur.execute("SELECT post_id, title, url_title, post_date, text, UNIX_TIMESTAMP(updated_at) FROM blog_posts WHERE url_title = %s;", (url,))
+			prev_url = urls[offset - 1] if offset != 0 else None
+			next_url = urls[offset + 1] if offset != len(urls) - 1 else None
+			post = blog.PostPage(*map(blog.to_utf8, cur.fetchall()[0]), prev_url, next_url)
+			res = blog.Response()
+			blog.render_post(res, post)
+			if url in targets:
+				write_static(out_dir, os.path.join('p', url + '.html'), res.body())
+			if offset == 0:
+				write_static(out_dir, 'index.html', res.body())
+		# only the first page of the archive is static, the cursors of the rest are endless
+		page_size = blog.archive_config['page_size']
+		posts = [blog.ArchiveEntry._make(row) for row in order[:page_size + 1]]
+		older = blog.archive_cursor(posts[page_size - 1]) if len(posts) > page_size else None
+		res = blog.Response()
+		blog.render_archive(res, posts[:page_size], older = older)
+		write_static(out_dir, 'archive.html', res.body())
+		if changed is None:
+			for name in os.listdir(os.path.join(out_dir, 'p')):
+				if name.endswith('.html') and name[:-5] not in targets:
+					remove_static(out_dir, os.path.join('p', name))
+		cur.close()
+	except mysql.connector.Error as e:
+		print("SQL Error: {}".format(e), file = sys.stderr)
+		sys.exit(1)
+
+def update_search_index(changed = None):
+	"""
+	Re-indexes the posts in changed, a list of url titles, in the search index blog.py uses.
+	If changed is None, or there is no index yet, every post is indexed.
+	"""
+	path = publish_config['search_index']
+	if not path:
+		return
+	try:
+		cur = get_connection().cursor(prepared = True)
+		select = "SELECT post_id, url_title, title, description, text FROM blog_posts"
+		if changed is None or not os.path.exists(path):
+			cur.execute(select + ";")
+			searchindex.build_index(path, [tuple(map(blog.to_utf8, row)) for row in cur.fetchall()])
 		else:
+			rows = []
+			for url in set(changed):
+				cur.execute(select + " WHERE url_title = %s;", (url,))
+				rows.extend(tuple(map(blog.to_utf8, row)) for row in cur.fetchall())
+			searchindex.update_index(path, rows)
+		cur.close()
+	except mysql.connector.Error as e:
+		print("SQL Error: {}".format(e), file = sys.stderr)
+		sys.exit(1)
+	except (OSError, ValueError) as e:
+		print("Could not update the search index {}: {}".format(path, e), file = sys.stderr)
+		print("Run post.py -s to rebuild it.", file = sys.stderr)
+
+def write_snapshot():
+	"""
+	Writes every post to the snapshot blog.py serves posts and the archive from.
+	"""
+	path = publish_config['snapshot_file']
+	if not path:
+		return
+	try:
+		cur = get_connection().cursor(prepared = True)
+		cur.execute("SELECT post_id, url_title, title, post_date, UNIX_TIMESTAMP(updated_at), description, text FROM blog_posts;")
+		rows = [tuple(map(blog.to_utf8, row)) for row in cur.fetchall()]
+		cur.close()
+	except mysql.connector.Error as e:
+		print("SQL Error: {}".format(e), file = sys.stderr)
+		sys.exit(1)
+	try:
+		snapshot.write_snapshot(path, rows)
+	except OSError as e:
+		print("Could not write the snapshot {}: {}".format(path, e), file = sys.stderr)
+		print("blog.py will serve the old one until post.py -snapshot succeeds.", file = sys.stderr)
+
+def atom_date(timestamp):
+	return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+def make_feed(posts, site_url):
+	"""
+	Returns an Atom feed of posts, a list of (url title, title, description, text, last update time).
+	Titles and descriptions are already escaped by sanitize(), so everything goes in as html.
+	"""
+	escape = lambda text: html.escape(text, quote = False)
+	out = [
+		'<?xml version="1.0" encoding="utf-8"?>',
+		'<feed xmlns="http://www.w3.org/2005/Atom">',
+		'<title type="html">{}</title>'.format(escape(feed_config['title'])),
+		'<link href="{}/" />'.format(site_url),
+		'<link rel="self" href="{}/?p=feed" />'.format(site_url),
+		'<id>{}/</id>'.format(site_url),
+		'<updated>{}</updated>'.format(atom_date(max((post[4] for post in posts), default = 0)))
+	]
+	for url, title, description, text, updated_at in posts:
+		out += [
+			'<entry>',
+			'<title type="html">{}</title>'.format(escape(title)),
+			'<link href="{}/?p={}" />'.format(site_url, url),
+			'<id>{}/?p={}</id>'.format(site_url, url),
+			'<updated>{}</updated>'.format(atom_date(updated_at)),
+			'<summary type="html">{}</summary>'.format(escape(description)),
+			'<content type="html">{}</content>'.format(escape(text)),
+			'</entry>'
+		]
+	out.append('</feed>')
+	return '\n'.join(out) + '\n'
+
+def make_sitemap(order, site_url):
+	"""
+	Returns a sitemap of the home page, the archive and every post in order, from get_post_order().
+	Sitemaps are limited to 50,000 urls, which is plenty for one person's blog.
+	"""
+	out = [
+		'<?xml version="1.0" encoding="utf-8"?>',
+		'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+	]
+	newest = atom_date(max((row[3] for row in order), default = 0))
+	for url, lastmod in (('/', newest), ('/?p=archive', newest)):
+		out.append('<url><loc>{}{}</loc><lastmod>{}</lastmod></url>'.format(site_url, url, lastmod))
+	for row in order:
+		out.append('<url><loc>{}/?p={}</loc><lastmod>{}</lastmod></url>'.format(site_url, row[0], atom_date(row[3])))
+	out.append('</urlset>')
+	return '\n'.join(out) + '\n'
+
+def write_feeds():
+	"""
+	Writes the Atom feed and sitemap blog.py serves, and copies them into the static copy if there is one.
+	Does nothing if site_url isn't set in feed_config.
+	"""
+	site_url = feed_config['site_url'].rstrip('/')
+	if not site_url:
+		return
+	try:
+		cur = get_connection().cursor(prepared = True)
+		order = get_post_order(cur)
+		cur.execute(
+			"SELECT url_title, title, description, text, UNIX_TIMESTAMP(updated_at) FROM blog_posts ORDER BY post_date DESC, post_id DESC LIMIT %s;",
+			(feed_config['entries'],)
+		)
+		posts = [tuple(map(blog.to_utf8, row)) for row in cur.fetchall()]
+		cur.close()
+	except mysql.connector.Error as e:
+		print("SQL Error: {}".format(e), file = sys.stderr)
+		sys.exit(1)
+	feeds = (
+		(feed_config['feed_file'], 'feed.xml', make_feed(posts, site_url)),
+		(feed_config['sitemap_file'], 'sitemap.xml', make_sitemap(order, site_url))
+	)
+	for path, static_name, text in feeds:
+		try:
+			with open(path + '.tmp', 'w', encoding = 'utf8') as fh:
+				fh.write(text)
+			os.replace(path + '.tmp', path)
+			if static_config['output_dir']:
+				write_static(static_config['output_dir'], static_name, text.encode('utf8'))
+		except OSError as e:
+			print("Could not write {}: {}".format(path, e), file = sys.stderr)
+
+def find_neighbours(url):
+	"""
+	Returns url along with the url titles of the posts before and after it.
+	Used before a post is updated, since its old neighbours' pages link to it.
+	"""
+	try:
+		cur = get_connection().cursor(prepared = True)
+		try:
+			return get_neighbours(get_post_order(cur), url)
+		finally:
+			cur.close()
+	except mysql.connector.Error as e:
+		print("SQL Error: {}".format(e), file = sys.stderr)
+		sys.exit(1)
+
+def convert_file(path):
+	"""
+	Converts one mml file for bulk_import(), in a worker process.
+	Returns the html, or raises ValueError if the file couldn't be converted.
+	"""
+	try:
+		with open(path, 'r') as fh:
+			return convert_block(fh)
+	except OSError as e:
+		raise ValueError(e.strerror)
+	except SystemExit:
+		# convert_block() has already printed why
+		raise ValueError("could not be converted")
+
+def read_manifest(path):
+	"""
+	Reads a -bulk manifest. Returns a list of (url title, title, description, mml file, date or None)
+	and a list of (line, reason) for the lines that couldn't be read.
+	mml files are relative to the manifest's directory.
+	"""
+	entries = []
+	failures = []
+	base = os.path.dirname(path)
+	with open(path, 'r') as fh:
+		for number, line in enumerate(fh, 1):
+			line = line.rstrip('\n')
+			if not line.strip() or line.startswith('#'):
+				continue
+			name = "{} line {}".format(path, number)
+			fields = line.split('\t')
+			if len(fields) not in (4, 5):
+				failures.append((name, "expected 4 or 5 tab separated fields, found {}".format(len(fields))))
+				continue
+			date = None
+			if len(fields) == 5:
+				try:
+					date = datetime.date.fromisoformat(fields[4].strip())
+				except ValueError:
+					failures.append((name, "bad date {}".format(fields[4])))
+					continue
+			url, title, desc = (sanitize(field.strip()) for field in fields[:3])
+			entries.append((url, title, desc, os.path.join(base, fields[3].strip()), date))
+	return entries, failures
+
+def write_batches(con, query, rows, names, failures, is_written = None):
+	"""
+	Runs query once for every row in rows, batch_size rows to a transaction.
+	If a batch fails, its rows are run again one at a time so that only the bad rows are lost.
+	The table isn't transactional, so part of a failed batch may already be written;
+	is_written(row) is asked before a row is run again, if given.
+	names[i] is what rows[i] is called in failures. Returns the number of rows written.
+	"""
+	written = 0
+	size = bulk_config['batch_size']
+	cur = con.cursor()
+	for start in range(0, len(rows), size):
+		batch = rows[start:start + size]
+		try:
+			cur.executemany(query, batch)
 			con.commit()
-			return
+			written += len(batch)
+		except mysql.connector.Error:
+			con.rollback()
+			for row, name in zip(batch, names[start:start + size]):
+				if is_written is not None and is_written(row):
+					written += 1
+					continue
+				try:
+					cur.execute(query, row)
+					con.commit()
+					written += 1
+				except mysql.connector.Error as e:
+					con.rollback()
+					failures.append((name, "SQL Error: {}".format(e)))
+	cur.close()
+	return written
+
+def bulk_import(path):
+	"""
+	Creates or updates the posts in a manifest, or renders the text of existing posts again
+	from a directory of <url title>.mml files. Files are converted in parallel and written
+	over one connection in batches. A file that fails is reported and the rest carry on.
+	Returns True if every post was written.
+	"""
+	if os.path.isdir(path):
+		names = sorted(name for name in os.listdir(path) if name.endswith('.mml'))
+		entries = [(name[:-4], None, None, os.path.join(path, name), None) for name in names]
+		failures = []
+	else:
+		try:
+			entries, failures = read_manifest(path)
+		except OSError as e:
+			print("Could not read {}: {}".format(path, e.strerror), file = sys.stderr)
+			return False
+	with concurrent.futures.ProcessPoolExecutor(bulk_config['workers']) as pool:
+		futures = [pool.submit(convert_file, entry[3]) for entry in entries]
+		texts = []
+		for entry, future in zip(entries, futures):
+			try:
+				texts.append(future.result())
+			except ValueError as e:
+				texts.append(None)
+				failures.append((entry[3], str(e)))
+	try:
+		con = get_connection()
+		cur = con.cursor()
+		cur.execute("SELECT url_title, post_id FROM blog_posts;")
+		post_ids = {blog.to_utf8(url): post_id for url, post_id in cur.fetchall()}
+		order = get_post_order(cur)
+		cur.close()
+		updates, update_names = [], []
+		inserts, insert_names = [], []
+		for (url, title, desc, mml, date), text in zip(entries, texts):
+			if text is None:
+				continue
+			if url in post_ids:
+				if title is None:
+					updates.append((text, post_ids[url]))
+				else:
+					updates.append((title, desc, text, date, post_ids[url]))
+				update_names.append(mml)
+			elif title is None:
+				failures.append((mml, "there is no post with the url title {}".format(url)))
+			elif is_reserved(url):
+				failures.append((mml, reserved_message(url)))
+			else:
+				inserts.append((title, url, date or datetime.date.today(), desc, text))
+				insert_names.append(mml)
+		if os.path.isdir(path):
+			update = "UPDATE blog_posts SET text = %s WHERE post_id = %s;"
+		else:
+			update = "UPDATE blog_posts SET title = %s, description = %s, text = %s, post_date = COALESCE(%s, post_date) WHERE post_id = %s;"
+		updated = write_batches(con, update, updates, update_names, failures)
+		def is_inserted(row):
+			return setup_and_execute("SELECT post_id FROM blog_posts WHERE url_title = %s;", row[1]) is not None
+		inserted = write_batches(con, "INSERT INTO blog_posts(title, url_title, post_date, description, text) VALUES(%s,%s,%s,%s,%s);", inserts, insert_names, failures, is_inserted)
+		if not os.path.isdir(path):
+			# new and re-dated posts change which posts link to which
+			urls = [entry[0] for entry in entries]
+			cur = con.cursor()
+			touch = get_all_neighbours(order, urls) | get_all_neighbours(get_post_order(cur), urls)
+			cur.close()
+			touch_posts(touch - set(urls))
 	except mysql.connector.Error as e:
 		print("SQL Error: {}".format(e), file = sys.stderr)
 		sys.exit(1)
-	finally:
-		con.close()
+	for name, reason in failures:
+		print("{}: {}".format(name, reason), file = sys.stderr)
+	print("{} posts updated, {} created, {} failed".format(updated, inserted, len(failures)))
+	if updated or inserted:
+		publish_changes()
+	return not failures
 
 if __name__ == '__main__':
 	# create a new post. 
@@ -154,9 +689,15 @@ if __name__ == '__main__':
 			url = sanitize(sys.argv[sys.argv.index('-url') + 1])
 			desc = sanitize(sys.argv[sys.argv.index('-desc') + 1])
 			mml = sys.argv[sys.argv.index('-f') + 1]
+			if is_reserved(url):
+				print(reserved_message(url), file = sys.stderr)
+				sys.exit(1)
 			with open(mml, 'r') as fh:
 				text = convert_block(fh)
 			setup_and_execute("INSERT INTO blog_posts(title, url_title, post_date, description, text) VALUES(%s,%s,CURDATE(),%s,%s);", title, url, desc,text, commit = True)
+			# the posts next to the new one link to it now
+			touch_posts([neighbour for neighbour in find_neighbours(url) if neighbour != url])
+			publish_changes([url])
 		except (ValueError, IndexError) as e:
 			if isinstance(e, ValueError):	
 				print(e, file = sys.stderr)
@@ -177,24 +718,78 @@ if __name__ == '__main__':
 		except IndexError:
 			print("No url title provided", file = sys.stderr)
 			exit(1)
+		# the pages that linked to this post need to be rendered again if it moves
+		changed = find_neighbours(url)
 		try:
+			if '-url' in sys.argv and is_reserved(sanitize(sys.argv[sys.argv.index('-url') + 1])):
+				print(reserved_message(sys.argv[sys.argv.index('-url') + 1]), file = sys.stderr)
+				sys.exit(1)
 			fields = {
-				"-title" : "UPDATE blog_posts SET title = %s WHERE post_id = %s;",
-				"-url"   : "UPDATE blog_posts SET url_title = %s WHERE post_id = %s;",
-				"-date"  : "UPDATE blog_posts SET post_date = %s WHERE post_id = %s;",
-				"-desc"  : "UPDATE blog_posts SET description = %s WHERE post_id = %s;",
-				"-text"  : "UPDATE blog_posts SET text = %s WHERE post_id = %s;"
+				"-title" : "title",
+				"-url"   : "url_title",
+				"-date"  : "post_date",
+				"-desc"  : "description",
+				"-text"  : "text"
 			}
+			# every field given is set by a single UPDATE
+			columns = []
+			values = []
 			for field in fields.keys():
 				if field in sys.argv:
 					if field == '-text':
 						with open(sys.argv[sys.argv.index(field) + 1], 'r') as fh:
-							setup_and_execute(fields[field], convert_block(fh), post_id, commit = True)
+							values.append(convert_block(fh))
 					else:
-						setup_and_execute(fields[field], sanitize(sys.argv[sys.argv.index(field) + 1]), post_id, commit = True)
+						values.append(sanitize(sys.argv[sys.argv.index(field) + 1]))
+					columns.append(fields[field] + " = %s")
+			if columns:
+				setup_and_execute("UPDATE blog_posts SET " + ", ".join(columns) + " WHERE post_id = %s;", *values, post_id, commit = True)
+			new_url = url
+			if '-url' in sys.argv:
+				new_url = sanitize(sys.argv[sys.argv.index('-url') + 1])
+				if static_config['output_dir'] and new_url != url:
+					remove_static(static_config['output_dir'], os.path.join('p', url + '.html'))
+				changed.append(new_url)
+			# the old and new neighbours' links changed if the post was moved or renamed
+			touch_posts([neighbour for neighbour in set(changed + find_neighbours(new_url)) if neighbour not in (url, new_url)])
+			publish_changes(changed)
 		except IndexError:
 			print("A field was not populated", file = sys.stderr)
 			exit(1)
+	# create or re-render many posts at once
+	elif '-bulk' in sys.argv:
+		try:
+			path = sys.argv[sys.argv.index('-bulk') + 1]
+		except IndexError:
+			print("No manifest or directory provided", file = sys.stderr)
+			exit(1)
+		if not bulk_import(path):
+			exit(1)
+	# render the whole blog into static pages
+	elif '-b' in sys.argv:
+		offset = sys.argv.index('-b') + 1
+		out_dir = sys.argv[offset] if offset < len(sys.argv) else static_config['output_dir']
+		if not out_dir:
+			print("No output directory provided, and output_dir isn't set in static_config", file = sys.stderr)
+			exit(1)
+		build_static(out_dir)
+	# index every post for searching
+	elif '-s' in sys.argv:
+		update_search_index()
+	# write every post to the snapshot
+	elif '-snapshot' in sys.argv:
+		write_snapshot()
+		bump_version()
+	# write the feed and sitemap
+	elif '-feeds' in sys.argv:
+		if not feed_config['site_url']:
+			print("Set site_url in feed_config first", file = sys.stderr)
+			exit(1)
+		write_feeds()
+		bump_version()
+	# index the contact page word list, blog.py writes it too if it can
+	elif '-wordlist' in sys.argv:
+		blog.WordList(blog.template_config['wordlist'])
 	# print a converted mml file to stdout
 	elif '-p' in sys.argv:
 		try:
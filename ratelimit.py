@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Limits how often each client can use the expensive pages, and how many of them are served at once.
+
+Every CGI process and worker opens the same file and memory maps it, so the limits hold for
+all of them together. The file is laid out as:
+	header		magic, number of slots
+	slots		for every slot: hash of a client's address, tokens left and when they were counted
+Each client gets a token bucket in the slot its address hashes to. A request takes a token,
+and tokens come back at rate per second, up to burst. Two clients with the same slot share it
+until one of them pushes the other out, which gives the other a full bucket.
+
+The number of requests served at once is limited with fcntl locks on bytes past the end of the
+slots, one byte for each request that can be served. The system lets go of a process' locks when
+it exits, so a CGI process that dies while serving a request doesn't keep its place.
+"""
+import os
+import mmap
+import time
+import fcntl
+import struct
+import zlib
+import threading
+
+MAGIC = b'LBRL'
+# magic, slot count
+HEADER = struct.Struct('=4sI')
+# address hash, tokens, time
+SLOT = struct.Struct('=Qdd')
+
+class RateLimiter:
+	"""
+	The shared limits in the file at path, which is made if it doesn't exist.
+	Each client can make burst requests at once, and rate more every second after that.
+	At most concurrency requests are served at once, 0 doesn't limit them.
+	"""
+	def __init__(self, path, burst, rate, concurrency, slot_count = 4096):
+		self.burst = burst
+		self.rate = rate
+		self.concurrency = concurrency
+		self.slot_count = slot_count
+		size = HEADER.size + SLOT.size * slot_count
+		self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			# the first process to open the file sets it up, the rest wait for it
+			fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+			if os.fstat(self.fd).st_size == 0:
+				os.ftruncate(self.fd, size)
+				os.pwrite(self.fd, HEADER.pack(MAGIC, slot_count), 0)
+			fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+			# other processes may have it mapped, so a file that doesn't match is left alone
+			if os.fstat(self.fd).st_size != size or os.pread(self.fd, HEADER.size, 0) != HEADER.pack(MAGIC, slot_count):
+				raise ValueError('{} is not a rate limit file with {} slots, delete it to start over'.format(path, slot_count))
+			self.map = mmap.mmap(self.fd, size)
+		except (OSError, ValueError):
+			os.close(self.fd)
+			raise
+		self.places_start = size
+		# places taken by this process, fcntl locks don't keep its threads from taking the same one
+		self.taken = set()
+		self.lock = threading.Lock()
+
+	def take(self, client):
+		"""
+		Takes a token from client's bucket. Returns 0 if there was one, or else the
+		number of seconds until there will be one.
+		"""
+		key_hash = zlib.crc32(client.encode('utf8'))
+		slot = HEADER.size + SLOT.size * (key_hash % self.slot_count)
+		with self.lock:
+			fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, 0)
+			try:
+				found_hash, tokens, counted = SLOT.unpack_from(self.map, slot)
+				now = time.time()
+				if found_hash != key_hash:
+					tokens = self.burst
+				else:
+					# a clock that went back counts as no time passing
+					tokens = min(self.burst, tokens + max(0, now - counted) * self.rate)
+				wait = 0
+				if tokens >= 1:
+					tokens -= 1
+				else:
+					wait = (1 - tokens) / self.rate if self.rate > 0 else 3600
+				SLOT.pack_into(self.map, slot, key_hash, tokens, now)
+			finally:
+				fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, 0)
+		return wait
+
+	def enter(self):
+		"""
+		Takes one of the places for requests being served. Returns the place, to be given
+		back with leave() when the request is done, or None if they're all taken.
+		"""
+		if self.concurrency <= 0:
+			return -1
+		with self.lock:
+			for place in range(self.concurrency):
+				if place in self.taken:
+					continue
+				try:
+					fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.places_start + place)
+				except OSError:
+					continue
+				self.taken.add(place)
+				return place
+		return None
+
+	def leave(self, place):
+		if place < 0:
+			return
+		with self.lock:
+			fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.places_start + place)
+			self.taken.discard(place)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+A small full text search index for blog posts, ranked with BM25.
+
+post.py writes the index to a single file whenever posts change, and blog.py
+memory maps it to answer searches without asking the database.
+
+The file is laid out as:
+	header		magic, version, number of posts, number of terms, average post length
+	posts		for every post: post_id, length, and where its url title, title and description are in strings
+	terms		for every term, sorted: where the term is in strings, where its postings start, how many there are
+	postings	for every term: (post number, weighted term count) pairs
+	strings		utf-8 text the other sections point into
+Numbers are stored in the byte order of the machine that wrote the file, and everything but the
+header and strings is an array of 32 bit unsigned integers, so the sections can be used straight
+out of the memory map. Rebuild the index with post.py -s after moving it to a different kind of machine.
+"""
+import os
+import re
+import mmap
+import html
+import math
+import heapq
+import struct
+import array
+import collections
+
+MAGIC = b'LBSI'
+VERSION = 1
+# magic, version, post count, term count, average post length
+HEADER = struct.Struct('=4sIIId')
+# post_id, length, url title offset and length, title offset and length, description offset and length
+POST_FIELDS = 8
+# term offset and length, first posting, number of postings
+TERM_FIELDS = 4
+
+# a word in the title counts as much as three in the text, a word in the description as much as two
+field_weights = (3, 2, 1)
+# the usual BM25 tuning
+k1 = 1.2
+b = 0.75
+
+stopwords = frozenset('''
+a an and are as at be but by for from has have he her his i if in into is it its me my no not of on or our
+she so than that the their them then there these they this to was we were what when which who will with you your
+'''.split())
+
+word_re = re.compile(r'\w+')
+tag_re = re.compile(r'<[^>]*>')
+
+SearchResult = collections.namedtuple('SearchResult', 'url_title title description rank')
+
+def tokenize(text, strip_html = False):
+	"""
+	Splits text into lower case words, leaving out stop words.
+	If strip_html is true, tags and entities are removed first.
+	"""
+	if strip_html:
+		text = html.unescape(tag_re.sub(' ', text))
+	return [word for word in word_re.findall(text.lower()) if word not in stopwords]
+
+def count_terms(title, description, text):
+	"""
+	Returns a post's weighted term counts and its weighted length.
+	"""
+	counts = collections.Counter()
+	length = 0
+	for weight, words in zip(field_weights, (tokenize(title, True), tokenize(description, True), tokenize(text, True))):
+		for word in words:
+			counts[word] += weight
+		length += weight * len(words)
+	return counts, length
+
+class SearchIndex:
+	"""
+	A memory mapped search index file.
+	Opening one is cheap, nothing but the header is read until search() is called.
+	"""
+	def __init__(self, path):
+		with open(path, 'rb') as fh:
+			self.map = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+		if len(self.map) < HEADER.size:
+			raise ValueError('{} is too short to be a search index'.format(path))
+		magic, version, self.post_count, self.term_count, self.avg_length = HEADER.unpack_from(self.map)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError('{} is not a search index this version can read'.format(path))
+		postings_start = self.post_count * POST_FIELDS + self.term_count * TERM_FIELDS
+		# a file cut short by a full disk or a copy that didn't finish would be read past its end
+		if len(self.map) < HEADER.size + 4 * (postings_start + 1):
+			raise ValueError('{} is cut short'.format(path))
+		postings_length = struct.unpack_from('=I', self.map, HEADER.size + 4 * postings_start)[0]
+		strings_start = HEADER.size + 4 * (postings_start + 1 + postings_length)
+		if len(self.map) < strings_start:
+			raise ValueError('{} is cut short'.format(path))
+		words = memoryview(self.map)[HEADER.size:strings_start].cast('I')
+		self.posts = words[:self.post_count * POST_FIELDS]
+		self.terms = words[len(self.posts):postings_start]
+		self.postings = words[postings_start + 1:]
+		self.strings = memoryview(self.map)[strings_start:]
+
+	def _string(self, offset, length):
+		return str(self.strings[offset:offset + length], 'utf8')
+
+	def _find_term(self, term):
+		"""
+		Binary searches the sorted terms, returns the term's number or None.
+		"""
+		term = term.encode('utf8')
+		low, high = 0, self.term_count
+		while low < high:
+			middle = (low + high) // 2
+			offset = self.terms[middle * TERM_FIELDS]
+			found = self.strings[offset:offset + self.terms[middle * TERM_FIELDS + 1]].tobytes()
+			if found < term:
+				low = middle + 1
+			elif found > term:
+				high = middle
+			else:
+				return middle
+		return None
+
+	def search(self, query, limit = 20):
+		"""
+		Returns up to limit SearchResults for the posts that best match query, best first.
+		"""
+		scores = collections.defaultdict(float)
+		for term in set(tokenize(query)):
+			number = self._find_term(term)
+			if number is None:
+				continue
+			first = self.terms[number * TERM_FIELDS + 2]
+			count = self.terms[number * TERM_FIELDS + 3]
+			idf = math.log(1 + (self.post_count - count + 0.5) / (count + 0.5))
+			for i in range(first, first + count):
+				post = self.postings[2 * i]
+				tf = self.postings[2 * i + 1]
+				length = self.posts[post * POST_FIELDS + 1]
+				scores[post] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / self.avg_length))
+		results = []
+		for post, score in heapq.nlargest(limit, scores.items(), key = lambda item: item[1]):
+			fields = self.posts[post * POST_FIELDS:(post + 1) * POST_FIELDS]
+			results.append(SearchResult(
+				self._string(fields[2], fields[3]),
+				self._string(fields[4], fields[5]),
+				self._string(fields[6], fields[7]),
+				score
+			))
+		return results
+
+	def read_posts(self):
+		"""
+		Reads the whole index back into the dictionary write_index() takes.
+		"""
+		posts = dict()
+		for post in range(self.post_count):
+			fields = self.posts[post * POST_FIELDS:(post + 1) * POST_FIELDS]
+			posts[fields[0]] = [
+				self._string(fields[2], fields[3]),
+				self._string(fields[4], fields[5]),
+				self._string(fields[6], fields[7]),
+				collections.Counter(),
+				fields[1]
+			]
+		ids = [self.posts[post * POST_FIELDS] for post in range(self.post_count)]
+		for number in range(self.term_count):
+			term = self._string(self.terms[number * TERM_FIELDS], self.terms[number * TERM_FIELDS + 1])
+			first = self.terms[number * TERM_FIELDS + 2]
+			for i in range(first, first + self.terms[number * TERM_FIELDS + 3]):
+				posts[ids[self.postings[2 * i]]][3][term] = self.postings[2 * i + 1]
+		return posts
+
+	def close(self):
+		# the memoryviews have to go before the map can be closed
+		del self.posts, self.terms, self.postings, self.strings
+		self.map.close()
+
+def write_index(path, posts):
+	"""
+	Writes posts to a new index file at path.
+	posts is a dictionary from post_id to [url_title, title, description, term counts, length].
+	The file is written next to path and renamed over it, so readers never see half an index.
+	"""
+	strings = bytearray()
+	string_offsets = dict()
+	def add_string(text):
+		data = text.encode('utf8')
+		if data not in string_offsets:
+			string_offsets[data] = len(strings)
+			strings.extend(data)
+		return string_offsets[data], len(data)
+	post_table = array.array('I')
+	postings_by_term = collections.defaultdict(list)
+	total_length = 0
+	for number, post_id in enumerate(sorted(posts)):
+		url_title, title, description, counts, length = posts[post_id]
+		post_table.extend((post_id, length))
+		for text in (url_title, title, description):
+			post_table.extend(add_string(text))
+		for term, tf in counts.items():
+			postings_by_term[term].append((number, tf))
+		total_length += length
+	term_table = array.array('I')
+	postings = array.array('I')
+	for term in sorted(postings_by_term, key = lambda term: term.encode('utf8')):
+		term_table.extend(add_string(term))
+		term_table.extend((len(postings) // 2, len(postings_by_term[term])))
+		for pair in postings_by_term[term]:
+			postings.extend(pair)
+	avg_length = total_length / len(posts) if posts else 1.0
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as fh:
+		fh.write(HEADER.pack(MAGIC, VERSION, len(posts), len(term_table) // TERM_FIELDS, avg_length or 1.0))
+		fh.write(post_table.tobytes())
+		fh.write(term_table.tobytes())
+		fh.write(struct.pack('=I', len(postings)))
+		fh.write(postings.tobytes())
+		fh.write(strings)
+	os.replace(tmp_path, path)
+
+def build_index(path, rows):
+	"""
+	Indexes every post and writes the index to path.
+	rows is an iterable of (post_id, url_title, title, description, text).
+	"""
+	write_index(path, dict(index_row(row) for row in rows))
+
+def update_index(path, rows, removed = ()):
+	"""
+	Re-indexes the posts in rows and drops the post_ids in removed, keeping everything else in the index at path.
+	Only the changed posts are tokenized, the rest is read back from the old index.
+	"""
+	index = SearchIndex(path)
+	try:
+		posts = index.read_posts()
+	finally:
+		index.close()
+	for post_id in removed:
+		posts.pop(post_id, None)
+	posts.update(index_row(row) for row in rows)
+	write_index(path, posts)
+
+def index_row(row):
+	post_id, url_title, title, description, text = row
+	counts, length = count_terms(title, description, text)
+	return post_id, [url_title, title, description, counts, length]
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+A page cache in a memory mapped file, shared by every worker blog.py forks.
+
+It's made before the workers are forked, and they all map the same file, so a page
+rendered by one worker is served by all of them and is only kept once.
+
+The file is laid out as:
+	header		magic, number of slots, generation, bytes written so far, version file identity
+	slots		for every slot: hash of its key, generation, where its entry was written and how long it is
+	data		entries, each the length of its key, the key and the pickled value
+Entries are written one after the other into data, going back to the start when it's full,
+so the oldest entries are the ones overwritten. A key always goes in the same slot, and a
+newer key with the same slot replaces it. A slot's entry is good as long as its generation is
+the cache's and nothing has been written over it since. Entries from before the cache was
+last emptied can still be read as stale ones until then.
+
+Emptying the cache is bumping the generation in the header, which every worker sees at once.
+Workers take an fcntl lock on the file around every read and write, which is let go
+if a worker dies holding it.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import pickle
+import hashlib
+import tempfile
+import threading
+
+MAGIC = b'LBPC'
+# magic, slot count, generation, bytes written, version file inode, mtime and size
+HEADER = struct.Struct('=4sIQQQQQ')
+# key hash, generation, position, length
+SLOT = struct.Struct('=QQQI')
+# length of an entry's key
+KEY_LENGTH = struct.Struct('=I')
+
+class SharedCache:
+	"""
+	Works like blog.LRUCache, but keeps values pickled in a temporary file in directory that's
+	shared with every process forked after it's made. max_bytes is the size of the data section.
+	Everything in the cache is dropped when the file at version_path changes.
+	"""
+	def __init__(self, max_bytes, version_path = None, slot_count = 4096, directory = None):
+		self.max_bytes = max_bytes
+		self.version_path = version_path
+		self.version = None
+		self.slot_count = slot_count
+		self.data_start = HEADER.size + SLOT.size * slot_count
+		self.file = tempfile.TemporaryFile(dir = directory)
+		self.file.truncate(self.data_start + max_bytes)
+		self.map = mmap.mmap(self.file.fileno(), self.data_start + max_bytes)
+		HEADER.pack_into(self.map, 0, MAGIC, slot_count, 0, 0, 0, 0, 0)
+		# counted by each process for itself
+		self.hits = 0
+		self.misses = 0
+		# the fcntl lock keeps other processes out, this one the other threads of this process
+		self.lock = threading.Lock()
+
+	@property
+	def generation(self):
+		return HEADER.unpack_from(self.map)[2]
+
+	def _lock(self, exclusive):
+		self.lock.acquire()
+		fcntl.lockf(self.file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+	def _unlock(self):
+		fcntl.lockf(self.file, fcntl.LOCK_UN)
+		self.lock.release()
+
+	def _slot(self, key):
+		"""
+		Returns the key as bytes, its hash and where its slot is.
+		Python's own hash() of a str is different in every process, so it can't be used here.
+		"""
+		key_bytes = repr(key).encode('utf8')
+		key_hash = int.from_bytes(hashlib.blake2b(key_bytes, digest_size = 8).digest(), 'little')
+		return key_bytes, key_hash, HEADER.size + SLOT.size * (key_hash % self.slot_count)
+
+	def _entry(self, slot, key_hash, header, stale = False):
+		"""
+		Returns where the entry in slot starts in the map and its length, or None if it's gone.
+		With stale, only entries from before the cache was last emptied are returned.
+		"""
+		found_hash, generation, position, length = SLOT.unpack_from(self.map, slot)
+		written = header[3]
+		if length == 0 or found_hash != key_hash or (generation == header[2]) == stale or written - position > self.max_bytes:
+			return None
+		return self.data_start + position % self.max_bytes, length
+
+	def get(self, key):
+		"""
+		Returns the cached value for key, or None.
+		"""
+		value = self._read(key, False)
+		if value is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return value
+
+	def get_stale(self, key):
+		"""
+		Returns the value that was cached for key before the cache was last emptied, or None.
+		Stale values last until the same key is cached again or they're written over.
+		"""
+		return self._read(key, True)
+
+	def _read(self, key, stale):
+		key_bytes, key_hash, slot = self._slot(key)
+		self._lock(False)
+		try:
+			entry = self._entry(slot, key_hash, HEADER.unpack_from(self.map), stale)
+			if entry is not None:
+				start, length = entry
+				key_length = KEY_LENGTH.unpack_from(self.map, start)[0]
+				start += KEY_LENGTH.size
+				if self.map[start:start + key_length] != key_bytes:
+					entry = None
+				else:
+					data = self.map[start + key_length:start - KEY_LENGTH.size + length]
+		finally:
+			self._unlock()
+		return None if entry is None else pickle.loads(data)
+
+	def put(self, key, value, generation = None):
+		"""
+		Caches value under key, writing over the oldest entries if there isn't room.
+		Values bigger than the whole cache aren't cached.
+		If generation is given and the cache was emptied since it was read,
+		the value was made from old data and isn't cached.
+		"""
+		key_bytes, key_hash, slot = self._slot(key)
+		data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+		length = KEY_LENGTH.size + len(key_bytes) + len(data)
+		if length > self.max_bytes:
+			return
+		self._lock(True)
+		try:
+			header = HEADER.unpack_from(self.map)
+			if generation is not None and generation != header[2]:
+				return
+			position = header[3]
+			# entries aren't split across the end of data
+			if position % self.max_bytes + length > self.max_bytes:
+				position += self.max_bytes - position % self.max_bytes
+			start = self.data_start + position % self.max_bytes
+			KEY_LENGTH.pack_into(self.map, start, len(key_bytes))
+			start += KEY_LENGTH.size
+			self.map[start:start + len(key_bytes)] = key_bytes
+			start += len(key_bytes)
+			self.map[start:start + len(data)] = data
+			SLOT.pack_into(self.map, slot, key_hash, header[2], position, length)
+			HEADER.pack_into(self.map, 0, *header[:3], position + length, *header[4:])
+		finally:
+			self._unlock()
+
+	def clear(self):
+		"""
+		Empties the cache for every process by moving on to the next generation.
+		"""
+		self._lock(True)
+		try:
+			header = HEADER.unpack_from(self.map)
+			HEADER.pack_into(self.map, 0, *header[:2], header[2] + 1, *header[3:])
+		finally:
+			self._unlock()
+
+	def check_version(self):
+		"""
+		Empties the cache if the version file changed since the last check.
+		The first process to see a change empties it for the rest, the others only remember the new version.
+		"""
+		if self.version_path is None:
+			return
+		try:
+			st = os.stat(self.version_path)
+			version = (st.st_ino, st.st_mtime_ns, st.st_size)
+		except OSError:
+			version = (0, 0, 0)
+		if version == self.version:
+			return
+		self._lock(True)
+		try:
+			header = HEADER.unpack_from(self.map)
+			if header[4:] != version:
+				HEADER.pack_into(self.map, 0, *header[:2], header[2] + 1, header[3], *version)
+		finally:
+			self._unlock()
+		self.version = version
+
+	def stats(self):
+		"""
+		Returns the hits and misses of this process, and how many entries and bytes are in the cache.
+		"""
+		self._lock(False)
+		try:
+			header = HEADER.unpack_from(self.map)
+			entries = 0
+			used = 0
+			for slot in range(HEADER.size, self.data_start, SLOT.size):
+				key_hash = SLOT.unpack_from(self.map, slot)[0]
+				entry = self._entry(slot, key_hash, header)
+				if entry is not None:
+					entries += 1
+					used += entry[1]
+		finally:
+			self._unlock()
+		return {'hits' : self.hits, 'misses' : self.misses, 'entries' : entries, 'bytes' : used}
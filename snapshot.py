@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+A read only copy of every post in one file, so blog.py can serve posts and the archive without the database.
+
+post.py writes the snapshot whenever posts change, and blog.py memory maps it.
+Looking up a post or a page of the archive is a binary search, and only the fields
+that are asked for are read. Post texts are handed out as memoryviews of the map.
+
+The file is laid out as:
+	header		magic, version, number of posts
+	posts		for every post, newest first: post_id, date, last update time, and where its
+				url title, title, description and text are in strings
+	slugs		post numbers, sorted by url title
+	strings		utf-8 text the other sections point into
+Numbers are stored in the byte order of the machine that wrote the file, and everything but the
+header and strings is an array of 32 bit unsigned integers, so the sections can be used straight
+out of the memory map. Write the snapshot again with post.py -snapshot after moving it to a different kind of machine.
+"""
+import os
+import mmap
+import struct
+import array
+import datetime
+
+MAGIC = b'LBSN'
+VERSION = 1
+# magic, version, post count
+HEADER = struct.Struct('=4sII')
+# post_id, date ordinal, updated_at, then offset and length of the url title, title, description and text
+POST_FIELDS = 11
+# where each field of a post is in its row of the posts section
+number_fields = {'post_id' : 0, 'post_date' : 1, 'updated_at' : 2}
+string_fields = {'url_title' : 3, 'title' : 5, 'description' : 7, 'text' : 9}
+
+class Snapshot:
+	"""
+	A memory mapped snapshot file.
+	Lookups return lists of whatever namedtuple they're given, filled in by field name,
+	so they can stand in for SQLcon.fetch(). Fields the snapshot doesn't have are None.
+	"""
+	def __init__(self, path):
+		with open(path, 'rb') as fh:
+			self.map = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+		if len(self.map) < HEADER.size:
+			raise ValueError('{} is too short to be a snapshot'.format(path))
+		magic, version, self.post_count = HEADER.unpack_from(self.map)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError('{} is not a snapshot this version can read'.format(path))
+		strings_start = HEADER.size + 4 * self.post_count * (POST_FIELDS + 1)
+		# a file cut short by a full disk or a copy that didn't finish would be read past its end
+		if len(self.map) < strings_start:
+			raise ValueError('{} is cut short'.format(path))
+		words = memoryview(self.map)[HEADER.size:strings_start].cast('I')
+		self.posts = words[:self.post_count * POST_FIELDS]
+		self.slugs = words[self.post_count * POST_FIELDS:]
+		self.strings = memoryview(self.map)[strings_start:]
+		# strings are written in order, so the last post's text ends where the file should
+		if self.post_count and len(self.strings) < sum(self.posts[-2:]):
+			raise ValueError('{} is cut short'.format(path))
+
+	def _bytes(self, number, field):
+		offset = self.posts[number * POST_FIELDS + field]
+		return self.strings[offset:offset + self.posts[number * POST_FIELDS + field + 1]]
+
+	def _field(self, number, name):
+		if name in number_fields:
+			value = self.posts[number * POST_FIELDS + number_fields[name]]
+			return datetime.date.fromordinal(value) if name == 'post_date' else value
+		if name == 'text':
+			# left as utf-8 in the map, see blog.render_post()
+			return self._bytes(number, string_fields[name])
+		if name in string_fields:
+			return str(self._bytes(number, string_fields[name]), 'utf8')
+		return None
+
+	def _record(self, record, number, **values):
+		for name in record._fields:
+			if name not in values:
+				values[name] = self._field(number, name)
+		return record(**values)
+
+	def _key(self, number):
+		return (self.posts[number * POST_FIELDS + 1], self.posts[number * POST_FIELDS])
+
+	def _find_older(self, post_date, post_id):
+		"""
+		Returns the number of the newest post older than (post_date, post_id), or post_count if there isn't one.
+		"""
+		key = (post_date.toordinal(), post_id)
+		low, high = 0, self.post_count
+		while low < high:
+			middle = (low + high) // 2
+			if self._key(middle) < key:
+				high = middle
+			else:
+				low = middle + 1
+		return low
+
+	def find(self, url_title):
+		"""
+		Returns the number of the post with url_title, or None.
+		"""
+		url_title = url_title.encode('utf8')
+		low, high = 0, self.post_count
+		while low < high:
+			middle = (low + high) // 2
+			found = self._bytes(self.slugs[middle], string_fields['url_title']).tobytes()
+			if found < url_title:
+				low = middle + 1
+			elif found > url_title:
+				high = middle
+			else:
+				return self.slugs[middle]
+		return None
+
+	def post_page(self, record, url_title = None):
+		"""
+		Like the get_post_page query, or get_first_post_page if url_title is None.
+		record's prev_url and next_url are the url titles of the newer and older posts next to it.
+		"""
+		number = 0 if url_title is None else self.find(url_title)
+		if number is None or number >= self.post_count:
+			return []
+		return [self._record(
+			record,
+			number,
+			prev_url = self._field(number - 1, 'url_title') if number > 0 else None,
+			next_url = self._field(number + 1, 'url_title') if number + 1 < self.post_count else None
+		)]
+
+	def archive_page(self, record, limit, before = None, after = None):
+		"""
+		Like the get_title_and_desc query, or get_archive_before and get_archive_after
+		when given a (post_date, post_date, post_id) cursor. Returns up to limit posts.
+		"""
+		if before is not None:
+			first = self._find_older(before[0], before[2])
+			numbers = range(first, min(first + limit, self.post_count))
+		elif after is not None:
+			# the posts newer than the cursor, oldest first
+			first = self._find_older(after[0], after[2] + 1)
+			numbers = range(first - 1, max(first - limit, 0) - 1, -1)
+		else:
+			numbers = range(min(limit, self.post_count))
+		return [self._record(record, number) for number in numbers]
+
+def write_snapshot(path, rows):
+	"""
+	Writes rows to a new snapshot file at path.
+	rows is an iterable of (post_id, url_title, title, post_date, updated_at, description, text).
+	The file is written next to path and renamed over it, so readers never see half a snapshot.
+	"""
+	rows = sorted(rows, key = lambda row: (row[3], row[0]), reverse = True)
+	strings = bytearray()
+	post_table = array.array('I')
+	for post_id, url_title, title, post_date, updated_at, description, text in rows:
+		post_table.extend((post_id, post_date.toordinal(), updated_at))
+		for field in (url_title, title, description, text):
+			data = field.encode('utf8')
+			post_table.extend((len(strings), len(data)))
+			strings.extend(data)
+	slugs = array.array('I', sorted(range(len(rows)), key = lambda number: rows[number][1].encode('utf8')))
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as fh:
+		fh.write(HEADER.pack(MAGIC, VERSION, len(rows)))
+		fh.write(post_table.tobytes())
+		fh.write(slugs.tobytes())
+		fh.write(strings)
+	os.replace(tmp_path, path)
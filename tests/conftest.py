@@ -0,0 +1,5 @@
+# blog.py and the modules next to it aren't a package, so the tests import them from the repository root
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
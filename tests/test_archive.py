@@ -0,0 +1,107 @@
+"""
+Tests for paging through the archive with (post_date, post_id) cursors.
+"""
+import os
+import re
+import datetime
+
+import pytest
+
+import blog
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+page_size = 3
+
+# newest first, a few posts share a date so their ids have to break the tie
+posts = sorted(
+	(blog.ArchiveEntry('post-{}'.format(i), 'Post {}'.format(i), 'desc', 1500000000 + i, datetime.date(2017, 1, 1) + datetime.timedelta(days = i // 3), i) for i in range(1, 12)),
+	key = lambda post: (post.post_date, post.post_id),
+	reverse = True
+)
+
+class ListCon:
+	"""
+	Stands in for blog.SQLcon, answering the archive queries from posts.
+	"""
+	def __init__(self, config):
+		pass
+
+	def fetch(self, query, record, *parameters):
+		limit = page_size + 1
+		if query == 'get_title_and_desc':
+			return posts[:limit]
+		post_date, _, post_id = parameters
+		if query == 'get_archive_before':
+			return [post for post in posts if (post.post_date, post.post_id) < (post_date, post_id)][:limit]
+		if query == 'get_archive_after':
+			return [post for post in reversed(posts) if (post.post_date, post.post_id) > (post_date, post_id)][:limit]
+		raise AssertionError(query)
+
+@pytest.fixture(autouse = True)
+def archive(monkeypatch):
+	monkeypatch.setitem(blog.archive_config, 'page_size', page_size)
+	monkeypatch.setitem(blog.snapshot_config, 'snapshot_file', '')
+	monkeypatch.setitem(blog.template_config, 'archive_template', os.path.join(repo_dir, 'templates', 'archive_temp.html'))
+	monkeypatch.setitem(blog.template_config, 'post_template', os.path.join(repo_dir, 'templates', 'home_temp.html'))
+	monkeypatch.setattr(blog, 'SQLcon', ListCon)
+
+def serve(before = None, after = None):
+	"""
+	Returns the status of an archive page, the url titles on it and its newer and older cursors.
+	"""
+	res = blog.Response()
+	blog.serve_default_archive(res, None, before, after)
+	page = res.body().decode('utf8')
+	links = dict(re.findall(r'\?p=archive&(?:amp;)?(before|after)=([0-9.-]+)', page))
+	return res.status, re.findall(r'\?p=(post-\d+)', page), links.get('after'), links.get('before')
+
+def test_cursor_round_trips():
+	cursor = blog.archive_cursor(posts[0])
+	assert cursor == '2017-01-04.11'
+	assert blog.parse_archive_cursor(cursor) == (datetime.date(2017, 1, 4), datetime.date(2017, 1, 4), 11)
+
+@pytest.mark.parametrize('cursor', [None, '', '2017-01-04', '2017-1-4.11', '2017-02-30.1', '2017-01-04.', '2017-01-04.-1', '2017-01-04.1x', '../etc'])
+def test_bad_cursors(cursor):
+	assert blog.parse_archive_cursor(cursor) is None
+
+def test_bad_cursor_is_a_404():
+	assert serve(before = 'nope')[0] == '404 Not Found'
+
+def test_before_and_after_is_a_404():
+	assert serve(before = blog.archive_cursor(posts[5]), after = blog.archive_cursor(posts[1]))[0] == '404 Not Found'
+
+def test_cursors_for_the_same_post_share_a_cache_key():
+	assert blog.archive_key(before = '2017-01-04.11') == blog.archive_key(before = '2017-01-04.0011')
+	assert blog.archive_key(before = '2017-01-04.11') != blog.archive_key(after = '2017-01-04.11')
+	assert blog.archive_key() != blog.archive_key(before = 'nope')
+	assert blog.archive_key(before = '2017-01-04.11', after = '2017-01-04.11') != blog.archive_key(before = '2017-01-04.11')
+
+def test_walk_older_then_newer_covers_every_post_once():
+	status, titles, newer, older = serve()
+	assert status == '200 OK' and newer is None
+	seen = [titles]
+	while older is not None:
+		status, titles, newer, older = serve(before = older)
+		assert status == '200 OK' and newer is not None
+		seen.append(titles)
+	assert sum(seen, []) == [post.url_title for post in posts]
+	assert len(seen[-1]) == len(posts) % page_size
+	# and back again from the last page
+	pages = [seen[-1]]
+	while newer is not None:
+		status, titles, newer, older = serve(after = newer)
+		assert status == '200 OK'
+		pages.insert(0, titles)
+	assert sum(pages, []) == [post.url_title for post in posts]
+
+def test_before_the_oldest_post_is_a_404():
+	assert serve(before = blog.archive_cursor(posts[-1]))[0] == '404 Not Found'
+
+def test_after_a_recent_post_is_the_first_page():
+	status, titles, newer, older = serve(after = blog.archive_cursor(posts[1]))
+	assert titles == [post.url_title for post in posts[:page_size]]
+	assert newer is None
+
+def test_failed_query_is_a_500(monkeypatch):
+	monkeypatch.setattr(ListCon, 'fetch', lambda self, query, record, *parameters: None)
+	assert serve(before = blog.archive_cursor(posts[0]))[0] == '500 Internal Error'
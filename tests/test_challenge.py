@@ -0,0 +1,186 @@
+"""
+Tests for the contact page challenge: signed tokens, and answering each one only once.
+"""
+import os
+import re
+import time
+import shutil
+
+import pytest
+
+import blog
+import usednonces
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+@pytest.fixture(autouse = True)
+def challenge_files(tmp_path, monkeypatch):
+	monkeypatch.setitem(blog.challenge_config, 'secret_file', str(tmp_path / 'secret'))
+	monkeypatch.setitem(blog.challenge_config, 'nonce_file', str(tmp_path / 'nonces'))
+	monkeypatch.setitem(blog.template_config, 'email_challenge', os.path.join(repo_dir, 'templates', 'email_temp1.html'))
+	monkeypatch.setitem(blog.template_config, 'email_success', os.path.join(repo_dir, 'templates', 'email_temp2.html'))
+	monkeypatch.setitem(blog.template_config, 'post_template', os.path.join(repo_dir, 'templates', 'home_temp.html'))
+	# copied, so its index is written in a directory of its own
+	(tmp_path / 'wordlist').mkdir()
+	shutil.copy(os.path.join(repo_dir, 'wordlist'), str(tmp_path / 'wordlist' / 'wordlist'))
+	monkeypatch.setitem(blog.template_config, 'wordlist', str(tmp_path / 'wordlist' / 'wordlist'))
+	monkeypatch.setitem(blog.loaded_secret, 'secret', None)
+	monkeypatch.setitem(blog.open_nonces, 'path', None)
+	monkeypatch.setitem(blog.open_nonces, 'nonces', None)
+
+def answer(word, token):
+	res = blog.Response()
+	blog.check_email_challenge(res, word, token)
+	return res.body().decode('utf8')
+
+def passed(page):
+	return 'Thank you' in page
+
+def test_secret_is_created_once(tmp_path):
+	secret = blog.get_challenge_secret()
+	assert len(secret) == 32
+	assert (tmp_path / 'secret').read_bytes() == secret
+	blog.loaded_secret['secret'] = None
+	assert blog.get_challenge_secret() == secret
+
+def test_secret_made_by_another_process_is_used(tmp_path):
+	(tmp_path / 'secret').write_bytes(b'k' * 32)
+	assert blog.get_challenge_secret() == b'k' * 32
+	# no temporary files are left behind
+	assert sorted(path.name for path in tmp_path.iterdir() if path.is_file()) == ['secret']
+
+@pytest.mark.parametrize('secret', [b'', b'short'])
+def test_short_secret_is_refused(tmp_path, monkeypatch, secret):
+	(tmp_path / 'secret').write_bytes(secret)
+	monkeypatch.setattr(blog, 'log_print', lambda *args, **kwargs: None)
+	assert blog.get_challenge_secret() is None
+	res = blog.Response()
+	blog.serve_email_challenge(res)
+	assert res.status == '500 Internal Error'
+	res = blog.Response()
+	blog.check_email_challenge(res, 'pelican', '1.2.3')
+	assert res.status == '500 Internal Error'
+
+def test_secret_that_cant_be_made_is_a_500(tmp_path, monkeypatch):
+	monkeypatch.setitem(blog.challenge_config, 'secret_file', str(tmp_path / 'missing' / 'secret'))
+	monkeypatch.setattr(blog, 'log_print', lambda *args, **kwargs: None)
+	res = blog.Response()
+	blog.serve_email_challenge(res)
+	assert res.status == '500 Internal Error'
+
+def test_wordlist_picks_every_word(tmp_path):
+	path = tmp_path / 'words'
+	path.write_bytes(b'apple\nbanana\r\n\n  cherry \n')
+	words = blog.WordList(str(path))
+	assert len(words) == 3
+	assert {words.choice() for i in range(200)} == {'apple', 'banana', 'cherry'}
+
+def test_wordlist_index_is_written_and_used(tmp_path, monkeypatch):
+	path = tmp_path / 'words'
+	path.write_bytes(b'apple\nbanana\n')
+	blog.WordList(str(path))
+	assert (tmp_path / 'words.index').exists()
+	# picking words from the index never looks for them in the list
+	monkeypatch.setattr(re, 'finditer', None)
+	words = blog.WordList(str(path))
+	assert sorted({words.choice() for i in range(100)}) == ['apple', 'banana']
+
+def test_wordlist_index_is_made_again_when_the_list_changes(tmp_path):
+	path = tmp_path / 'words'
+	path.write_bytes(b'apple\nbanana\n')
+	blog.WordList(str(path))
+	path.write_bytes(b'cherry\n')
+	os.utime(str(path), ns = (0, 0))
+	words = blog.WordList(str(path))
+	assert len(words) == 1 and words.choice() == 'cherry'
+
+def test_wordlist_works_without_its_index(tmp_path, monkeypatch):
+	path = tmp_path / 'words'
+	path.write_bytes(b'apple\n')
+	# the index can't be read or written
+	(tmp_path / 'words.index').mkdir()
+	monkeypatch.setattr(blog, 'log_print', lambda *args, **kwargs: None)
+	words = blog.WordList(str(path))
+	assert words.choice() == 'apple'
+	# and the temporary file is cleaned up
+	assert sorted(path.name for path in tmp_path.iterdir()) == ['wordlist', 'words', 'words.index']
+
+def test_token_does_not_contain_word():
+	token = blog.make_challenge_token('pelican')
+	expires, nonce, signature = token.split('.')
+	assert int(expires) > time.time()
+	assert len(nonce) == 16 and len(signature) == 32
+	assert 'pelican' not in token
+
+def test_right_word_passes_any_case():
+	assert passed(answer(' Pelican ', blog.make_challenge_token('pelican')))
+
+def test_wrong_word_fails():
+	page = answer('penguin', blog.make_challenge_token('pelican'))
+	assert not passed(page)
+	assert "wasn't typed in correctly" in page
+
+def test_token_only_works_once():
+	token = blog.make_challenge_token('pelican')
+	assert passed(answer('pelican', token))
+	assert not passed(answer('pelican', token))
+
+def test_expired_token_fails(monkeypatch):
+	monkeypatch.setitem(blog.challenge_config, 'lifetime', -1)
+	assert not passed(answer('pelican', blog.make_challenge_token('pelican')))
+
+@pytest.mark.parametrize('change', [
+	lambda expires, nonce, signature: (str(int(expires) + 1000), nonce, signature),
+	lambda expires, nonce, signature: (expires, '0' * 16, signature),
+	lambda expires, nonce, signature: (expires, nonce, 'f' * 32),
+])
+def test_changed_token_fails(change):
+	token = blog.make_challenge_token('pelican')
+	assert not passed(answer('pelican', '.'.join(change(*token.split('.')))))
+
+@pytest.mark.parametrize('token', [None, '', 'abc', '1.2', 'x.y.z', '1.2.3.4'])
+def test_malformed_token_fails(token):
+	assert not passed(answer('pelican', token))
+
+def test_shared_nonces_are_seen_by_every_process(tmp_path):
+	path = str(tmp_path / 'shared')
+	first = usednonces.UsedNonces(path, bucket_count = 4)
+	second = usednonces.UsedNonces(path, bucket_count = 4)
+	expires = time.time() + 60
+	assert first.use('abc', expires)
+	assert not second.use('abc', expires)
+	assert second.use('def', expires)
+
+def test_shared_nonces_can_be_used_again_once_expired(tmp_path):
+	nonces = usednonces.UsedNonces(str(tmp_path / 'shared'), bucket_count = 1)
+	assert nonces.use('abc', time.time() - 1)
+	assert nonces.use('abc', time.time() + 60)
+
+def test_full_bucket_forgets_the_nonce_closest_to_expiring(tmp_path):
+	nonces = usednonces.UsedNonces(str(tmp_path / 'shared'), bucket_count = 1)
+	now = time.time()
+	for i in range(usednonces.BUCKET_SIZE + 1):
+		assert nonces.use(str(i), now + 100 + i)
+	assert nonces.use('0', now + 100)
+	assert not nonces.use(str(usednonces.BUCKET_SIZE), now + 200)
+
+def test_shared_nonce_file_of_another_size_is_refused(tmp_path):
+	path = str(tmp_path / 'shared')
+	usednonces.UsedNonces(path, bucket_count = 4)
+	with pytest.raises(ValueError):
+		usednonces.UsedNonces(path, bucket_count = 8)
+
+def test_falls_back_on_nonces_for_this_process(tmp_path, monkeypatch):
+	monkeypatch.setitem(blog.challenge_config, 'nonce_file', str(tmp_path / 'missing' / 'nonces'))
+	monkeypatch.setattr(blog, 'log_print', lambda *args, **kwargs: None)
+	assert isinstance(blog.get_used_nonces(), blog.UsedNonces)
+	token = blog.make_challenge_token('pelican')
+	assert passed(answer('pelican', token))
+	assert not passed(answer('pelican', token))
+
+def test_process_nonces_drop_the_oldest_when_full():
+	nonces = blog.UsedNonces(2)
+	expires = time.time() + 60
+	assert nonces.use('a', expires) and nonces.use('b', expires) and nonces.use('c', expires)
+	assert nonces.use('a', expires)
+	assert not nonces.use('c', expires)
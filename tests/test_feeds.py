@@ -0,0 +1,73 @@
+"""
+Tests for post.py's Atom feed and sitemap, and the url titles it won't give a post.
+"""
+import datetime
+import xml.etree.ElementTree as ElementTree
+
+import pytest
+
+import post
+
+atom = '{http://www.w3.org/2005/Atom}'
+sitemap = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+site_url = 'https://example.com/blog'
+
+# (url title, title, description, text, last update time), as write_feeds() reads them
+posts = [
+	('soup', 'Soup &amp; bread', 'Less &lt; more', '<p>\nBread & <b>butter</b> ]]> done\n</p>\n', 1500000300),
+	('hello', 'Hello', 'First post', '<p>\nhi\n</p>\n', 1500000000),
+]
+
+# (url title, title, description, last update time, date, id), as get_post_order() returns them
+order = [
+	('soup', 'Soup &amp; bread', 'Less &lt; more', 1500000300, datetime.date(2017, 7, 14), 2),
+	('hello', 'Hello', 'First post', 1500000000, datetime.date(2017, 7, 13), 1),
+]
+
+def test_feed_entries():
+	feed = ElementTree.fromstring(post.make_feed(posts, site_url))
+	entries = feed.findall(atom + 'entry')
+	assert [entry.find(atom + 'id').text for entry in entries] == [site_url + '/?p=soup', site_url + '/?p=hello']
+	assert [entry.find(atom + 'link').get('href') for entry in entries] == [site_url + '/?p=soup', site_url + '/?p=hello']
+	# titles and texts are html, which the feed carries escaped
+	assert entries[0].find(atom + 'title').text == 'Soup &amp; bread'
+	assert entries[0].find(atom + 'summary').text == 'Less &lt; more'
+	assert entries[0].find(atom + 'content').text == posts[0][3]
+	assert [entry.find(atom + 'updated').text for entry in entries] == ['2017-07-14T02:45:00Z', '2017-07-14T02:40:00Z']
+
+def test_feed_links_and_updated():
+	feed = ElementTree.fromstring(post.make_feed(posts, site_url))
+	links = {link.get('rel') : link.get('href') for link in feed.findall(atom + 'link')}
+	assert links == {None : site_url + '/', 'self' : site_url + '/?p=feed'}
+	assert feed.find(atom + 'id').text == site_url + '/'
+	# the newest update of any post
+	assert feed.find(atom + 'updated').text == '2017-07-14T02:45:00Z'
+
+def test_feed_title_is_escaped(monkeypatch):
+	monkeypatch.setitem(post.feed_config, 'title', 'Bits & <Bytes>')
+	feed = ElementTree.fromstring(post.make_feed(posts, site_url))
+	assert feed.find(atom + 'title').text == 'Bits & <Bytes>'
+
+def test_empty_feed():
+	feed = ElementTree.fromstring(post.make_feed([], site_url))
+	assert feed.findall(atom + 'entry') == []
+	assert feed.find(atom + 'updated').text == '1970-01-01T00:00:00Z'
+
+def test_sitemap():
+	urlset = ElementTree.fromstring(post.make_sitemap(order, site_url))
+	urls = [(url.find(sitemap + 'loc').text, url.find(sitemap + 'lastmod').text) for url in urlset.findall(sitemap + 'url')]
+	assert urls == [
+		(site_url + '/', '2017-07-14T02:45:00Z'),
+		(site_url + '/?p=archive', '2017-07-14T02:45:00Z'),
+		(site_url + '/?p=soup', '2017-07-14T02:45:00Z'),
+		(site_url + '/?p=hello', '2017-07-14T02:40:00Z'),
+	]
+
+@pytest.mark.parametrize('url', ['archive', 'contact', 'feed', 'sitemap', 'metrics'])
+def test_blogs_own_pages_are_reserved(url):
+	assert post.is_reserved(url)
+	assert url in post.reserved_message(url)
+
+@pytest.mark.parametrize('url', ['soup', 'archives', 'feed-reader', 'my-sitemap'])
+def test_other_url_titles_are_not_reserved(url):
+	assert not post.is_reserved(url)
@@ -0,0 +1,160 @@
+"""
+Tests for cached pages: ETags, 304s, HTTP dates and picking a compressed body.
+"""
+import gzip
+
+import pytest
+
+import blog
+
+def make_page(body = 'hello world ' * 200, last_modified = 1500000000):
+	res = blog.Response()
+	blog.print_headers(res, ['Last-Modified: ' + blog.format_http_date(last_modified)])
+	res.write(body)
+	return blog.CachedPage(res)
+
+@pytest.fixture
+def page_cache(monkeypatch):
+	cache = blog.LRUCache(100000, sizeof = lambda page: page.size())
+	monkeypatch.setattr(blog, 'page_cache', cache)
+	return cache
+
+def header(res, name):
+	return dict(res.headers).get(name)
+
+def test_http_dates_round_trip():
+	assert blog.format_http_date(784111777) == 'Sun, 06 Nov 1994 08:49:37 GMT'
+	assert blog.parse_http_date('Sun, 06 Nov 1994 08:49:37 GMT') == 784111777
+
+@pytest.mark.parametrize('value', ['Sunday, 06-Nov-94 08:49:37 GMT', 'Sun Nov  6 08:49:37 1994'])
+def test_older_http_dates(value):
+	assert blog.parse_http_date(value) == 784111777
+
+@pytest.mark.parametrize('value', [None, '', 'yesterday', 'Sun, 99 Nov 1994 08:49:37 GMT'])
+def test_bad_http_dates(value):
+	assert blog.parse_http_date(value) is None
+
+def test_etag_is_the_same_for_the_same_body():
+	assert make_page().etag == make_page().etag
+	assert make_page().etag != make_page('something else').etag
+
+def test_page_is_compressed_only_when_asked():
+	page = make_page()
+	assert list(page.bodies) == ['identity']
+	page.compress()
+	assert gzip.decompress(page.bodies['gzip']) == page.bodies['identity']
+
+def test_compress_skips_bodies_that_would_grow():
+	page = make_page('x')
+	page.compress()
+	assert 'gzip' not in page.bodies
+
+@pytest.mark.parametrize('accept, expected', [
+	('', 'identity'),
+	('gzip', 'gzip'),
+	('gzip, deflate, br', 'br'),
+	('GZIP;q=0.5', 'gzip'),
+	('gzip;q=0', 'identity'),
+	('*', 'br'),
+	('deflate', 'identity'),
+])
+def test_choose_encoding(accept, expected):
+	bodies = {'identity' : b'x' * 100, 'gzip' : b'x' * 50, 'br' : b'x' * 40}
+	assert blog.choose_encoding(accept, bodies) == expected
+
+def test_respond_sends_the_encoding_asked_for():
+	page = make_page()
+	page.compress()
+	res = page.respond({'HTTP_ACCEPT_ENCODING' : 'gzip'})
+	assert res.status == '200 OK'
+	assert header(res, 'Content-Encoding') == 'gzip'
+	assert header(res, 'ETag') == '"{}-gzip"'.format(page.etag)
+	assert header(res, 'Vary') == 'Accept-Encoding'
+	assert res.body() == page.bodies['gzip']
+	res = page.respond({})
+	assert header(res, 'Content-Encoding') is None
+	assert header(res, 'ETag') == '"{}"'.format(page.etag)
+
+@pytest.mark.parametrize('if_none_match', ['"{etag}"', 'W/"{etag}"', '"{etag}-gzip"', '"other", "{etag}-br"', '*'])
+def test_matching_etag_gets_a_304(if_none_match):
+	page = make_page()
+	res = page.respond({'HTTP_IF_NONE_MATCH' : if_none_match.format(etag = page.etag)})
+	assert res.status == '304 Not Modified'
+	assert res.body() == b''
+	assert header(res, 'Last-Modified') == blog.format_http_date(1500000000)
+
+def test_other_etag_gets_the_page():
+	page = make_page()
+	# If-Modified-Since is ignored when there's an If-None-Match
+	res = page.respond({'HTTP_IF_NONE_MATCH' : '"other"', 'HTTP_IF_MODIFIED_SINCE' : blog.format_http_date(2000000000)})
+	assert res.status == '200 OK'
+
+@pytest.mark.parametrize('since, status', [
+	(1500000000, '304 Not Modified'),
+	(1600000000, '304 Not Modified'),
+	(1499999999, '200 OK'),
+])
+def test_if_modified_since(since, status):
+	res = make_page().respond({'HTTP_IF_MODIFIED_SINCE' : blog.format_http_date(since)})
+	assert res.status == status
+
+def test_not_modified_without_a_cached_page():
+	res = blog.Response()
+	blog.not_modified(res, 1500000000)
+	assert res.status == '304 Not Modified'
+	assert header(res, 'Last-Modified') == blog.format_http_date(1500000000)
+
+def test_keep_page_compresses_and_caches(page_cache):
+	page = make_page()
+	blog.keep_page('key', page, page_cache.generation)
+	assert page_cache.get('key') is page
+	assert 'gzip' in page.bodies
+
+def test_keep_page_skips_pages_from_before_a_change(page_cache):
+	page = make_page()
+	generation = page_cache.generation
+	page_cache.clear()
+	blog.keep_page('key', page, generation)
+	assert page_cache.get('key') is None
+	assert list(page.bodies) == ['identity']
+
+def test_keep_page_skips_pages_too_big_to_cache(page_cache):
+	page = make_page('x' * 200000)
+	blog.keep_page('key', page, page_cache.generation)
+	assert page_cache.get('key') is None
+	assert list(page.bodies) == ['identity']
+
+@pytest.fixture
+def big_posts(tmp_path, monkeypatch, page_cache):
+	import os
+	import datetime
+	import snapshot
+	repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+	monkeypatch.setitem(blog.template_config, 'post_template', os.path.join(repo_dir, 'templates', 'home_temp.html'))
+	monkeypatch.setitem(blog.stream_config, 'threshold', 1000)
+	path = str(tmp_path / 'snapshot')
+	snapshot.write_snapshot(path, [(1, 'big', 'Big', datetime.date(2017, 1, 1), 1500000000, '', 'word ' * 1000)])
+	monkeypatch.setitem(blog.snapshot_config, 'snapshot_file', path)
+	return blog.PostPage(1, 'Big', 'big', datetime.date(2017, 1, 1), 'word ' * 1000, 1500000000, None, None)
+
+def get(query, **headers):
+	environ = {'REQUEST_METHOD' : 'GET', 'QUERY_STRING' : 'p=' + query}
+	environ.update(headers)
+	return blog.handle_request(environ)
+
+def test_big_posts_from_the_database_are_cached(big_posts):
+	res = blog.Response()
+	blog.render_post(res, big_posts)
+	assert not res.streaming
+
+def test_big_posts_from_the_snapshot_are_streamed(big_posts, page_cache):
+	res = get('big')
+	assert res.streaming
+	assert b''.join(res.iter_body()).count(b'word') == 1000
+	assert page_cache.get('big') is None
+
+def test_streamed_posts_get_a_304_by_last_modified(big_posts):
+	res = get('big', HTTP_IF_MODIFIED_SINCE = blog.format_http_date(1500000000))
+	assert res.status == '304 Not Modified'
+	assert not res.streaming and res.body() == b''
+	assert get('big', HTTP_IF_MODIFIED_SINCE = blog.format_http_date(1400000000)).streaming
@@ -0,0 +1,136 @@
+"""
+Tests for ratelimit.py and how blog.py admits requests for the expensive pages.
+"""
+import os
+import time
+
+import pytest
+
+import blog
+import ratelimit
+
+@pytest.fixture
+def limit_path(tmp_path):
+	return str(tmp_path / 'limits')
+
+def test_burst_then_wait(limit_path):
+	limiter = ratelimit.RateLimiter(limit_path, burst = 3, rate = 2, concurrency = 0)
+	assert [limiter.take('1.1.1.1') for i in range(3)] == [0, 0, 0]
+	assert limiter.take('1.1.1.1') == pytest.approx(0.5, abs = 0.05)
+	# other clients have their own bucket
+	assert limiter.take('2.2.2.2') == 0
+
+def test_tokens_come_back(limit_path, monkeypatch):
+	now = [1000.0]
+	monkeypatch.setattr(ratelimit.time, 'time', lambda: now[0])
+	limiter = ratelimit.RateLimiter(limit_path, burst = 2, rate = 1, concurrency = 0)
+	assert limiter.take('a') == 0 and limiter.take('a') == 0
+	assert limiter.take('a') == pytest.approx(1)
+	now[0] += 1
+	assert limiter.take('a') == 0
+	# never more than burst
+	now[0] += 100
+	assert [limiter.take('a') for i in range(3)][-1] > 0
+
+def test_no_rate_waits_an_hour(limit_path):
+	limiter = ratelimit.RateLimiter(limit_path, burst = 1, rate = 0, concurrency = 0)
+	assert limiter.take('a') == 0
+	assert limiter.take('a') == 3600
+
+def test_buckets_are_shared_between_openers(limit_path):
+	first = ratelimit.RateLimiter(limit_path, burst = 1, rate = 0.001, concurrency = 0)
+	second = ratelimit.RateLimiter(limit_path, burst = 1, rate = 0.001, concurrency = 0)
+	assert first.take('a') == 0
+	assert second.take('a') > 0
+
+def test_file_of_another_size_is_refused(limit_path):
+	ratelimit.RateLimiter(limit_path, burst = 1, rate = 1, concurrency = 0, slot_count = 8)
+	with pytest.raises(ValueError):
+		ratelimit.RateLimiter(limit_path, burst = 1, rate = 1, concurrency = 0, slot_count = 16)
+
+def test_places(limit_path):
+	limiter = ratelimit.RateLimiter(limit_path, burst = 1, rate = 1, concurrency = 2)
+	first = limiter.enter()
+	second = limiter.enter()
+	assert {first, second} == {0, 1}
+	assert limiter.enter() is None
+	limiter.leave(first)
+	assert limiter.enter() == first
+
+def test_unlimited_places(limit_path):
+	limiter = ratelimit.RateLimiter(limit_path, burst = 1, rate = 1, concurrency = 0)
+	assert limiter.enter() == -1
+	limiter.leave(-1)
+
+def test_places_held_by_another_process_are_let_go_when_it_exits(limit_path):
+	limiter = ratelimit.RateLimiter(limit_path, burst = 1, rate = 1, concurrency = 1)
+	read_fd, write_fd = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		child = ratelimit.RateLimiter(limit_path, burst = 1, rate = 1, concurrency = 1)
+		os.write(write_fd, b'0' if child.enter() == 0 else b'x')
+		time.sleep(0.5)
+		os._exit(0)
+	assert os.read(read_fd, 1) == b'0'
+	assert limiter.enter() is None
+	os.waitpid(pid, 0)
+	assert limiter.enter() == 0
+
+@pytest.fixture
+def limits(limit_path, monkeypatch):
+	monkeypatch.setitem(blog.limit_config, 'limit_file', limit_path)
+	monkeypatch.setitem(blog.limit_config, 'burst', 2)
+	monkeypatch.setitem(blog.limit_config, 'rate', 0.001)
+	monkeypatch.setitem(blog.limit_config, 'concurrency', 1)
+	monkeypatch.setitem(blog.limit_config, 'forwarded_for', False)
+	monkeypatch.setitem(blog.open_limiter, 'path', None)
+	monkeypatch.setitem(blog.open_limiter, 'limiter', None)
+	return blog.get_limiter
+
+def admit(client):
+	res = blog.Response()
+	done = blog.admit(res, {'REMOTE_ADDR' : client})
+	return res, done
+
+def test_admit_turns_away_clients_over_their_rate(limits):
+	for i in range(2):
+		res, done = admit('1.1.1.1')
+		assert done is not None
+		done()
+	res, done = admit('1.1.1.1')
+	assert done is None
+	assert res.status == '429 Too Many Requests'
+	assert int(dict(res.headers)['Retry-After']) >= 1
+	# the place it was given back is free for others
+	res, done = admit('2.2.2.2')
+	assert done is not None
+
+def test_full_cap_doesnt_spend_tokens(limits):
+	place = limits().enter()
+	for i in range(5):
+		res, done = admit('1.1.1.1')
+		assert done is None
+		assert dict(res.headers)['Retry-After'] == '1'
+	limits().leave(place)
+	for i in range(2):
+		res, done = admit('1.1.1.1')
+		assert done is not None
+		done()
+
+def test_client_address(monkeypatch):
+	environ = {'REMOTE_ADDR' : '127.0.0.1', 'HTTP_X_FORWARDED_FOR' : '6.6.6.6, 5.5.5.5'}
+	monkeypatch.setitem(blog.limit_config, 'forwarded_for', False)
+	assert blog.client_address(environ) == '127.0.0.1'
+	monkeypatch.setitem(blog.limit_config, 'forwarded_for', True)
+	# only the address the proxy added can be trusted
+	assert blog.client_address(environ) == '5.5.5.5'
+	assert blog.client_address({'REMOTE_ADDR' : '127.0.0.1'}) == '127.0.0.1'
+
+def test_limits_off_when_the_file_cant_be_opened(tmp_path, monkeypatch):
+	monkeypatch.setitem(blog.limit_config, 'limit_file', str(tmp_path / 'missing' / 'limits'))
+	monkeypatch.setitem(blog.open_limiter, 'path', None)
+	monkeypatch.setitem(blog.open_limiter, 'limiter', None)
+	monkeypatch.setattr(blog, 'log_print', lambda *args, **kwargs: None)
+	assert blog.get_limiter() is None
+	res, done = admit('1.1.1.1')
+	assert done is not None
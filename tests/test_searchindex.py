@@ -0,0 +1,77 @@
+"""
+Tests for searchindex.py: tokenizing, writing and reading the index, and ranking.
+"""
+import pytest
+
+import searchindex
+
+rows = [
+	(1, 'python-tips', 'Python tips', 'A few tips', '<p>\nPython lists and python dicts\n</p>\n'),
+	(2, 'cooking', 'Cooking at home', 'Soup &amp; bread', '<p>\nBread needs time\n</p>\n'),
+	(3, 'snakes', 'Snakes', 'Not about python', '<p>\nA python is a snake\n</p>\n'),
+]
+
+@pytest.fixture
+def index_path(tmp_path):
+	path = str(tmp_path / 'search')
+	searchindex.build_index(path, rows)
+	return path
+
+def test_tokenize_drops_stop_words_and_case():
+	assert searchindex.tokenize('The Python and THE snake') == ['python', 'snake']
+
+def test_tokenize_strips_html():
+	assert searchindex.tokenize('<b>Soup</b> &amp; bread', strip_html = True) == ['soup', 'bread']
+
+def test_search_ranks_title_matches_first(index_path):
+	index = searchindex.SearchIndex(index_path)
+	results = index.search('python')
+	assert [result.url_title for result in results] == ['python-tips', 'snakes']
+	assert results[0].rank > results[1].rank
+	index.close()
+
+def test_search_terms_not_in_index(index_path):
+	index = searchindex.SearchIndex(index_path)
+	assert index.search('rust') == []
+	assert index.search('the and of') == []
+	index.close()
+
+def test_search_limit(index_path):
+	index = searchindex.SearchIndex(index_path)
+	assert len(index.search('python bread', limit = 1)) == 1
+	index.close()
+
+def test_read_posts_round_trips(index_path):
+	index = searchindex.SearchIndex(index_path)
+	posts = index.read_posts()
+	index.close()
+	assert posts == dict(searchindex.index_row(row) for row in rows)
+
+def test_update_index_replaces_and_removes(index_path):
+	searchindex.update_index(index_path, [(2, 'cooking', 'Cooking python', '', '')], removed = [3])
+	index = searchindex.SearchIndex(index_path)
+	assert [result.url_title for result in index.search('python')] == ['cooking', 'python-tips']
+	assert index.search('snake') == []
+	index.close()
+
+def test_empty_index(tmp_path):
+	path = str(tmp_path / 'search')
+	searchindex.build_index(path, [])
+	index = searchindex.SearchIndex(path)
+	assert index.search('python') == []
+	index.close()
+
+def test_rejects_other_files(tmp_path):
+	path = tmp_path / 'search'
+	path.write_bytes(b'not an index' * 10)
+	with pytest.raises(ValueError):
+		searchindex.SearchIndex(str(path))
+
+@pytest.mark.parametrize('keep', [2, searchindex.HEADER.size, searchindex.HEADER.size + 8, -1])
+def test_rejects_cut_short_files(index_path, keep):
+	with open(index_path, 'rb') as fh:
+		data = fh.read()
+	with open(index_path, 'wb') as fh:
+		fh.write(data[:keep] if keep > 0 else data[:len(data) - len(data) // 3])
+	with pytest.raises(ValueError):
+		searchindex.SearchIndex(index_path)
@@ -0,0 +1,85 @@
+"""
+Tests for sharedcache.py, the page cache the workers share.
+"""
+import os
+
+import pytest
+
+import sharedcache
+
+@pytest.fixture
+def cache(tmp_path):
+	return sharedcache.SharedCache(4096, version_path = str(tmp_path / 'version'), slot_count = 16, directory = str(tmp_path))
+
+def test_put_and_get(cache):
+	assert cache.get('a') is None
+	cache.put('a', {'page' : b'x' * 100})
+	assert cache.get('a') == {'page' : b'x' * 100}
+	assert cache.get(('archive', None, None)) is None
+	stats = cache.stats()
+	assert (stats['hits'], stats['misses'], stats['entries']) == (1, 2, 1)
+
+def test_keys_with_the_same_slot_replace_each_other(tmp_path):
+	cache = sharedcache.SharedCache(4096, slot_count = 1, directory = str(tmp_path))
+	cache.put('a', 1)
+	cache.put('b', 2)
+	assert cache.get('a') is None
+	assert cache.get('b') == 2
+
+def test_oldest_entries_are_written_over(cache):
+	for i in range(40):
+		cache.put(i % 16, bytes(500) + bytes([i]))
+	# only the newest entries fit in 4096 bytes
+	assert cache.get(15) is None
+	assert cache.get(39 % 16) == bytes(500) + bytes([39])
+	assert cache.stats()['bytes'] <= cache.max_bytes
+
+def test_values_bigger_than_the_cache_are_not_kept(cache):
+	cache.put('big', bytes(5000))
+	assert cache.get('big') is None
+
+def test_clear_keeps_stale_values(cache):
+	cache.put('a', 1)
+	cache.clear()
+	assert cache.get('a') is None
+	assert cache.get_stale('a') == 1
+	cache.put('a', 2)
+	assert cache.get('a') == 2
+	assert cache.get_stale('a') is None
+
+def test_put_from_before_a_clear_is_dropped(cache):
+	generation = cache.generation
+	cache.clear()
+	cache.put('a', 1, generation)
+	assert cache.get('a') is None
+	cache.put('a', 1, cache.generation)
+	assert cache.get('a') == 1
+
+def test_version_file_change_empties_the_cache(cache, tmp_path):
+	cache.check_version()
+	cache.put('a', 1)
+	cache.check_version()
+	assert cache.get('a') == 1
+	(tmp_path / 'version').write_text('1')
+	cache.check_version()
+	assert cache.get('a') is None
+
+def test_forked_processes_share_entries(cache):
+	cache.put('parent', 'from parent')
+	pid = os.fork()
+	if pid == 0:
+		ok = cache.get('parent') == 'from parent'
+		cache.put('child', 'from child')
+		os._exit(0 if ok else 1)
+	_, status = os.waitpid(pid, 0)
+	assert os.WEXITSTATUS(status) == 0
+	assert cache.get('child') == 'from child'
+
+def test_clear_in_one_process_empties_the_cache_for_all(cache):
+	cache.put('a', 1)
+	pid = os.fork()
+	if pid == 0:
+		cache.clear()
+		os._exit(0)
+	os.waitpid(pid, 0)
+	assert cache.get('a') is None
@@ -0,0 +1,155 @@
+"""
+Tests for rendering a page that isn't cached once, while other requests for it wait.
+"""
+import os
+import time
+import threading
+
+import pytest
+
+import blog
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+last_modified = 1500000000
+
+class BlockingPost:
+	"""
+	Stands in for blog.serve_post(). The first render waits until release() is called,
+	so other requests for the page can pile up behind it. Renders are numbered in their bodies.
+	"""
+	def __init__(self, fail = None):
+		self.renders = 0
+		self.fail = fail
+		self.started = threading.Event()
+		self.released = threading.Event()
+		self.lock = threading.Lock()
+
+	def __call__(self, res, url_title = None, environ = None):
+		with self.lock:
+			self.renders += 1
+			render = self.renders
+		if render == 1:
+			self.started.set()
+			assert self.released.wait(5)
+			if self.fail is not None:
+				raise self.fail
+		if environ is not None and blog.is_not_modified(environ, last_modified = last_modified):
+			blog.not_modified(res, last_modified)
+			return
+		blog.print_headers(res, ['Last-Modified: ' + blog.format_http_date(last_modified)])
+		res.write('render {}'.format(render))
+
+	def release(self):
+		self.released.set()
+
+@pytest.fixture
+def page_cache(monkeypatch):
+	cache = blog.LRUCache(100000, sizeof = lambda page: page.size(), keep_stale = True)
+	monkeypatch.setattr(blog, 'page_cache', cache)
+	monkeypatch.setattr(blog, 'page_flights', blog.SingleFlight())
+	monkeypatch.setitem(blog.cache_config, 'flight_timeout', 5)
+	monkeypatch.setitem(blog.cache_config, 'serve_stale', False)
+	monkeypatch.setitem(blog.template_config, 'post_template', os.path.join(repo_dir, 'templates', 'home_temp.html'))
+	return cache
+
+@pytest.fixture
+def post(monkeypatch, page_cache):
+	post = BlockingPost()
+	monkeypatch.setattr(blog, 'serve_post', post)
+	return post
+
+def get(**headers):
+	environ = {'REQUEST_METHOD' : 'GET', 'QUERY_STRING' : 'p=post-1'}
+	environ.update(headers)
+	res = blog.handle_request(environ)
+	return res.status, res.body()
+
+class Requests:
+	"""
+	Runs get() in a thread for each of environs, and keeps what they returned in order.
+	"""
+	def __init__(self, *environs):
+		self.results = [None] * len(environs)
+		self.threads = [threading.Thread(target = self.run, args = (number, environ)) for number, environ in enumerate(environs)]
+		for thread in self.threads:
+			thread.start()
+
+	def run(self, number, environ):
+		self.results[number] = get(**environ)
+
+	def join(self):
+		for thread in self.threads:
+			thread.join(10)
+		return self.results
+
+def wait_until(check):
+	deadline = time.monotonic() + 5
+	while not check():
+		assert time.monotonic() < deadline
+		time.sleep(0.001)
+
+def test_page_is_rendered_once_for_every_waiting_request(post, page_cache):
+	leader = Requests({})
+	assert post.started.wait(5)
+	waiters = Requests(*[{}] * 8)
+	wait_until(lambda: blog.page_flights.stats()['waits'] == 8)
+	post.release()
+	assert leader.join() + waiters.join() == [('200 OK', b'render 1')] * 9
+	assert post.renders == 1
+	assert blog.page_flights.stats()['rendering'] == 0
+	assert page_cache.get('post-1') is not None
+
+def test_waiters_render_their_own_page_after_the_timeout(post, monkeypatch):
+	monkeypatch.setitem(blog.cache_config, 'flight_timeout', 0.05)
+	leader = Requests({})
+	assert post.started.wait(5)
+	assert get() == ('200 OK', b'render 2')
+	post.release()
+	assert leader.join() == [('200 OK', b'render 1')]
+
+def test_waiters_get_the_stale_page_with_serve_stale(post, page_cache, monkeypatch):
+	monkeypatch.setitem(blog.cache_config, 'serve_stale', True)
+	res = blog.Response()
+	res.write('old')
+	page_cache.put('post-1', blog.CachedPage(res))
+	page_cache.clear()
+	leader = Requests({})
+	assert post.started.wait(5)
+	assert get() == ('200 OK', b'old')
+	assert blog.page_flights.stats()['stale'] == 1
+	post.release()
+	assert leader.join() == [('200 OK', b'render 1')]
+	assert post.renders == 1
+
+def test_waiters_render_their_own_page_when_the_leader_fails(monkeypatch, page_cache):
+	post = BlockingPost(fail = blog.SQLError())
+	monkeypatch.setattr(blog, 'serve_post', post)
+	leader = Requests({})
+	assert post.started.wait(5)
+	waiters = Requests({}, {})
+	wait_until(lambda: blog.page_flights.stats()['waits'] == 2)
+	post.release()
+	assert leader.join()[0][0] == '500 Internal Error'
+	assert sorted(waiters.join()) == [('200 OK', b'render 2'), ('200 OK', b'render 3')]
+	assert blog.page_flights.stats()['rendering'] == 0
+
+def test_flight_is_finished_when_the_leader_raises(monkeypatch, page_cache):
+	post = BlockingPost(fail = RuntimeError('boom'))
+	monkeypatch.setattr(blog, 'serve_post', post)
+	post.release()
+	with pytest.raises(RuntimeError):
+		get()
+	assert blog.page_flights.stats()['rendering'] == 0
+	assert get() == ('200 OK', b'render 2')
+
+def test_leader_with_a_fresh_copy_renders_the_whole_page_for_the_waiters(post, page_cache):
+	fresh = {'HTTP_IF_MODIFIED_SINCE' : blog.format_http_date(last_modified)}
+	leader = Requests(fresh)
+	assert post.started.wait(5)
+	waiters = Requests({}, {})
+	wait_until(lambda: blog.page_flights.stats()['waits'] == 2)
+	post.release()
+	assert leader.join() == [('304 Not Modified', b'')]
+	assert waiters.join() == [('200 OK', b'render 1')] * 2
+	assert post.renders == 1
+	assert page_cache.get('post-1') is not None
@@ -0,0 +1,116 @@
+"""
+Tests for snapshot.py: writing a snapshot and looking posts and archive pages up in it.
+"""
+import os
+import datetime
+import collections
+
+import pytest
+
+import blog
+import snapshot
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def make_rows(count):
+	# (post_id, url_title, title, post_date, updated_at, description, text), a few posts a day
+	return [
+		(i, 'post-{:03d}'.format(i), 'Post {}'.format(i), datetime.date(2017, 1, 1) + datetime.timedelta(days = i // 3), 1500000000 + i, 'desc {}'.format(i), '<p>\ntext {} é\n</p>\n'.format(i))
+		for i in range(1, count + 1)
+	]
+
+@pytest.fixture
+def snap(tmp_path):
+	path = str(tmp_path / 'snapshot')
+	# written out of order, the snapshot sorts them
+	snapshot.write_snapshot(path, reversed(make_rows(20)))
+	return snapshot.Snapshot(path)
+
+def newest_first(count):
+	return sorted(make_rows(count), key = lambda row: (row[3], row[0]), reverse = True)
+
+def test_first_post_page_is_the_newest(snap):
+	[post] = snap.post_page(blog.PostPage)
+	assert post.url_title == 'post-020'
+	assert post.prev_url is None
+	assert post.next_url == 'post-019'
+	assert bytes(post.text).decode('utf8') == '<p>\ntext 20 é\n</p>\n'
+
+def test_every_post_is_found_with_its_neighbours(snap):
+	order = [row[1] for row in newest_first(20)]
+	for number, url_title in enumerate(order):
+		[post] = snap.post_page(blog.PostPage, url_title)
+		assert post.url_title == url_title
+		assert post.prev_url == (order[number - 1] if number > 0 else None)
+		assert post.next_url == (order[number + 1] if number + 1 < len(order) else None)
+
+@pytest.mark.parametrize('url_title', ['post-000', 'post-021', 'post-0105', 'a', 'zzz', ''])
+def test_missing_posts(snap, url_title):
+	assert snap.find(url_title) is None
+	assert snap.post_page(blog.PostPage, url_title) == []
+
+def test_fields_the_snapshot_doesnt_have_are_none(snap):
+	Record = collections.namedtuple('Record', 'url_title rank')
+	[post] = snap.archive_page(Record, 1)
+	assert post == Record('post-020', None)
+
+def test_first_archive_page(snap):
+	page = snap.archive_page(blog.ArchiveEntry, 4)
+	assert [post.post_id for post in page] == [20, 19, 18, 17]
+	assert page[0].post_date == datetime.date(2017, 1, 7)
+	assert page[0].updated_at == 1500000020
+
+@pytest.mark.parametrize('post_id', range(1, 21))
+def test_archive_before_and_after_every_post(snap, post_id):
+	rows = newest_first(20)
+	row = next(row for row in rows if row[0] == post_id)
+	cursor = (row[3], row[3], row[0])
+	older = [r[0] for r in rows if (r[3], r[0]) < (row[3], row[0])]
+	newer = [r[0] for r in reversed(rows) if (r[3], r[0]) > (row[3], row[0])]
+	assert [post.post_id for post in snap.archive_page(blog.ArchiveEntry, 4, before = cursor)] == older[:4]
+	assert [post.post_id for post in snap.archive_page(blog.ArchiveEntry, 4, after = cursor)] == newer[:4]
+
+def test_empty_snapshot(tmp_path):
+	path = str(tmp_path / 'snapshot')
+	snapshot.write_snapshot(path, [])
+	snap = snapshot.Snapshot(path)
+	assert snap.post_page(blog.PostPage) == []
+	assert snap.post_page(blog.PostPage, 'post-001') == []
+	assert snap.archive_page(blog.ArchiveEntry, 4) == []
+
+def test_rejects_other_files(tmp_path):
+	path = tmp_path / 'snapshot'
+	path.write_bytes(b'not a snapshot' * 10)
+	with pytest.raises(ValueError):
+		snapshot.Snapshot(str(path))
+
+@pytest.mark.parametrize('keep', [2, snapshot.HEADER.size, snapshot.HEADER.size + 8, -1])
+def test_rejects_cut_short_files(tmp_path, keep):
+	path = tmp_path / 'snapshot'
+	snapshot.write_snapshot(str(path), make_rows(5))
+	data = path.read_bytes()
+	path.write_bytes(data[:keep])
+	with pytest.raises(ValueError):
+		snapshot.Snapshot(str(path))
+
+def test_blog_ignores_cut_short_snapshots(tmp_path, monkeypatch):
+	path = tmp_path / 'snapshot'
+	snapshot.write_snapshot(str(path), make_rows(5))
+	path.write_bytes(path.read_bytes()[:-1])
+	monkeypatch.setitem(blog.snapshot_config, 'snapshot_file', str(path))
+	monkeypatch.setitem(blog.open_snapshot, 'version', None)
+	assert blog.get_snapshot() is None
+
+def test_blog_serves_posts_from_the_snapshot(tmp_path, monkeypatch):
+	path = str(tmp_path / 'snapshot')
+	snapshot.write_snapshot(path, make_rows(5))
+	monkeypatch.setitem(blog.snapshot_config, 'snapshot_file', path)
+	monkeypatch.setitem(blog.template_config, 'post_template', os.path.join(repo_dir, 'templates', 'home_temp.html'))
+	res = blog.Response()
+	blog.serve_post(res, 'post-003')
+	assert res.status == '200 OK'
+	page = res.body().decode('utf8')
+	assert 'text 3 é' in page and '?p=post-004' in page and '?p=post-002' in page
+	res = blog.Response()
+	blog.serve_post(res, 'post-009')
+	assert res.status == '404 Not Found'
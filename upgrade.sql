@@ -0,0 +1,21 @@
+-- Run this on databases created with an older init.sql.
+-- Each block brings the schema up to date with one change to init.sql.
+USE blog;
+
+-- Indexes for finding a post by url title and finding its neighbours
+ALTER TABLE blog_posts
+  ADD KEY post_order (post_date, post_id),
+  ADD KEY url_title (url_title(64));
+
+-- Contact page challenges are signed tokens now, blog.py doesn't store them
+DROP EVENT IF EXISTS delete_old_email_challenges;
+DROP TABLE IF EXISTS email_challenges;
+
+-- When each post last changed, for the Last-Modified header
+ALTER TABLE blog_posts
+  ADD COLUMN updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP;
+
+-- Posts whose url title is one of blog.py's own pages (?p=archive, ?p=feed...) can't be reached,
+-- blog.py serves its page instead. post.py refuses these url titles now. This lists any older
+-- posts that have one, rename each with ./post.py -u <url title> -url <new url title>
+SELECT post_id, url_title FROM blog_posts WHERE url_title IN ('archive', 'contact', 'feed', 'sitemap', 'metrics');
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# LightBlog: a lightweight Python blogging application.
+# Copyright (C) 2017  Dylan Spriggs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Remembers which contact page challenges were already answered, for every process at once.
+
+Every CGI process and worker opens the same file and memory maps it, so a challenge answered
+in one of them can't be answered again in another. The file is laid out as:
+	header		magic, number of buckets
+	buckets		for every bucket: BUCKET_SIZE entries, each a hash of a nonce and when it expires
+A nonce goes in the bucket its hash picks, in an entry that's empty or expired. When every
+entry in the bucket is still good, the one that expires first is written over, so a full
+table forgets the nonces closest to expiring and not the newest ones.
+"""
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+
+MAGIC = b'LBUN'
+# magic, bucket count
+HEADER = struct.Struct('=4sI')
+# nonce hash, expiry time
+ENTRY = struct.Struct('=Qq')
+BUCKET_SIZE = 8
+
+class UsedNonces:
+	"""
+	The shared table of answered nonces in the file at path, which is made if it doesn't exist.
+	It holds up to bucket_count * BUCKET_SIZE nonces.
+	"""
+	def __init__(self, path, bucket_count = 2048):
+		self.bucket_count = bucket_count
+		size = HEADER.size + ENTRY.size * BUCKET_SIZE * bucket_count
+		self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			# the first process to open the file sets it up, the rest wait for it
+			fcntl.lockf(self.fd, fcntl.LOCK_EX)
+			if os.fstat(self.fd).st_size == 0:
+				os.ftruncate(self.fd, size)
+				os.pwrite(self.fd, HEADER.pack(MAGIC, bucket_count), 0)
+			fcntl.lockf(self.fd, fcntl.LOCK_UN)
+			# other processes may have it mapped, so a file that doesn't match is left alone
+			if os.fstat(self.fd).st_size != size or os.pread(self.fd, HEADER.size, 0) != HEADER.pack(MAGIC, bucket_count):
+				raise ValueError('{} is not a nonce file with {} buckets, delete it to start over'.format(path, bucket_count))
+			self.map = mmap.mmap(self.fd, size)
+		except (OSError, ValueError):
+			os.close(self.fd)
+			raise
+		# fcntl locks don't keep this process' threads out of each other's way
+		self.lock = threading.Lock()
+
+	def use(self, nonce, expires):
+		"""
+		Marks nonce as used until expires. Returns False if it was already used.
+		"""
+		# 0 marks an empty entry
+		nonce_hash = int.from_bytes(hashlib.blake2b(nonce.encode('utf8'), digest_size = 8).digest(), 'little') or 1
+		bucket = HEADER.size + ENTRY.size * BUCKET_SIZE * (nonce_hash % self.bucket_count)
+		now = time.time()
+		with self.lock:
+			fcntl.lockf(self.fd, fcntl.LOCK_EX)
+			try:
+				replace = None
+				replace_expires = None
+				for entry in range(bucket, bucket + ENTRY.size * BUCKET_SIZE, ENTRY.size):
+					found_hash, found_expires = ENTRY.unpack_from(self.map, entry)
+					if found_expires < now:
+						found_expires = 0
+					elif found_hash == nonce_hash:
+						return False
+					if replace is None or found_expires < replace_expires:
+						replace = entry
+						replace_expires = found_expires
+				ENTRY.pack_into(self.map, replace, nonce_hash, int(expires))
+			finally:
+				fcntl.lockf(self.fd, fcntl.LOCK_UN)
+		return True